@@ -0,0 +1,299 @@
+import array
+import chess
+import chess.pgn
+import json
+import mmap
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+from navigator import PlyNavigator, encode_move, decode_move
+from ratings import get_archive_files
+
+## packed game archive
+## every move is 2 bytes, a game is a fixed header followed by its moves and
+## an index at the end holds the offset of every game, so a game, a header or
+## the move of any ply is a seek away, nothing gets parsed
+## the file is read through mmap, only the pages that are touched get loaded,
+## opening an archive reads its header and nothing else whatever its size
+##
+##   ARCHIVE_HEADER: magic, version, games, strings, index offset, strings offset
+##   games:   GAME_HEADER, then plies * uint16 moves
+##   index:   uint64 offset of every game
+##   strings: uint64 offset of every string and of the end, then the utf8
+##            strings, names, dates, FENs and extra headers point into them
+##
+## moves are packed with navigator.encode_move
+## only the mainline is kept, comments and variations are dropped
+
+ARCHIVE_MAGIC = b"CHESSARC"
+ARCHIVE_VERSION = 2
+
+ARCHIVE_HEADER = "<8sIIIQQ"
+ARCHIVE_HEADER_SIZE = struct.calcsize(ARCHIVE_HEADER)
+
+## white, black, date, start FEN, extra headers (string ids), result, plies
+GAME_HEADER = "<IIIIIBI"
+GAME_HEADER_SIZE = struct.calcsize(GAME_HEADER)
+
+RESULTS = ["*", "1-0", "0-1", "1/2-1/2"]
+
+## headers that have their own field
+HEADER_FIELDS = ["White", "Black", "Date", "Result", "FEN", "SetUp"]
+## what chess.pgn.Game() fills in by itself, not worth storing
+DEFAULT_HEADERS = {"Event": "?", "Site": "?", "Round": "?"}
+
+class ArchiveWriter:
+    def __init__(self, path):
+        self.f = open(path, "wb")
+        ## header gets its counts and offsets on close
+        self.f.write(bytes(ARCHIVE_HEADER_SIZE))
+
+        self.offsets = []
+        self.strings = [""]
+        self.string_ids = {"": 0}
+
+    def get_string_id(self, s):
+        i = self.string_ids.get(s)
+        if i is None:
+            i = self.string_ids[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+    def add(self, headers, moves, start_fen=None):
+        moves = array.array("H", [encode_move(move) for move in moves])
+        if sys.byteorder != "little":
+            moves.byteswap()
+
+        extra = {key: value for key,value in headers.items() if not key in HEADER_FIELDS and DEFAULT_HEADERS.get(key) != value}
+        result = headers.get("Result", "*")
+
+        self.offsets.append(self.f.tell())
+        self.f.write(struct.pack(GAME_HEADER,
+                                 self.get_string_id(headers.get("White", "?")),
+                                 self.get_string_id(headers.get("Black", "?")),
+                                 self.get_string_id(headers.get("Date", "")),
+                                 self.get_string_id(start_fen or ""),
+                                 self.get_string_id(json.dumps(extra) if extra else ""),
+                                 RESULTS.index(result) if result in RESULTS else 0,
+                                 len(moves)))
+        self.f.write(moves.tobytes())
+
+    def add_game(self, game):
+        board = game.board()
+        self.add(game.headers, game.mainline_moves(), None if board.fen() == chess.STARTING_FEN else board.fen())
+
+    def close(self):
+        index_offset = self.f.tell()
+        self.f.write(struct.pack(f"<{len(self.offsets)}Q", *self.offsets))
+
+        strings_offset = self.f.tell()
+        data = [s.encode("utf-8") for s in self.strings]
+        offsets = [0]
+        for s in data:
+            offsets.append(offsets[-1] + len(s))
+        self.f.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+        self.f.write(b"".join(data))
+
+        self.f.seek(0)
+        self.f.write(struct.pack(ARCHIVE_HEADER, ARCHIVE_MAGIC, ARCHIVE_VERSION, len(self.offsets), len(self.strings), index_offset, strings_offset))
+        self.f.close()
+
+class GameArchive:
+    def __init__(self, path):
+        self.f = open(path, "rb")
+        self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic,version,self.games,self.num_strings,self.index_offset,self.strings_offset = struct.unpack_from(ARCHIVE_HEADER, self.map, 0)
+        if magic != ARCHIVE_MAGIC or version != ARCHIVE_VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a version {ARCHIVE_VERSION} archive")
+
+        ## the strings themselves come after their offsets
+        self.string_data = self.strings_offset + (self.num_strings + 1) * 8
+
+    def __len__(self):
+        return self.games
+
+    ## offset of game i, read off the index when needed
+    def get_offset(self, i):
+        if i < 0:
+            i += self.games
+        if i < 0 or i >= self.games:
+            raise IndexError(f"game {i} not in the archive")
+        return struct.unpack_from("<Q", self.map, self.index_offset + i*8)[0]
+
+    def get_string(self, i):
+        start,end = struct.unpack_from("<2Q", self.map, self.strings_offset + i*8)
+        return self.map[self.string_data + start:self.string_data + end].decode("utf-8")
+
+    def close(self):
+        self.map.close()
+        self.f.close()
+
+    ## (white, black, date, start FEN, extra headers, result, plies)
+    def get_header(self, i):
+        white,black,date,fen,extra,result,plies = struct.unpack_from(GAME_HEADER, self.map, self.get_offset(i))
+        s = self.get_string
+        return s(white), s(black), s(date), s(fen) or None, s(extra), RESULTS[result], plies
+
+    def get_result(self, i):
+        return RESULTS[self.map[self.get_offset(i) + GAME_HEADER_SIZE - 5]]
+
+    def get_plies(self, i):
+        return struct.unpack_from("<I", self.map, self.get_offset(i) + GAME_HEADER_SIZE - 4)[0]
+
+    ## packed moves of game i, as uint16s
+    def get_codes(self, i):
+        offset = self.get_offset(i) + GAME_HEADER_SIZE
+        codes = array.array("H", self.map[offset:offset + self.get_plies(i)*2])
+        if sys.byteorder != "little":
+            codes.byteswap()
+        return codes
+
+    def get_moves(self, i):
+        return [decode_move(code) for code in self.get_codes(i)]
+
+    ## move that led to ply (1 is the first move)
+    def get_move(self, i, ply):
+        if ply <= 0 or ply > self.get_plies(i):
+            return None
+        return decode_move(struct.unpack_from("<H", self.map, self.get_offset(i) + GAME_HEADER_SIZE + (ply-1)*2)[0])
+
+    def get_board(self, i):
+        fen = self.get_header(i)[3]
+        return chess.Board() if fen is None else chess.Board(fen)
+
+    def get_navigator(self, i):
+        return PlyNavigator(self.get_moves(i), self.get_board(i))
+
+    def get_game(self, i):
+        white,black,date,fen,extra,result,plies = self.get_header(i)
+
+        game = chess.pgn.Game()
+        if extra:
+            game.headers.update(json.loads(extra))
+        game.headers["White"] = white
+        game.headers["Black"] = black
+        if date:
+            game.headers["Date"] = date
+        game.headers["Result"] = result
+        if not fen is None:
+            game.setup(chess.Board(fen))
+
+        node = game
+        for move in self.get_moves(i):
+            node = node.add_main_variation(move)
+
+        return game
+
+## every game of the PGN files into an archive, returns the number of games
+def pgn_to_archive(paths, out_path):
+    writer = ArchiveWriter(out_path)
+    games = 0
+    for path in paths:
+        f = open(path, encoding="utf-8")
+        while True:
+            game = chess.pgn.read_game(f)
+            if game is None:
+                break
+            writer.add_game(game)
+            games += 1
+        f.close()
+    writer.close()
+
+    return games
+
+## every game of the archive into one PGN file, returns the number of games
+def archive_to_pgn(path, out_path):
+    archive = GameArchive(path)
+    f = open(out_path, "w", encoding="utf-8")
+    for i in range(0, len(archive)):
+        f.write(str(archive.get_game(i)) + "\n\n")
+    f.close()
+    archive.close()
+
+    return len(archive)
+
+## games of random legal moves, for the benchmark
+def random_games(num_games, max_plies=120, seed=0):
+    rng = random.Random(seed)
+    for n in range(0, num_games):
+        game = chess.pgn.Game()
+        game.headers["White"] = f"player{rng.randrange(100)}"
+        game.headers["Black"] = f"player{rng.randrange(100)}"
+
+        board = chess.Board()
+        node = game
+        for ply in range(0, rng.randrange(20, max_plies)):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            move = rng.choice(moves)
+            board.push(move)
+            node = node.add_main_variation(move)
+
+        game.headers["Result"] = board.result()
+        yield game
+
+## games/s of reading every game with its moves, PGN vs archive
+def benchmark(num_games):
+    tmp_dir = tempfile.mkdtemp()
+    pgn_path = os.path.join(tmp_dir, "bench.pgn")
+    archive_path = os.path.join(tmp_dir, "bench.arc")
+
+    f = open(pgn_path, "w", encoding="utf-8")
+    for game in random_games(num_games):
+        f.write(str(game) + "\n\n")
+    f.close()
+    pgn_to_archive([pgn_path], archive_path)
+
+    t = time.perf_counter()
+    f = open(pgn_path, encoding="utf-8")
+    plies = 0
+    while True:
+        game = chess.pgn.read_game(f)
+        if game is None:
+            break
+        plies += len(list(game.mainline_moves()))
+    f.close()
+    pgn_time = time.perf_counter() - t
+
+    t = time.perf_counter()
+    archive = GameArchive(archive_path)
+    archive_plies = 0
+    for i in range(0, len(archive)):
+        archive.get_header(i)
+        archive_plies += len(archive.get_moves(i))
+    archive.close()
+    archive_time = time.perf_counter() - t
+
+    print(f"archive: {num_games} games, {plies} plies, pgn {os.path.getsize(pgn_path)} bytes, archive {os.path.getsize(archive_path)} bytes")
+    print(f"archive: pgn read_game {num_games / pgn_time:.0f} games/s, archive {num_games / archive_time:.0f} games/s ({pgn_time / archive_time:.1f}x)")
+    if plies != archive_plies:
+        print(f"archive: ply counts differ, pgn {plies} archive {archive_plies}")
+
+    os.remove(pgn_path)
+    os.remove(archive_path)
+    os.rmdir(tmp_dir)
+
+## usage: archive.py pack [match dir] [out.arc]
+##        archive.py unpack in.arc out.pgn
+##        archive.py bench [games]
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "unpack":
+        n = archive_to_pgn(sys.argv[2], sys.argv[3])
+        print(f"archive: {n} games written to {sys.argv[3]}")
+
+    elif len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 2000)
+
+    else:
+        match_dir = sys.argv[2] if len(sys.argv) > 2 else "./matches/"
+        out_path = sys.argv[3] if len(sys.argv) > 3 else "./matches.arc"
+
+        t = time.perf_counter()
+        n = pgn_to_archive(get_archive_files(match_dir), out_path)
+        print(f"archive: packed {n} games into {out_path} in {time.perf_counter() - t:.2f}s")
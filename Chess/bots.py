@@ -0,0 +1,121 @@
+import chess
+import multiprocessing
+import random
+import sys
+import time
+from chessserver import *
+
+BOT_MOVE_RETRY = 1.0    ## seconds without an answer until the move is sent again
+
+## plays random legal moves, for load testing
+class Bot:
+    def __init__(self, ip, port, nick="bot", room=None):
+        self.client = ChessClient(ip, port, nick=nick, room=room)
+
+        self.board = chess.Board()
+        self.side = None
+        self.status = STATUS_WAITING_FOR_PLAYERS
+
+        ## a move was sent and the board didn't come back yet
+        self.waiting_for_board = False
+        self.move_sent = 0
+        self.finished = False
+
+        self.moves = 0
+
+    ## None: no move this turn
+    def choose_move(self):
+        return random.choice(list(self.board.legal_moves))
+
+    def is_our_turn(self):
+        return not self.side is None and self.board.turn == (self.side == 0)
+
+    def update(self):
+        if self.finished:
+            return
+
+        packets = self.client.update()
+        if packets is None:
+            self.finished = True
+            return
+
+        for p_id,payload in packets:
+            if p_id == PACKET_STATUS:
+                self.status = payload[0]
+                if self.status in [STATUS_GAME_ENDED, STATUS_GAME_ENDED_PLAYER_LEFT, STATUS_SERVER_STOPPED]:
+                    self.finished = True
+
+            if p_id == PACKET_SIDE:
+                self.side = payload[0]
+
+            if p_id == PACKET_BOARD:
+                self.board.set_epd(read_utf8_string(payload[1:]))
+                self.waiting_for_board = False
+
+            if p_id == PACKET_GAME_OUTCOME:
+                self.finished = True
+
+        ## move got lost (e.g. rate limited), try again
+        if self.waiting_for_board and time.time() - self.move_sent > BOT_MOVE_RETRY:
+            self.waiting_for_board = False
+
+        if self.status == STATUS_PLAYING and not self.finished and not self.waiting_for_board and self.is_our_turn():
+            move = self.choose_move()
+            if move is None:
+                return
+            self.client.send_move(move.from_square, move.to_square)
+
+            self.waiting_for_board = True
+            self.move_sent = time.time()
+            self.moves += 1
+
+    def disconnect(self):
+        if self.client._client.connected:
+            self.client.disconnect()
+
+## runs bot pairs until time is up, puts the number of moves into the queue
+def load_process(ip, port, seconds, pairs, queue):
+    bots = []
+    moves = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        ## keep the number of games up
+        while len(bots) < pairs * 2:
+            bots.append(Bot(ip, port, nick=f"bot{len(bots)}"))
+
+        for bot in bots:
+            bot.update()
+
+        for bot in [b for b in bots if b.finished]:
+            moves += bot.moves
+            bot.disconnect()
+            bots.remove(bot)
+
+        time.sleep(0.001)
+
+    for bot in bots:
+        moves += bot.moves
+        bot.disconnect()
+
+    queue.put(moves)
+
+## usage: bots.py [ip:port] [seconds] [processes] [pairs per process]
+if __name__ == "__main__":
+    addr = sys.argv[1] if len(sys.argv) > 1 else "127.0.0.1:1337"
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    num_processes = int(sys.argv[3]) if len(sys.argv) > 3 else multiprocessing.cpu_count()
+    pairs = int(sys.argv[4]) if len(sys.argv) > 4 else 50
+
+    ip,port = addr.split(":")
+    port = int(port)
+
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=load_process, args=(ip, port, seconds, pairs, queue)) for i in range(num_processes)]
+    for process in processes:
+        process.start()
+
+    moves = sum([queue.get() for process in processes])
+    for process in processes:
+        process.join()
+
+    print(f"bots: {num_processes * pairs} games at a time, {moves} moves in {seconds}s, {moves / seconds:.1f} moves/s")
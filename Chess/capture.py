@@ -0,0 +1,272 @@
+import json
+import os
+import secrets
+import struct
+import sys
+import time
+from networking import ClientContainer, MAX_SEND_QUEUE, CAPTURE_IN, CAPTURE_OUT, CAPTURE_CONNECT, CAPTURE_DISCONNECT, CAPTURE_HANG, CAPTURE_RTT
+from chessserver import *
+
+## network session captures
+## a Client or Server with a CaptureWriter as recorder writes every packet
+## it handles (after rate limiting) and every packet it sends, plus
+## connects and disconnects (hang-ups apart) on a Server, to a binary file:
+##
+##   CAPTURE_MAGIC, uint32 length + utf8 JSON info (who recorded, clock...)
+##   records: float64 time, uint32 client id, uint8 kind, uint32 length, data
+##   data of CAPTURE_IN/OUT is packet id + payload, of CAPTURE_RTT a float64
+##
+## replay_server feeds a server capture into a socketless ChessServer, at
+## the original or full speed, and checks it sends what the original did,
+## byte for byte: ticks run at their recorded time, round trips are the
+## recorded ones and session tokens the ones the original handed out
+## client captures are replayed in the game window, see chessgame.py --replay
+
+CAPTURE_MAGIC = b"CHESSCAP"
+CAPTURE_DIR = "./captures/"
+CAPTURE_BUFFER = 1 << 16        ## bytes buffered before a write
+
+RECORD_FORMAT = "<dIBI"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+class CaptureWriter:
+    def __init__(self, path, info=None):
+        self.f = open(path, "wb", buffering=CAPTURE_BUFFER)
+        self.f.write(CAPTURE_MAGIC)
+
+        info = json.dumps({} if info is None else info).encode("utf-8")
+        self.f.write(struct.pack("<I", len(info)) + info)
+
+        self.records = 0
+
+    def record(self, t, cl_id, kind, data=b""):
+        if self.f is None:
+            return
+        self.f.write(struct.pack(RECORD_FORMAT, t, cl_id, kind, len(data)))
+        self.f.write(data)
+        self.records += 1
+
+    def record_packets(self, t, cl_id, packets):
+        for p_id,payload in packets:
+            self.record(t, cl_id, CAPTURE_IN, bytes([p_id]) + payload)
+
+    ## buf: a whole packet as made by make_packet
+    def record_send(self, t, cl_id, buf):
+        self.record(t, cl_id, CAPTURE_OUT, buf[4:])
+
+    def close(self):
+        if not self.f is None:
+            self.f.close()
+            self.f = None
+
+## a new capture file in CAPTURE_DIR
+def new_capture(name, info=None):
+    os.makedirs(CAPTURE_DIR, exist_ok=True)
+    path = os.path.join(CAPTURE_DIR, time.strftime(f"%Y-%m-%d_%H-%M-%S_{name}.cap"))
+    return CaptureWriter(path, info)
+
+## (info, records), records being (time, client id, kind, data)
+def read_capture(path):
+    f = open(path, "rb")
+    buf = f.read()
+    f.close()
+
+    if buf[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+        raise ValueError(f"{path} is not a capture")
+
+    pos = len(CAPTURE_MAGIC)
+    info_len = struct.unpack_from("<I", buf, pos)[0]
+    info = json.loads(buf[pos+4:pos+4+info_len].decode("utf-8"))
+    pos += 4+info_len
+
+    records = []
+    ## a capture cut off mid-record (crash) ends at the last whole one
+    while len(buf) - pos >= RECORD_SIZE:
+        t,cl_id,kind,length = struct.unpack_from(RECORD_FORMAT, buf, pos)
+        pos += RECORD_SIZE
+        if len(buf) - pos < length:
+            break
+
+        records.append((t, cl_id, kind, buf[pos:pos+length]))
+        pos += length
+
+    return info, records
+
+## stands in for a connected Client, counts what gets sent to it
+class CaptureConnection:
+    def __init__(self, cl_id):
+        self.cl_id = cl_id
+        self.connected = True
+        self.rtt = None
+        self.max_send_queue = MAX_SEND_QUEUE
+
+        self.sent = 0
+        ## packet id + payload of everything sent
+        self.sent_packets = []
+
+    def _send(self, buf):
+        self.sent += 1
+        self.sent_packets.append(buf[4:])
+
+    def _disconnect(self):
+        self.connected = False
+
+## Server without sockets, the capture decides who connects and what they send
+## like on a Server, connects, packets and disconnects of a tick only take
+## effect in update(), which ChessServer calls after the new client snapshots
+class CaptureServer(ClientContainer):
+    def __init__(self):
+        ClientContainer.__init__(self)
+        self.running = True
+
+        ## (kind, client id, packet) until the next update
+        self.pending = []
+        ## every connection there was, for comparing what they got
+        self.connections = {}
+
+    def push_record(self, kind, cl_id, packet=None):
+        self.pending.append((kind, cl_id, packet))
+
+    ## now: unused, the records carry the time
+    def update(self, now=None):
+        updates = {}
+        for kind,cl_id,packet in self.pending:
+            if kind == CAPTURE_CONNECT:
+                self.clients[cl_id] = self.connections[cl_id] = CaptureConnection(cl_id)
+                self.new_clients.append(cl_id)
+
+            if kind == CAPTURE_IN and cl_id in self.clients:
+                updates.setdefault(cl_id, []).append(packet)
+
+            if kind == CAPTURE_RTT and cl_id in self.clients:
+                self.clients[cl_id].rtt = struct.unpack("<d", packet)[0]
+
+            if kind in [CAPTURE_DISCONNECT, CAPTURE_HANG] and not self.clients.pop(cl_id, None) is None:
+                updates.pop(cl_id, None)
+                if cl_id in self.new_clients:
+                    self.new_clients.remove(cl_id)
+                ## the room ends the game instead of holding the seat
+                if kind == CAPTURE_HANG:
+                    self.hung_up_clients.add(cl_id)
+
+        self.pending = []
+        return updates
+
+    def flush(self):
+        pass
+
+    def stop(self):
+        self.running = False
+
+## plays a client capture back in place of a ChessClient, at speed times
+## the original pace, 0 for everything at once
+## what the player does is dropped
+class CaptureClient:
+    def __init__(self, path, speed=1.0):
+        self.info,records = read_capture(path)
+        self.packets = [(t, (data[0], data[1:])) for t,cl_id,kind,data in records if kind == CAPTURE_IN]
+        self.pos = 0
+
+        self.speed = speed
+        self.start = time.time()
+        self.first = self.packets[0][0] if self.packets else 0
+
+        ## the parts of ChessClient the game looks at
+        self._client = CaptureConnection(0)
+        self.recorder = None
+        self.token = None
+        self.reconnecting = False
+        self.dropped = None
+
+    def update(self):
+        end = len(self.packets)
+        if self.speed > 0:
+            elapsed = (time.time() - self.start) * self.speed
+            end = self.pos
+            while end < len(self.packets) and self.packets[end][0] - self.first <= elapsed:
+                end += 1
+
+        packets = [packet for t,packet in self.packets[self.pos:end]]
+        self.pos = end
+        return packets
+
+    def send_move(self, from_square, to_square):
+        pass
+
+    def send_premoves(self, moves):
+        pass
+
+    def give_up(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+## plays a server capture into a fresh ChessServer, full speed or as recorded
+## returns (records, seconds, mismatched clients): a client is mismatched
+## when the replay sent it other packets than the capture says
+def replay_server(path, realtime=False):
+    info,records = read_capture(path)
+
+    server = CaptureServer()
+    clock = info.get("clock")
+    game = ChessServer(server=server, room=info.get("room"), clock=None if clock is None else tuple(clock))
+    game.save_matches = False
+
+    ## the tokens the original handed out, in order, so resumes match
+    ## a capture that runs out gets fresh ones and shows up as mismatched
+    tokens = iter([data[1:1+SESSION_TOKEN_SIZE] for t,cl_id,kind,data in records if kind == CAPTURE_OUT and data[0] == PACKET_SESSION])
+    game.new_token = lambda size: next(tokens, None) or secrets.token_bytes(size)
+
+    ## what the original server sent, per client
+    expected = {}
+
+    start = time.perf_counter()
+    first = records[0][0] if records else 0
+    tick = None
+    for t,cl_id,kind,data in records:
+        ## records of one server tick share the time, the tick is over when it changes
+        if t != tick and kind != CAPTURE_OUT:
+            if not tick is None:
+                game.update(now=tick)
+            tick = t
+
+            if realtime:
+                wait = (t - first) - (time.perf_counter() - start)
+                if wait > 0:
+                    time.sleep(wait)
+
+        if kind == CAPTURE_OUT:
+            expected.setdefault(cl_id, []).append(data)
+        elif kind == CAPTURE_IN:
+            server.push_record(kind, cl_id, (data[0], data[1:]))
+        else:
+            server.push_record(kind, cl_id, data)
+
+    if not tick is None:
+        game.update(now=tick)
+    elapsed = time.perf_counter() - start
+
+    ## pings are answered by the connection itself, not the game
+    mismatched = []
+    for cl_id,conn in server.connections.items():
+        sent = [data for data in expected.get(cl_id, []) if data[0] != PACKET_PING]
+        if sent != conn.sent_packets:
+            mismatched.append(cl_id)
+
+    return len(records), elapsed, mismatched
+
+## usage: capture.py capture.cap [realtime]
+if __name__ == "__main__":
+    path = sys.argv[1]
+    realtime = len(sys.argv) > 2 and sys.argv[2] == "realtime"
+
+    info,records = read_capture(path)
+    print(f"capture: {path}, {len(records)} records, {info}")
+
+    n,elapsed,mismatched = replay_server(path, realtime)
+    print(f"capture: replayed {n} records in {elapsed:.3f}s ({n / max(elapsed, 0.000001):.0f} records/s)")
+    if mismatched:
+        print(f"capture: clients {mismatched} got different packets than recorded")
+    else:
+        print("capture: replay matches the capture")
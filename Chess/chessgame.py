@@ -1,17 +1,25 @@
 import chess
-import chess.pgn
 import pygame
 import os
 import time
 import math
 import socket
 import struct
-import unidecode
 import json
 import webbrowser
 import random
-from datetime import datetime
-from networking import make_packet, Client, Server
+import collections
+import sys
+import errno
+from networking import make_packet, Client, Server, PendingConnection, CONNECT_TIMEOUT
+from chessserver import *
+from navigator import load_game
+from renderer import PIECES_FILENAME, BOARD_LIGHT, BOARD_DARK, LAST_MOVE_COLOR
+from profiler import FrameProfiler, ProfileCapture, HISTOGRAM_BUCKETS, FRAME_SECTION
+from capture import new_capture, CaptureClient
+from discovery import ServerBrowser, StatusResponder, make_status, parse_address, SERVER_ONLINE, SERVER_OFFLINE, SOURCE_PRESET, SOURCE_RECENT
+from log import get_logger, toggle_packet_trace
+from threats import ThreatWorker
 
 """                                       
                 *(##%&                  
@@ -41,6 +49,29 @@ from networking import make_packet, Client, Server
 GUI_BTN_PAD = 8
 GUI_BTN_OUTLINE_W = 3
 
+PREDICTION_TIMEOUT = 3  ## seconds until an unconfirmed own move gets rolled back
+
+REPLAY_CACHE_SIZE = 64          ## rendered replay positions kept
+REPLAY_THUMBNAIL_SIZE = 160
+REPLAY_NAME_LENGTH = 45
+
+PROFILE_CAPTURE_SECONDS = 5     ## length of a cProfile capture (F4)
+PROFILE_OVERLAY_REFRESH = 0.25  ## seconds between overlay text updates
+PROFILE_WAIT_SECTION = "wait"   ## clock.tick, not part of the tick time
+
+RECENT_SERVERS = 8              ## joined servers kept in the config for the server list
+
+## threat overlay (T), colors of attacked squares, hanging pieces, pieces
+## giving check and squares the side to move can check from
+THREAT_ATTACKED_COLOR = (255, 0, 0, 45)
+THREAT_HANGING_COLOR = (255, 128, 0)
+THREAT_CHECKER_COLOR = (160, 0, 0)
+THREAT_CHECK_COLOR = (0, 140, 0, 170)
+THREAT_BORDER_W = 4
+BROWSER_COLUMNS = [0, 250, 500, 600]    ## x of name, address, ping, players
+
+log = get_logger("Client")
+
 class GuiButton:
     def __init__(self, pos, content, normal_clr=(0, 196, 0), pressed_clr=(169, 128, 0), min_w=300):
         self.pos = pos
@@ -173,227 +204,109 @@ class EntryFocusManager:
                 self.focus_to_idx(i)
                 return
 
-STATUS_NOT_CONNECTED = -1 ## only for client
-STATUS_WAITING_FOR_PLAYERS = 0
-STATUS_PLAYING = 1
-STATUS_GAME_ENDED = 2
-STATUS_GAME_ENDED_PLAYER_LEFT = 3
-STATUS_SERVER_STOPPED = 4
-
 UTIL_STATUS_HUMAN_READABLE = ["Waiting for opponent!", "Game", "Game ended!", "Opponent left!", "Server shutting down!", "Connection lost!"]
 
-def write_utf8_string(string):
-    buf = string.encode("utf-8")
-
-    return struct.pack("I", len(buf)) + buf
-
-def read_utf8_string(buf):
-    l = struct.unpack("I", buf[0:4])[0]
-
-    return buf[4:4+l].decode("utf-8")
-    
-PACKET_STATUS = 2               ## int8 status
-PACKET_SET_NICK = 3             ## utf8_string nick
-PACKET_PLAYER_INFO = 4          ## int8 idx, utf8_string nick
-PACKET_SIDE = 5                 ## int8 side
-PACKET_BOARD = 6                ## int8 is_capture utf8_string board_epd
-PACKET_GIVE_UP = 7              ## give up
-PACKET_MOVE = 8                 ## int8 from, int8 to
-PACKET_GAME_OUTCOME = 9         ## int8 termination, int8 winner
-PACKET_CLIENT_MOVE_INFO = 10    ## int8 from, int8 to               info for client to see what was moved
-PACKET_CLIENT_TAKEN_INFO = 11   ## int8 piece                       info for client to see what was taken
-
-OUTCOME_RESIGNED = 11
-## this server should accept two clients
-## and then start the game
-class ChessServer:
-    ##
-    ## Server
-    ##
-    
-    def __init__(self, ip, port):
-        self._server = Server((ip, port))
-        
-        self.game_board = chess.Board()
-
-        ##
-        ##  debug
-        ##
-        debug = -1
-        debug_fen = ["r1bqkb1r/pppp1ppp/2n2n2/3Q4/2B1P3/8/PB3PPP/RN2K1NR w KQkq - 0 1",
-                     "k7/8/8/8/2R1r3/8/8/6K1 w - - 0 1",
-                     "2r5/4kppp/8/N1P5/7P/b7/5KP1/3R2N1 w - - 2 50"]
-        if debug > -1:
-            self.game_board = chess.Board(debug_fen[debug])
-
-        ##import stockfish
-        ##self.debug_stockfish = stockfish.Stockfish()
-
-        self.status = STATUS_WAITING_FOR_PLAYERS
-
-        self.game_pgn = chess.pgn.Game()
-        self.game_pgn.headers["Event"] = "ChessGame.py match"
-        self.game_pgn.setup(self.game_board)
-
-        self.node = self.game_pgn
-    
-    def broadcast(self, buf):
-        self._server.broadcast(buf)
-
-    def change_status(self, status):
-        self.status = status
-        self.broadcast_status()
-
-    def broadcast_status(self):
-        print("broadcasting status:", self.status)
-        self.broadcast(make_packet(PACKET_STATUS, bytes([self.status])))
-
-    def broadcast_board(self, is_capture=0):
-        data = self.game_board.epd()
-        self.broadcast(make_packet(PACKET_BOARD,bytes([is_capture])+write_utf8_string(data)))
-
-    def broadcast_client_info(self):
-        for idx,client in self._server.get_clients():
-            for idx2,update_client in self._server.get_clients():
-                update_client.send(make_packet(PACKET_PLAYER_INFO, bytes([idx]) + write_utf8_string(client.nick)))
-
-    def board_move(self, from_square, to_square):
-        captured_piece = None ## return what was captured to client
-
-        move = chess.Move(from_square, to_square)
-
-        ## if pawn, rank 0 or 7, promote to queen
-        print(chess.square_rank(to_square))
-        ##print(self.game_board.piece_at(from_square).piece_type == chess.PAWN)
-        if chess.square_rank(move.to_square) in [0, 7] and self.game_board.piece_at(move.from_square).piece_type == chess.PAWN:
-            move.promotion = chess.QUEEN
-
-        ## info for client
-        if self.game_board.is_en_passant(move):
-            captured_piece = chess.PAWN
-        elif self.game_board.is_capture(move):
-            captured_piece = self.game_board.piece_at(to_square).piece_type
-
-        ##self.stockfish.set_fen_position(self.game_board.fen())
-        
-        self.game_board.push(move)
-        self.broadcast_board(1 if not captured_piece is None else 0)
-        ## fix for capture sound on client
-
-        ## add to PGN
-        self.node = self.node.add_variation(move)
-
-        ## try to save
-        ##print(self.game)
-        white_nick = self._server.get_client(0).nick
-        black_nick = self._server.get_client(1).nick
-        
-        self.match_name = unidecode.unidecode("{0}_{1}_{2}.pgn".format(white_nick, black_nick, self.start_time.strftime("%Y-%m-%d_%H-%M-%S")))
-        
-        f = open(os.path.join(MATCH_DIR, self.match_name), "w")
-        f.write(str(self.game_pgn))
-        f.close()
-
-        outcome = self.game_board.outcome()
-        if not outcome is None:
-            ## the game has ended!
-            self.change_status(STATUS_GAME_ENDED)
-            self.broadcast(make_packet(PACKET_GAME_OUTCOME, bytes([outcome.termination.value, outcome.winner if not outcome.winner is None else 0])))
-
-        return captured_piece
-    
-    def update(self):
-        if self.status == STATUS_SERVER_STOPPED:
-            return
-
-        ## send status packet to new clients
-        if len(self._server.get_new_clients()) > 0:
-            self.broadcast_status()
-
-        if self.status == STATUS_PLAYING and self._server.get_num_clients() <= 1:
-            self.change_status(STATUS_GAME_ENDED_PLAYER_LEFT)
-
-        ## enough clients
-        if self.status == STATUS_WAITING_FOR_PLAYERS and self._server.get_num_clients() == 2:
-            self.change_status(STATUS_PLAYING)
-            self.broadcast_board()
-
-            self._server.get_client(0).send(make_packet(PACKET_SIDE, bytes([0])))
-            self._server.get_client(1).send(make_packet(PACKET_SIDE, bytes([1])))
-
-            self.start_time = datetime.now()
-            self.game_pgn.headers["Date"] = self.start_time
-
-        for cl_idx,packets in self._server.update().items():
-            cl = self._server.get_client(cl_idx)
-            for packet in packets:
-                pID, pDATA = packet
-
-                ## move only if game in progress
-                if pID == PACKET_MOVE and self.status == STATUS_PLAYING:
-                    from_square = pDATA[0]
-                    to_square = pDATA[1]
-
-                    ## each client can only move his own pieces
-                    if cl_idx == 0 and self.game_board.turn == chess.WHITE or cl_idx == 1 and self.game_board.turn == chess.BLACK:
-                        print(f"ChessServer: move {from_square} {to_square}")
-
-                        taken_piece = self.board_move(from_square, to_square)
+OUTCOME_NAMES = {chess.Termination.CHECKMATE: "Checkmate",
+                 chess.Termination.STALEMATE: "Stalemate",
+                 chess.Termination.INSUFFICIENT_MATERIAL: "Insufficient material",
+                 chess.Termination.FIVEFOLD_REPETITION: "Fivefold repetition",
+                 OUTCOME_RESIGNED: "Terminated",
+                 OUTCOME_TIMEOUT: "Time out"}
+
+CAPTURED_DRAW_ORDER = ["P", "R", "B", "N", "Q"]
+
+## everything ClientBoard draws that is derived from the board and the packets
+## refresh() rebuilds it when a packet changed something, drawing is only blits
+class BoardViewModel:
+    def __init__(self, tile_size, transform):
+        self.tile_size = tile_size
+        self.transform = transform
+
+        self.pieces = []                ## (surface, pos) of the pieces on the board
+        self.material = {}              ## symbol -> count on the board
+        self.captured = {chess.WHITE: [], chess.BLACK: []}
+        self.captured_icons = []        ## (surface, pos)
+        self.check_square = None
+        self.checkmate = False
+
+        self.texts = []                 ## (surface, pos)
+
+    def refresh(self, cb):
+        self.refresh_board(cb.board, cb.side)
+        self.refresh_texts(cb)
+
+    def refresh_board(self, board, side):
+        self.pieces = []
+        self.material = dict.fromkeys(BASE_PIECES_NUM, 0)
+        for square,piece in board.piece_map().items():
+            symbol = piece.symbol()
+            self.material[symbol] += 1
+
+            x,y = self.transform(chess.square_file(square), chess.square_rank(square))
+            self.pieces.append((PIECES_IMG[symbol], (x*self.tile_size, y*self.tile_size)))
+
+        ## missing from the starting set
+        self.captured_icons = []
+        for c in [chess.WHITE, chess.BLACK]:
+            self.captured[c] = []
 
-                        ## inform other player about the move 
-                        for cl2_idx,cl2 in self._server.get_clients():
-                            if cl2 != cl:
-                                ## the position
-                                cl2.send(make_packet(PACKET_CLIENT_MOVE_INFO, bytes([from_square, to_square])))
-                                ## taken piece
-                                if not taken_piece is None:
-                                    cl2.send(make_packet(PACKET_CLIENT_TAKEN_INFO, bytes([taken_piece])))
+            draw_x = board_w
+            draw_y = 390 if (side == 1) == (c != 0) else 0
+            for t in CAPTURED_DRAW_ORDER:
+                o = t.lower() if c == chess.BLACK else t.upper()
+                missing = max(0, BASE_PIECES_NUM[o] - self.material[o])
+                for n in range(missing):
+                    self.captured[c].append(o)
+                    self.captured_icons.append((ICON_PIECES[o], (draw_x, draw_y)))
+
+                    draw_pad = ICON_PIECE_SIZE
+                    ## stack pawns a bit (keep pad when changing type)
+                    if (t == "P") and n < missing-1:
+                        draw_pad /= 2.5
+                    else:
+                        draw_pad /= 1.25
+                    draw_x += draw_pad
 
-                if pID == PACKET_SET_NICK:
-                    nick = read_utf8_string(pDATA)
-                    print(f"ChessServer: client {cl_idx} set nick {nick}")
+        self.check_square = board.king(board.turn) if board.is_check() else None
+        self.checkmate = not self.check_square is None and board.is_checkmate()
 
-                    if cl_idx <= 1:
-                    
-                        self.game_pgn.headers[["White", "Black"][cl_idx]] = nick
+    def refresh_texts(self, cb):
+        self.texts = []
 
-                    cl.nick = nick
+        s = UTIL_STATUS_HUMAN_READABLE[cb.status]
+        if cb.is_spectator() and cb.status == STATUS_PLAYING:
+            s = "Spectating"
+        if cb.is_reconnecting():
+            s = "Reconnecting..."
+        self.texts.append((FONT_ACCENT.render(s, True, (0, 0, 0)), (board_w+20, 28)))
 
-                    ## send everybody client info
-                    self.broadcast_client_info()
+        if cb.status == STATUS_PLAYING:
+            player = cb.white_player if cb.board.turn else cb.black_player
+            self.texts.append((FONT.render(f"{player}'s turn!", True, (0, 0, 0)), (board_w+20, 68)))
 
-                ## gave up
-                if pID == PACKET_GIVE_UP and self.status == STATUS_PLAYING:
-                    if cl_idx <= 1:
-                        print(cl_idx, "gave up")
-                        self.change_status(STATUS_GAME_ENDED)
-                        self.broadcast(make_packet(PACKET_GAME_OUTCOME, bytes([OUTCOME_RESIGNED, 0 if cl_idx == 1 else 1])))
+        if not cb.enemy_taken_piece is None and not cb.is_spectator():
+            self.texts.append((FONT.render("Piece lost:", True, (0, 0, 0)), (board_w+20, 140)))
 
-    ## a very sad day today
-    def stop(self):
-        self.status = STATUS_SERVER_STOPPED
-        self._server.stop()
-        
-## connects to server
-class ChessClient:
-    def __init__(self, ip, port, nick="newbie"):
-        self._client = Client.new_connection((ip, port))
+            p = PIECES_IMG[chess.Piece(cb.enemy_taken_piece, cb.side != 1).symbol()]
+            takenx,takeny = center_horiz((w-board_w, h), p.get_size(), 180)
+            self.texts.append((p, (takenx+board_w, takeny)))
 
-        self.nick = nick
+        if not cb.outcome is None:
+            outcome = cb.outcome
+            player = cb.white_player if outcome.winner else cb.black_player
+            you = " (you)" if (outcome.winner == (cb.side == 0)) and not cb.is_spectator() else ""
 
-        self._client.send(make_packet(PACKET_SET_NICK, write_utf8_string(self.nick)))
-    
-    def update(self):
-        return self._client.update()
-
-    def disconnect(self):
-        self._client.disconnect()
-        
-    def send_move(self, from_square, to_square):
-        self._client.send(make_packet(PACKET_MOVE, bytes([from_square, to_square])))
+            t_name = OUTCOME_NAMES.get(outcome.termination, "Terminated")
+            t_winner = "Draw"
+            if outcome.termination == chess.Termination.CHECKMATE:
+                t_winner = f"{player} won!" + you
+            if outcome.termination == OUTCOME_RESIGNED:
+                t_winner = f"{player} resigned!" + you
+            if outcome.termination == OUTCOME_TIMEOUT:
+                t_winner = f"{player} lost on time!" + you
 
-    def give_up(self):
-        self._client.send(make_packet(PACKET_GIVE_UP, b""))
+            self.texts.append((FONT_ACCENT.render(t_name, True, (0, 0, 0)), (board_w+20, 300)))
+            self.texts.append((FONT.render(t_winner, True, (0, 0, 0)), (board_w+20, 340)))
 
 class ClientBoard:
     def __init__(self, initial_board, client, side=0):
@@ -401,8 +314,8 @@ class ClientBoard:
         self.side = side
         self.tile_size = 60
 
-        self.board_c1 = (255, 207, 159)
-        self.board_c2 = (210, 140, 69)
+        self.board_c1 = BOARD_LIGHT
+        self.board_c2 = BOARD_DARK
 
         self.black_player = "Black"
         self.white_player = "White"
@@ -447,6 +360,17 @@ class ClientBoard:
                         self.board_surf_black.blit(FONT_LABEL.render(f"{lbb}", True, text_clr), lb_pos)
 
         self.board_size = self.board_surface.get_size()
+
+        ## board with labels and the threat overlay, one blit per frame
+        ## whether the overlay is shown or not, rebuilt when either changes
+        self.background = None
+        self.background_state = None
+
+        self.threat_tiles = self.render_threat_tiles()
+        self.show_threats = bool(get_client_config().get("threat_overlay", False))
+        ## hash of the position shown, its Threats once THREAT_WORKER is done
+        self.threats_key = None
+        self.threats = None
         
         self.selection_square = None
         self.move_squares = []
@@ -458,16 +382,112 @@ class ClientBoard:
         self.enemy_taken_piece = None
         self.outcome = None
 
+        ## own moves are shown right away, the server confirms them later
+        ## confirmed_epd: last board from the server, predicted_epd: what we expect back
+        self.confirmed_epd = self.board.epd()
+        self.predicted_epd = None
+        self.predicted_time = 0
+
+        ## moves queued while it's the opponent's turn, as the server last confirmed them
+        self.premoves = []
+
+        ## derived drawing state, rebuilt when packets change something
+        self.view = BoardViewModel(self.tile_size, self.transform)
+        self.view_dirty = True
+        self.view_reconnecting = False
+
+        ## clocks as of clock_received, running: side whose clock runs, -1 none
+        self.clock_ms = None
+        self.clock_running = -1
+        self.clock_received = 0
+
+        ## digits are rendered once, clocks get drawn from them every frame
+        self.clock_digits = [FONT_SMALL_ACCENT.render(str(i), True, (0, 0, 0)) for i in range(10)]
+        self.clock_colon = FONT_SMALL_ACCENT.render(":", True, (0, 0, 0))
+        self.clock_digit_w = max([d.get_width() for d in self.clock_digits])
+        self.clock_w = self.clock_digit_w * 4 + self.clock_colon.get_width()
+        self.clock_h = self.clock_colon.get_height()
+
+    def rollback(self):
+        log.info("move not confirmed, rolling back")
+        self.predicted_epd = None
+        self.board.set_epd(self.confirmed_epd)
+        self.view_dirty = True
+
+    def is_reconnecting(self):
+        return not self.client is None and not self.client.dropped is None
+
+    def refresh_view(self):
+        self.view_reconnecting = self.is_reconnecting()
+        self.view.refresh(self)
+        self.view_dirty = False
+
+        ## worked out for every position, shown or not, so turning the
+        ## overlay on never waits
+        key = THREAT_WORKER.request(self.board)
+        if key != self.threats_key:
+            self.threats_key = key
+            self.threats = THREAT_WORKER.get(key)
+
+    ## overlay pieces, blitted onto the background
+    def render_threat_tiles(self):
+        size = self.tile_size
+        attacked = pygame.Surface((size, size), pygame.SRCALPHA)
+        attacked.fill(THREAT_ATTACKED_COLOR)
+
+        hanging = pygame.Surface((size, size), pygame.SRCALPHA)
+        pygame.draw.rect(hanging, THREAT_HANGING_COLOR, hanging.get_rect(), THREAT_BORDER_W)
+
+        checker = pygame.Surface((size, size), pygame.SRCALPHA)
+        pygame.draw.rect(checker, THREAT_CHECKER_COLOR, checker.get_rect(), THREAT_BORDER_W)
+
+        check = pygame.Surface((size, size), pygame.SRCALPHA)
+        pygame.draw.circle(check, THREAT_CHECK_COLOR, (size // 2, size // 2), size // 8)
+
+        return {"attacked": attacked, "hanging": hanging, "checker": checker, "check": check}
+
+    def refresh_background(self, state):
+        self.background_state = state
+        self.background = self.board_surface.copy()
+        self.background.blit(self.board_surf_black if self.side == 1 else self.board_surf_white, (0, 0))
+
+        threats = state[1]
+        if threats is None:
+            return
+
+        for mask,tile in [(threats.attacked, "attacked"), (threats.hanging, "hanging"), (threats.checkers, "checker"), (threats.checks, "check")]:
+            for square in chess.scan_forward(mask):
+                x,y = self.transform(chess.square_file(square), chess.square_rank(square))
+                self.background.blit(self.threat_tiles[tile], (x*self.tile_size, y*self.tile_size))
+
+    def toggle_threats(self):
+        self.show_threats = not self.show_threats
+
+        c = get_client_config()
+        c["threat_overlay"] = self.show_threats
+        save_config(c)
+
     def server_update(self, packets):
         if packets is None:
-            self.status = STATUS_NOT_CONNECTED
+            if self.status != STATUS_NOT_CONNECTED:
+                self.status = STATUS_NOT_CONNECTED
+                self.view_dirty = True
             return
+
+        ## move got lost or rejected
+        if not self.predicted_epd is None and time.time() - self.predicted_time > PREDICTION_TIMEOUT:
+            self.rollback()
             
         for packet in packets:
             pID, pDATA = packet
 
+            if not pID in [PACKET_PING, PACKET_CLOCK, PACKET_PREMOVE]:
+                self.view_dirty = True
+
             if pID == PACKET_STATUS:
                 self.status = pDATA[0]
+                if self.status != STATUS_PLAYING:
+                    self.premoves = []
 
             if pID == PACKET_SIDE:
                 self.side = pDATA[0]
@@ -476,7 +496,7 @@ class ClientBoard:
                 player_id = pDATA[0]
                 player_name = read_utf8_string(pDATA[1:])
 
-                print("Client: client info", player_id, player_name)
+                log.debug("client info %d %s", player_id, player_name)
 
                 if player_id == 0:
                     self.white_player = player_name
@@ -488,9 +508,17 @@ class ClientBoard:
                 ## if we had anything selected, cancel it
                 self.cancel_selection()
                 is_capture = pDATA[0]
+                epd = read_utf8_string(pDATA[1:])
+                self.confirmed_epd = epd
+
+                ## our own move, already on the board
+                if not self.predicted_epd is None and epd == self.predicted_epd:
+                    self.predicted_epd = None
+                    continue
+                self.predicted_epd = None
 
                 tmp = self.board.copy()
-                self.board.set_epd(read_utf8_string(pDATA[1:]))
+                self.board.set_epd(epd)
 
                 if tmp != self.board:
                     if is_capture != 0:
@@ -505,9 +533,17 @@ class ClientBoard:
             if pID == PACKET_CLIENT_TAKEN_INFO:
                 self.enemy_taken_piece = pDATA[0]
 
+            if pID == PACKET_CLOCK:
+                white,black,self.clock_running = struct.unpack(CLOCK_FORMAT, pDATA)
+                self.clock_ms = [white, black]
+                self.clock_received = time.time()
+
+            if pID == PACKET_PREMOVE:
+                self.premoves = [chess.Move(pDATA[i], pDATA[i+1]) for i in range(0, len(pDATA) - 1, 2)]
+
             if pID == PACKET_GAME_OUTCOME:
                 ## dirty hack for custom outcome
-                if pDATA[0] == OUTCOME_RESIGNED:
+                if pDATA[0] in [OUTCOME_RESIGNED, OUTCOME_TIMEOUT]:
                     self.outcome = chess.Outcome(pDATA[0], chess.Color(pDATA[1]))
                     
                 else:  
@@ -516,15 +552,51 @@ class ClientBoard:
                 sound_end.play()
 
     def client_move(self, from_square, to_square):
-        print("Client: move", from_square, to_square)
+        log.debug("move %d %d", from_square, to_square)
 
         ## reset enemy
         self.enemy_move = None
         self.enemy_taken_piece = None
+        self.view_dirty = True
+
+        ## predict it, same promotion rule as the server
+        move = chess.Move(from_square, to_square)
+        if chess.square_rank(to_square) in [0, 7] and self.board.piece_type_at(from_square) == chess.PAWN:
+            move.promotion = chess.QUEEN
+
+        if self.predicted_epd is None and move in self.board.legal_moves:
+            is_capture = self.board.is_capture(move)
+            self.board.push(move)
+
+            self.predicted_epd = self.board.epd()
+            self.predicted_time = time.time()
+
+            if is_capture:
+                sound_capture.play()
+            else:
+                sound_move.play()
 
         if not self.client is None:
             self.client.send_move(from_square, to_square)
 
+    ## mm:ss from the cached digits, no strings involved
+    def draw_clock(self, screen, side, pos):
+        ms = self.clock_ms[side]
+        if self.clock_running == side:
+            ms = max(0, ms - int((time.time() - self.clock_received) * 1000))
+            screen.fill((255, 255, 0), pygame.Rect(pos[0]-4, pos[1], self.clock_w+8, self.clock_h))
+
+        minutes,seconds = divmod(ms // 1000, 60)
+
+        x,y = pos
+        for digit in [minutes // 10 % 10, minutes % 10, -1, seconds // 10, seconds % 10]:
+            if digit < 0:
+                screen.blit(self.clock_colon, (x, y))
+                x += self.clock_colon.get_width()
+            else:
+                screen.blit(self.clock_digits[digit], (x, y))
+                x += self.clock_digit_w
+
     def highlight_square(self, screen, square, color=(255, 0, 0)):
         y = math.floor(square/8)
         x = square % 8
@@ -533,8 +605,40 @@ class ClientBoard:
 
         screen.fill(color, pygame.Rect((x)*self.tile_size, (y)*self.tile_size, self.tile_size, self.tile_size).inflate(-15, -15))
     
+    ## spectators see the board like white
+    def is_spectator(self):
+        return self.side == SIDE_SPECTATOR
+
+    def is_our_turn(self):
+        return self.board.turn == (self.side == 0)
+
+    ## where our pieces would be after the queued premoves, with us to move
+    def premove_board(self):
+        board = self.board.copy(stack=False)
+        for move in self.premoves:
+            board.turn = self.side == 0
+            if board.piece_at(move.from_square) is None:
+                break
+            board.push(move)
+        board.turn = self.side == 0
+
+        return board
+
+    def queue_premove(self, from_square, to_square):
+        log.debug("premove %d %d", from_square, to_square)
+
+        self.premoves.append(chess.Move(from_square, to_square))
+        if not self.client is None:
+            self.client.send_premoves([(m.from_square, m.to_square) for m in self.premoves])
+
+    def clear_premoves(self):
+        if len(self.premoves) > 0:
+            self.premoves = []
+            if not self.client is None:
+                self.client.send_premoves([])
+
     def transform(self, x, y):
-        if self.side == 0:
+        if self.side != 1:
             return x,7-y
         return 7-x,y
 
@@ -542,123 +646,69 @@ class ClientBoard:
         self.move_squares = []
         self.selection_square = None
 
-    def draw(self, screen, mouse_pos):       
-        screen.blit(self.board_surface, (0, 0))
+    def draw(self, screen, mouse_pos):
+        if self.view_dirty or self.is_reconnecting() != self.view_reconnecting:
+            self.refresh_view()
 
-        if self.side == 0:
-            screen.blit(self.board_surf_white, (0, 0))
-        else:
-            screen.blit(self.board_surf_black, (0, 0))
+        ## the worker finished the position
+        if self.threats is None and not self.threats_key is None:
+            self.threats = THREAT_WORKER.get(self.threats_key)
+
+        state = (self.side == 1, self.threats if self.show_threats else None)
+        if state != self.background_state:
+            self.refresh_background(state)
+        screen.blit(self.background, (0, 0))
 
         ## highlights
         if not self.enemy_move is None:
             self.highlight_square(screen, self.enemy_move.from_square, (255, 160, 120))
             self.highlight_square(screen, self.enemy_move.to_square, (255, 160, 120) if self.enemy_taken_piece is None else (128, 128, 128))
 
+        for move in self.premoves:
+            self.highlight_square(screen, move.from_square, (120, 160, 255))
+            self.highlight_square(screen, move.to_square, (120, 160, 255))
+
         if self.selection_square != None:
             self.highlight_square(screen, self.selection_square, (255, 255, 0))
 
         for dest in self.move_squares:
             self.highlight_square(screen, dest, (0, 255, 0))
 
-        ## count missing pieces
-        bp = {"R": -2, "N": -2, "B": -2, "Q": -1, "K": -1, "P": -8, "r": -2, "n": -2, "b": -2, "q": -1, "k": -1, "p": -8}
-        for y in range(0, 8):
-            for x in range(0, 8):
-                square = chess.square(x, y)
-
-                ## fig
-            
-                fig = self.board.piece_at(square)
-
-                x,y = self.transform(x, y)
-                
-                if fig:
-                    screen.blit(PIECES_IMG[fig.symbol()], (x*self.tile_size, y*self.tile_size))
-                    bp[fig.symbol()] += 1
-                    
-        ## gui info
-        s = UTIL_STATUS_HUMAN_READABLE[self.status]
-        status_text = FONT_ACCENT.render(f"{s}", True, (0, 0, 0))
-
-        player = self.white_player if self.board.turn else self.black_player
-        playing_text = FONT.render(f"{player}'s turn!", True, (0, 0, 0))
-
-        screen.blit(status_text, (board_w+20, 28))
-
-        if self.status == STATUS_PLAYING:
-            screen.blit(playing_text, (board_w+20, 68))
+        if not self.view.check_square is None:
+            self.highlight_square(screen, self.view.check_square, (128, 0, 0) if self.view.checkmate else (255, 0, 0))
 
-        ## taken pieces
-        taken_draw_order = ["P", "R", "B", "N", "Q"]
-        taken = {}
-        for k in bp:
-            if bp[k] < 0:
-                missing = bp[k] * -1
-                ## type and how much is missing
-                taken[k] = missing
+        for surf,pos in self.view.pieces:
+            screen.blit(surf, pos)
 
-        for c in [chess.WHITE, chess.BLACK]:
-            draw_x = board_w
-            draw_y = 390 if self.side == (c != 0) else 0
-            for t in taken_draw_order:
-                o = t.lower() if c == chess.BLACK else t.upper()
-                if o in taken:
-                    for n in range(taken[o]):
-                        screen.blit(ICON_PIECES[o], (draw_x, draw_y))
-
-                        draw_pad = ICON_PIECE_SIZE
-                        ## stack pawns a bit (keep pad when changing type)
-                        if (t == "P") and n < taken[o]-1:
-                            draw_pad /= 2.5
-                        else:
-                            draw_pad /= 1.25
-                        draw_x += draw_pad
-                           
-        if not self.enemy_taken_piece is None:
-            taken_text = FONT.render(f"Piece lost:", True, (0, 0, 0))
-            screen.blit(taken_text, (board_w+20, 140))
-
-            p = PIECES_IMG[chess.Piece(self.enemy_taken_piece, self.side != 1).symbol()]
-            takenx,takeny = center_horiz((w-board_w, h), p.get_size(), 180)
-
-            screen.blit(p, (takenx+board_w, takeny))
+        for surf,pos in self.view.texts:
+            screen.blit(surf, pos)
 
-        if not self.outcome is None:
-            player = self.white_player if self.outcome.winner else self.black_player
+        ## white left, black right
+        if not self.clock_ms is None:
+            self.draw_clock(screen, 0, (board_w+20, 100))
+            self.draw_clock(screen, 1, (w-20-self.clock_w, 100))
 
-            t_name = "Terminated"
-            t_winner = "Draw"
+        for surf,pos in self.view.captured_icons:
+            screen.blit(surf, pos)
 
-            if self.outcome.termination == chess.Termination.CHECKMATE:
-                t_name = "Checkmate"
-                t_winner = f"{player} won!" + (" (you)" if (self.outcome.winner == (self.side == 0)) else "")
-            if self.outcome.termination == chess.Termination.STALEMATE:
-                t_name = "Stalemate"
-            if self.outcome.termination == chess.Termination.INSUFFICIENT_MATERIAL:
-                t_name = "Insufficient material"
-            if self.outcome.termination == chess.Termination.FIVEFOLD_REPETITION:
-                t_name = "Fivefold repetition"
-            if self.outcome.termination == OUTCOME_RESIGNED:
-                t_winner = f"{player} resigned!" + (" (you)" if (self.outcome.winner == (self.side == 0)) else "")
-
-            outcome_text = FONT_ACCENT.render(t_name, True, (0, 0, 0))
-            outcome_text_winner = FONT.render(t_winner, True, (0, 0, 0))
-
-            screen.blit(outcome_text, (board_w+20, 300))
-            screen.blit(outcome_text_winner, (board_w+20, 340))
-
-        if self.status in self.btn_leave_show_when:
+        if self.show_leave():
             self.btn_leave.draw(screen)
 
-        if self.status in self.btn_give_up_show_when and mouse_pos[0] >= board_w and mouse_pos[1] >= h-75:
+        if self.show_give_up(mouse_pos):
             self.btn_give_up.draw(screen)
 
+    ## spectators can always leave and never resign
+    def show_leave(self):
+        return self.status in self.btn_leave_show_when or self.is_spectator()
+
+    def show_give_up(self, mouse_pos):
+        return self.status in self.btn_give_up_show_when and not self.is_spectator() and mouse_pos[0] >= board_w and mouse_pos[1] >= h-75
+
     def update(self, events, mouse_pos):
-        if self.status in self.btn_leave_show_when:
+        if self.show_leave():
             self.btn_leave.update(events, mouse_pos)
 
-        if self.status in self.btn_give_up_show_when and mouse_pos[0] >= board_w and mouse_pos[1] >= h-75:
+        if self.show_give_up(mouse_pos):
             self.btn_give_up.update(events, mouse_pos)
 
         if self.btn_give_up.pressed:
@@ -669,15 +719,19 @@ class ClientBoard:
             return False
         
         for e in events:
-            ## right click: cancel selection
+            if e.type == pygame.KEYDOWN and e.key == pygame.K_t:
+                self.toggle_threats()
+
+            ## right click: cancel selection and premoves
             if e.type == pygame.MOUSEBUTTONDOWN and e.button == pygame.BUTTON_RIGHT:
                 self.cancel_selection()
+                self.clear_premoves()
                 
             if e.type == pygame.MOUSEBUTTONDOWN and e.button == pygame.BUTTON_LEFT:
                 x,y = e.pos
 
-                ## game not running or not clicked in board
-                if self.status != STATUS_PLAYING or x > board_w or y > board_w:
+                ## game not running, spectating or not clicked in board
+                if self.status != STATUS_PLAYING or self.is_spectator() or x > board_w or y > board_w:
                     ## just cancel selection
                     self.cancel_selection()
                     continue
@@ -689,10 +743,17 @@ class ClientBoard:
 
                 square = chess.square(tx, ty)
 
+                ## opponent's turn: pieces move as premoves, on the board after the queued ones
+                our_turn = self.is_our_turn()
+                board = self.board if our_turn else self.premove_board()
+
                 ## chose a move
                 if len(self.move_squares) != 0:
                     if square in self.move_squares:
-                        self.client_move(self.selection_square, square)
+                        if our_turn:
+                            self.client_move(self.selection_square, square)
+                        elif len(self.premoves) < MAX_PREMOVES:
+                            self.queue_premove(self.selection_square, square)
 
                         ## unselect
                         self.move_squares = []
@@ -700,15 +761,15 @@ class ClientBoard:
                         return
                         
                 ## chose a piece
-                if self.board.piece_at(square) != None:
+                if board.piece_at(square) != None:
                     self.move_squares = []
 
                     ## deny selection if it isn't your piece
-                    if not self.board.color_at(square) == self.side:
+                    if not board.color_at(square) == self.side:
 
-                        ## find valid moves
+                        ## find valid moves, premoves only get checked by the server
                         self.selection_square = square
-                        for m in self.board.legal_moves:
+                        for m in (board.legal_moves if our_turn else board.pseudo_legal_moves):
                             if m.from_square == square:
                                 self.move_squares.append(m.to_square)
 
@@ -721,6 +782,404 @@ class ClientBoard:
                     
                     self.selection_square = None
 
+## archived games in MATCH_DIR, newest first
+class ReplayList:
+    def __init__(self):
+        self.files = []
+        if os.path.exists(MATCH_DIR):
+            self.files = [f for f in os.listdir(MATCH_DIR) if f.endswith(".pgn")]
+            self.files.sort(key=lambda f: os.path.getmtime(os.path.join(MATCH_DIR, f)), reverse=True)
+
+        ## names are rendered once
+        self.rows = [FONT_SMALL_ACCENT.render(f[:-4][:REPLAY_NAME_LENGTH], True, (0, 0, 0)) for f in self.files]
+        self.row_h = FONT_SMALL_ACCENT.get_height() + 6
+        self.top = below_title()
+        self.visible = (h - self.top - GUI_PAD) // self.row_h
+        self.scroll = 0
+
+        self.empty_text = FONT_ACCENT.render("No matches yet.", True, (0, 0, 0))
+
+    def get_row_rect(self, i):
+        return pygame.Rect(GUI_PAD, self.top + (i - self.scroll) * self.row_h, w - GUI_PAD * 2, self.row_h)
+
+    ## returns the path of the chosen game
+    def update(self, events, mouse_pos):
+        for e in events:
+            if e.type == pygame.MOUSEWHEEL:
+                self.scroll = max(0, min(self.scroll - e.y, len(self.rows) - self.visible))
+
+            if e.type == pygame.MOUSEBUTTONDOWN and e.button == pygame.BUTTON_LEFT:
+                for i in range(self.scroll, min(len(self.rows), self.scroll + self.visible)):
+                    if self.get_row_rect(i).collidepoint(e.pos):
+                        return os.path.join(MATCH_DIR, self.files[i])
+
+        return None
+
+    def draw(self, screen, mouse_pos):
+        if len(self.rows) == 0:
+            screen.blit(self.empty_text, center_horiz((w, h), self.empty_text.get_size(), self.top))
+
+        for i in range(self.scroll, min(len(self.rows), self.scroll + self.visible)):
+            rect = self.get_row_rect(i)
+            if rect.collidepoint(mouse_pos):
+                screen.fill((255, 207, 159), rect)
+            screen.blit(self.rows[i], (rect.x + 5, rect.y + 3))
+
+## servers of a ServerBrowser, a row per server and one per room waiting for players
+## rows are only rendered again when the browser has news
+class BrowserList:
+    def __init__(self, browser):
+        self.browser = browser
+        self.version = -1
+
+        ## ([(surface, x)], address to join)
+        self.rows = []
+        self.row_h = FONT_SMALL_ACCENT.get_height() + 6
+        self.top = below_title()
+        self.visible = (h - self.top - GUI_PAD) // self.row_h
+        self.scroll = 0
+
+        self.empty_text = FONT_ACCENT.render("Looking for servers...", True, (0, 0, 0))
+
+    def render_row(self, columns):
+        return [(FONT_SMALL_ACCENT.render(text, True, (0, 0, 0)), BROWSER_COLUMNS[i]) for i,text in enumerate(columns) if text]
+
+    def refresh(self):
+        if self.version == self.browser.version:
+            return
+        self.version = self.browser.version
+
+        self.rows = []
+        for entry in self.browser.get_servers():
+            if entry.state == SERVER_OFFLINE:
+                ping = "offline"
+            elif entry.rtt is None:
+                ping = "..."
+            else:
+                ping = f"{entry.rtt * 1000:.0f}ms"
+
+            players = ""
+            if entry.state == SERVER_ONLINE and not entry.players is None:
+                players = f"{entry.players} players"
+                if "" in entry.open_rooms:
+                    players += ", open"
+
+            name = (entry.name or entry.host)[:18]
+            self.rows.append((self.render_row([name, entry.get_address(), ping, players]), entry.get_address()))
+
+            for room in entry.open_rooms:
+                if room:
+                    self.rows.append((self.render_row([f"  room {room}"[:18], "", "", "waiting"]), entry.get_address(room)))
+
+        self.scroll = max(0, min(self.scroll, len(self.rows) - self.visible))
+
+    def get_row_rect(self, i):
+        return pygame.Rect(GUI_PAD, self.top + (i - self.scroll) * self.row_h, w - GUI_PAD * 2, self.row_h)
+
+    ## returns the address of the chosen server or room
+    def update(self, events, mouse_pos):
+        self.browser.update()
+        self.refresh()
+
+        for e in events:
+            if e.type == pygame.MOUSEWHEEL:
+                self.scroll = max(0, min(self.scroll - e.y, len(self.rows) - self.visible))
+
+            if e.type == pygame.MOUSEBUTTONDOWN and e.button == pygame.BUTTON_LEFT:
+                for i in range(self.scroll, min(len(self.rows), self.scroll + self.visible)):
+                    if self.get_row_rect(i).collidepoint(e.pos):
+                        return self.rows[i][1]
+
+        return None
+
+    def draw(self, screen, mouse_pos):
+        if len(self.rows) == 0:
+            screen.blit(self.empty_text, center_horiz((w, h), self.empty_text.get_size(), self.top))
+
+        for i in range(self.scroll, min(len(self.rows), self.scroll + self.visible)):
+            rect = self.get_row_rect(i)
+            if rect.collidepoint(mouse_pos):
+                screen.fill((255, 207, 159), rect)
+            for surf,x in self.rows[i][0]:
+                screen.blit(surf, (rect.x + 5 + x, rect.y + 3))
+
+## replay of an archived game with a move list, any ply can be jumped to
+## positions come from a PlyNavigator, rendered ones are kept in a LRU cache
+## so scrubbing back and forth only blits
+class ReplayViewer:
+    def __init__(self, path, board_surface, board_labels):
+        self.game,self.navigator = load_game(path)
+        self.board_surface = board_surface
+        self.board_labels = board_labels
+        self.tile_size = T_SIZE
+
+        ## (ply, size) -> Surface, least recently used first
+        self.positions = collections.OrderedDict()
+
+        self.btn_back = GuiButton((board_w + GUI_PAD, GUI_BTN_PAD), FONT_ACCENT.render("Back", True, (0, 0, 0)), min_w=120)
+
+        white = self.game.headers.get("White", "?")
+        black = self.game.headers.get("Black", "?")
+        self.players_text = FONT_SMALL_ACCENT.render(f"{white} - {black}"[:REPLAY_NAME_LENGTH], True, (0, 0, 0))
+        self.result_text = FONT_SMALL_ACCENT.render(self.game.headers.get("Result", "*"), True, (0, 0, 0))
+
+        ## move list, every row rendered once when first shown
+        self.rows = self.navigator.get_rows()
+        self.row_surfaces = {}
+        self.row_h = FONT_SMALL_ACCENT.get_height()
+        self.list_top = 110
+        self.visible = (h - 60 - self.list_top) // self.row_h
+        self.scroll = 0
+        self.columns = [board_w + GUI_PAD, board_w + GUI_PAD + 60, board_w + GUI_PAD + 170]
+
+        ## scrub bar, hovering it shows a thumbnail of that ply
+        self.bar = pygame.Rect(board_w + GUI_PAD, h - 40, w - board_w - GUI_PAD * 2, 16)
+        self.scrubbing = False
+        self.hover_ply = None
+
+    def get_ply(self):
+        return self.navigator.ply
+
+    def seek(self, ply):
+        self.navigator.seek(ply)
+
+        ## keep the current move in view
+        row = self.get_row(self.navigator.ply)
+        if row < self.scroll:
+            self.scroll = row
+        if row >= self.scroll + self.visible:
+            self.scroll = row - self.visible + 1
+
+    ## move list row of a ply
+    def get_row(self, ply):
+        if self.navigator.start_turn == chess.BLACK:
+            return ply // 2
+        return max(0, ply - 1) // 2
+
+    ## board at ply drawn at size, cached
+    def get_position(self, ply, size=None):
+        size = board_w if size is None else size
+        key = (ply, size)
+
+        surf = self.positions.get(key)
+        if not surf is None:
+            self.positions.move_to_end(key)
+            return surf
+
+        if size != board_w:
+            surf = pygame.transform.smoothscale(self.get_position(ply), (size, size))
+        else:
+            surf = self.render_position(ply)
+
+        self.positions[key] = surf
+        if len(self.positions) > REPLAY_CACHE_SIZE:
+            self.positions.popitem(last=False)
+
+        return surf
+
+    def render_position(self, ply):
+        surf = self.board_surface.copy()
+        surf.blit(self.board_labels, (0, 0))
+
+        move = self.navigator.get_move(ply)
+        if not move is None:
+            for square in [move.from_square, move.to_square]:
+                x,y = chess.square_file(square), 7 - chess.square_rank(square)
+                surf.fill(LAST_MOVE_COLOR, pygame.Rect(x*self.tile_size, y*self.tile_size, self.tile_size, self.tile_size).inflate(-15, -15))
+
+        board = self.navigator.board_at(ply) if ply != self.navigator.ply else self.navigator.board
+        for square,piece in board.piece_map().items():
+            x,y = chess.square_file(square), 7 - chess.square_rank(square)
+            surf.blit(PIECES_IMG[piece.symbol()], (x*self.tile_size, y*self.tile_size))
+
+        return surf
+
+    def get_row_surfaces(self, i):
+        surfaces = self.row_surfaces.get(i)
+        if surfaces is None:
+            number,white_ply,black_ply = self.rows[i]
+            surfaces = [FONT_SMALL_ACCENT.render(f"{number}.", True, (0, 0, 0))]
+            ## "..." for white when the game starts with black to move
+            surfaces.append(FONT_SMALL_ACCENT.render("..." if white_ply is None else self.navigator.san[white_ply - 1], True, (0, 0, 0)))
+            surfaces.append(FONT_SMALL_ACCENT.render("" if black_ply is None else self.navigator.san[black_ply - 1], True, (0, 0, 0)))
+
+            self.row_surfaces[i] = surfaces
+
+        return surfaces
+
+    def bar_ply(self, x):
+        frac = (x - self.bar.x) / self.bar.w
+        return max(0, min(len(self.navigator), round(frac * len(self.navigator))))
+
+    ## returns False when leaving
+    def update(self, events, mouse_pos):
+        self.btn_back.update(events, mouse_pos)
+        if self.btn_back.pressed:
+            return False
+
+        ply = self.get_ply()
+        for e in events:
+            if e.type == pygame.KEYDOWN:
+                if e.key == pygame.K_RIGHT:
+                    ply += 1
+                if e.key == pygame.K_LEFT:
+                    ply -= 1
+                if e.key in [pygame.K_DOWN, pygame.K_PAGEDOWN]:
+                    ply += self.navigator.interval
+                if e.key in [pygame.K_UP, pygame.K_PAGEUP]:
+                    ply -= self.navigator.interval
+                if e.key == pygame.K_HOME:
+                    ply = 0
+                if e.key == pygame.K_END:
+                    ply = len(self.navigator)
+
+            if e.type == pygame.MOUSEWHEEL:
+                ply -= e.y
+
+            if e.type == pygame.MOUSEBUTTONDOWN and e.button == pygame.BUTTON_LEFT:
+                if self.bar.inflate(0, 10).collidepoint(e.pos):
+                    self.scrubbing = True
+
+                ## clicked a move
+                for i in range(self.scroll, min(len(self.rows), self.scroll + self.visible)):
+                    y = self.list_top + (i - self.scroll) * self.row_h
+                    if y <= e.pos[1] < y + self.row_h:
+                        for c,row_ply in zip(self.columns[1:], self.rows[i][1:]):
+                            if not row_ply is None and c <= e.pos[0] < c + 110:
+                                ply = row_ply
+
+            if e.type == pygame.MOUSEBUTTONUP and e.button == pygame.BUTTON_LEFT:
+                self.scrubbing = False
+
+        if self.scrubbing:
+            ply = self.bar_ply(mouse_pos[0])
+
+        self.hover_ply = self.bar_ply(mouse_pos[0]) if self.bar.inflate(0, 10).collidepoint(mouse_pos) and not self.scrubbing else None
+
+        self.seek(ply)
+
+    def draw(self, screen, mouse_pos):
+        ply = self.get_ply()
+        screen.blit(self.get_position(ply), (0, 0))
+
+        self.btn_back.draw(screen)
+        screen.blit(self.players_text, (board_w + GUI_PAD, 62))
+        screen.blit(self.result_text, (w - GUI_PAD - self.result_text.get_width(), 62))
+
+        for i in range(self.scroll, min(len(self.rows), self.scroll + self.visible)):
+            y = self.list_top + (i - self.scroll) * self.row_h
+            surfaces = self.get_row_surfaces(i)
+
+            for c,row_ply,surf in zip(self.columns, (None,) + self.rows[i][1:], surfaces):
+                if not row_ply is None and row_ply == ply:
+                    screen.fill((255, 255, 0), pygame.Rect(c - 4, y, surf.get_width() + 8, self.row_h))
+                screen.blit(surf, (c, y))
+
+        ## scrub bar
+        screen.fill((210, 140, 69), self.bar)
+        if len(self.navigator) > 0:
+            x = self.bar.x + self.bar.w * ply / len(self.navigator)
+            screen.fill((0, 0, 0), pygame.Rect(x - 3, self.bar.y - 4, 6, self.bar.h + 8))
+
+        if not self.hover_ply is None:
+            thumb = self.get_position(self.hover_ply, REPLAY_THUMBNAIL_SIZE)
+            x = max(0, min(w - REPLAY_THUMBNAIL_SIZE, mouse_pos[0] - REPLAY_THUMBNAIL_SIZE // 2))
+            screen.fill((0, 0, 0), pygame.Rect(x, self.bar.y - REPLAY_THUMBNAIL_SIZE - 10, REPLAY_THUMBNAIL_SIZE, REPLAY_THUMBNAIL_SIZE).inflate(4, 4))
+            screen.blit(thumb, (x, self.bar.y - REPLAY_THUMBNAIL_SIZE - 10))
+
+## frame stats over the board (F3), F4 records a cProfile capture,
+## F5 switches the packet trace in the log
+## the text only gets re-rendered every PROFILE_OVERLAY_REFRESH
+class ProfilerOverlay:
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.capture = ProfileCapture()
+        self.shown = False
+
+        self.font = pygame.font.Font(os.path.join(ASSETS_DIR, "OpenSans-Regular.ttf"), 14)
+        self.line_h = self.font.get_linesize()
+        self.lines = []
+        self.histogram = []
+        self.last_refresh = 0
+
+        self.message = None
+
+    def update(self, events):
+        for e in events:
+            if e.type == pygame.KEYDOWN and e.key == pygame.K_F3:
+                self.shown = not self.shown
+                self.last_refresh = 0
+
+            if e.type == pygame.KEYDOWN and e.key == pygame.K_F4 and not self.capture.is_running():
+                self.capture.start(PROFILE_CAPTURE_SECONDS)
+                self.message = f"Profiling for {PROFILE_CAPTURE_SECONDS}s..."
+                self.last_refresh = 0
+
+            if e.type == pygame.KEYDOWN and e.key == pygame.K_F5:
+                toggle_packet_trace()
+
+        path = self.capture.update()
+        if not path is None:
+            log.info("profiler capture written to %s", path)
+            self.message = f"Saved {path}"
+            self.last_refresh = 0
+
+    def refresh(self, rtt):
+        stats = self.profiler.get_stats()
+        lines = []
+
+        if FRAME_SECTION in stats:
+            avg,p95,top = stats[FRAME_SECTION]
+            wait = stats.get(PROFILE_WAIT_SECTION, (0, 0, 0))[0]
+            lines.append(f"frame {avg:.1f}ms ({1000 / max(avg, 0.001):.0f} fps)  p95 {p95:.1f}  max {top:.1f}")
+            lines.append(f"tick {avg - wait:.2f}ms")
+
+        for section,(avg, p95, top) in stats.items():
+            if not section in [FRAME_SECTION, PROFILE_WAIT_SECTION]:
+                lines.append(f"  {section} {avg:.2f}ms  p95 {p95:.2f}  max {top:.2f}")
+
+        for counter,value in self.profiler.get_counters().items():
+            lines.append(f"{counter}/frame {value:.2f}")
+
+        lines.append("rtt -" if rtt is None else f"rtt {rtt * 1000:.1f}ms")
+
+        if not self.message is None:
+            lines.append(self.message)
+
+        self.lines = [self.font.render(line, True, (255, 255, 255)) for line in lines]
+        self.histogram = self.profiler.get_histogram()
+
+    def draw(self, screen, rtt):
+        if not self.shown:
+            return
+
+        now = time.time()
+        if now - self.last_refresh > PROFILE_OVERLAY_REFRESH:
+            self.last_refresh = now
+            self.refresh(rtt)
+
+        bar_w = 24
+        hist_h = 40
+        width = max([surf.get_width() for surf in self.lines] + [bar_w * len(self.histogram)]) + 10
+        height = len(self.lines) * self.line_h + hist_h + 25
+
+        panel = pygame.Surface((width, height), pygame.SRCALPHA)
+        panel.fill((0, 0, 0, 180))
+        for i,surf in enumerate(self.lines):
+            panel.blit(surf, (5, 5 + i * self.line_h))
+
+        ## frame time histogram, upper bounds in ms below the bars
+        y = 5 + len(self.lines) * self.line_h + hist_h
+        most = max(self.histogram + [1])
+        for i,n in enumerate(self.histogram):
+            bar_h = int(hist_h * n / most)
+            panel.fill((0, 196, 0) if i < 4 else (196, 0, 0), pygame.Rect(5 + i * bar_w, y - bar_h, bar_w - 2, bar_h))
+
+            label = f"{HISTOGRAM_BUCKETS[i]}" if i < len(HISTOGRAM_BUCKETS) else "+"
+            panel.blit(self.font.render(label, True, (255, 255, 255)), (5 + i * bar_w, y))
+
+        screen.blit(panel, (0, 0))
+
 def transform(pos, pos2):
     return (pos[0]+pos2[0], pos[1]+pos2[1])
                 
@@ -730,31 +1189,121 @@ def center(container_size, size):
 def center_horiz(container_size, size, h):
     return (center(container_size, size)[0], h)
 
+## closes the session captures of the current game, see --record
+def close_captures():
+    if not GAME_SERVER is None and not GAME_SERVER._server.recorder is None:
+        GAME_SERVER._server.recorder.close()
+    if not GAME_CLIENT is None and not GAME_CLIENT.recorder is None:
+        GAME_CLIENT.recorder.close()
+
+## gives up a Join/Create still connecting, and the server it hosts
+def cancel_connecting():
+    global PENDING_CONNECTION, GAME_SERVER
+
+    PENDING_CONNECTION.close()
+    PENDING_CONNECTION = None
+
+    close_captures()
+    recorder = pending_args[4]
+    if not recorder is None:
+        recorder.close()
+
+    stop_hosting()
+
+## the hosted server and its status responder
+def stop_hosting():
+    global GAME_SERVER, GAME_RESPONDER
+
+    if not GAME_RESPONDER is None:
+        GAME_RESPONDER.stop()
+        GAME_RESPONDER = None
+
+    if not GAME_SERVER is None:
+        GAME_SERVER.stop()
+        GAME_SERVER = None
+
 def below_title():
     return GUI_PAD * 2 + FONT_TITLE.get_height()
 
 CONFIG_FILE = "config.json"
 
+## the config is read once and kept, changes are written through save_config
+CONFIG = None
+
 def get_json_content(file):
     if os.path.exists(file):
-        return json.loads(open(file, encoding="utf-8").read())
-    else:
-        return None
+        try:
+            return json.loads(open(file, encoding="utf-8").read())
+        except ValueError:
+            log.warning("%s is not valid JSON, ignoring it", file)
+    return None
 
+## written next to the config and renamed over it, a crash never leaves half a file
 def save_config(data):
-    d = json.dumps(data)
-
-    f = open(CONFIG_FILE, "w")
-    f.write(d)
+    global CONFIG
+    CONFIG = data
+
+    tmp = CONFIG_FILE + ".tmp"
+    f = open(tmp, "w", encoding="utf-8")
+    f.write(json.dumps(data))
+    f.flush()
+    os.fsync(f.fileno())
     f.close()
+    os.replace(tmp, CONFIG_FILE)
 
 def get_client_config():
-    config = get_json_content(CONFIG_FILE)
+    global CONFIG
+    if CONFIG is None:
+        CONFIG = get_json_content(CONFIG_FILE) or {}
+
+    return CONFIG
+
+## "minutes+increment" in the config, None for no clocks
+def get_time_control():
+    c = get_client_config()
+
+    if "time_control" in c:
+        try:
+            return parse_time_control(str(c["time_control"]))
+        except ValueError:
+            log.warning("invalid time control %s", c["time_control"])
 
-    if not config:
-        save_config({})
+    return None
+
+## seconds until connecting gives up, "connect_timeout" in the config
+def get_connect_timeout():
+    c = get_client_config()
 
-    return get_json_content(CONFIG_FILE)
+    try:
+        return float(c.get("connect_timeout", CONNECT_TIMEOUT))
+    except (TypeError, ValueError):
+        log.warning("invalid connect timeout %s", c["connect_timeout"])
+
+    return CONNECT_TIMEOUT
+
+## errno names of socket errors and their message
+## the WSA names are the windows codes, missing names are skipped
+SOCKET_ERRORS = [(["ECONNREFUSED", "WSAECONNREFUSED"], "Error: Connection refused!"),
+                 (["ETIMEDOUT", "WSAETIMEDOUT"], "Error: Timed out."),
+                 (["EADDRINUSE", "WSAEADDRINUSE"], "Error: Address already in use."),
+                 (["EADDRNOTAVAIL", "WSAEADDRNOTAVAIL"], "Error: Cannot bind/connect to this address."),
+                 (["ENETUNREACH", "WSAENETUNREACH"], "Error: Network unreachable."),
+                 (["EHOSTUNREACH", "WSAEHOSTUNREACH"], "Error: Host unreachable."),
+                 (["ECONNRESET", "WSAECONNRESET"], "Error: Connection reset.")]
+SOCKET_ERROR_STRINGS = {getattr(errno, name): err_string for names,err_string in SOCKET_ERRORS for name in names if hasattr(errno, name)}
+## windows host lookup errors (WSAHOST_NOT_FOUND, WSANO_DATA) aren't in errno
+SOCKET_ERROR_STRINGS[11001] = SOCKET_ERROR_STRINGS[11004] = "Error: Invalid address!"
+
+def get_error_string(e):
+    ## gaierror has its own codes, they'd clash with errno
+    if isinstance(e, socket.gaierror):
+        return "Error: Invalid address!"
+    if e.errno in SOCKET_ERROR_STRINGS:
+        return SOCKET_ERROR_STRINGS[e.errno]
+    if isinstance(e, socket.timeout):
+        return "Error: Timed out."
+
+    return "Invalid error :("
 
 def client_preset_load(idx):
     idx = str(idx)
@@ -777,10 +1326,40 @@ def client_preset_save(idx, ip, username):
     c = get_client_config()
     if not "presets" in c:
         c["presets"] = {}
-    print(c["presets"])
     c["presets"][idx] = preset
     save_config(c)
 
+## joined servers, newest first, for the server list
+def remember_server(ip, port):
+    address = f"{ip}:{port}"
+
+    c = get_client_config()
+    servers = [s for s in c.get("servers", []) if s != address]
+    c["servers"] = ([address] + servers)[:RECENT_SERVERS]
+    save_config(c)
+
+## (host, port, source) of presets and recently joined servers
+def get_known_servers():
+    c = get_client_config()
+
+    addresses = [(preset.get("ip", ""), SOURCE_PRESET) for preset in c.get("presets", {}).values()]
+    addresses += [(address, SOURCE_RECENT) for address in c.get("servers", [])]
+
+    known = []
+    for address,source in addresses:
+        try:
+            host,port,room = parse_address(address)
+        except ValueError:
+            continue
+        if host:
+            known.append((host, port, source))
+
+    return known
+
+## what a hosted game tells the server list
+def hosting_status(server, name, port):
+    return make_status(name, port, server._server.get_num_clients(), 1, [""] if server.is_open() else [], server.clock)
+
 pygame.mixer.init(44100, -16, 1, 1024)
 pygame.init()
 pygame.key.set_repeat(500, 25)
@@ -789,7 +1368,6 @@ pygame.display.set_caption("Chess")
 clock = pygame.time.Clock()
 
 ASSETS_DIR = "./assets/"
-MATCH_DIR = "./matches/"
 IMG_DIR = os.path.join(ASSETS_DIR, "pieces")
 ICONS_DIR = os.path.join(ASSETS_DIR, "gui")
 SOUND_DIR = os.path.join(ASSETS_DIR, "sound")
@@ -806,9 +1384,6 @@ sound_move = load_sound("move")
 sound_capture = load_sound("capture")
 sound_end = load_sound("end")
 
-if not os.path.exists(MATCH_DIR):
-    os.mkdir(MATCH_DIR)
-
 BASE_PIECES_NUM = {"R": 2,
                      "N": 2,
                      "B": 2,
@@ -822,19 +1397,6 @@ BASE_PIECES_NUM = {"R": 2,
                      "k": 1,
                      "p": 8} 
 
-PIECES_FILENAME = {"R": "Vb",
-                   "N": "Jb",
-                   "B": "Sb",
-                   "Q": "Db",
-                   "K": "Kb",
-                   "P": "Pb",
-                   "r": "Vc",
-                   "n": "Jc",
-                   "b": "Sc",
-                   "q": "Dc",
-                   "k": "Kc",
-                   "p": "Pc"}
-
 ICON_PIECE_SIZE = 30
 PIECES_IMG = {}
 ICON_PIECES = {}
@@ -867,6 +1429,9 @@ STATE_JOIN = 2
 STATE_CREATE = 3
 STATE_PLAYING = 4
 STATE_END = 5
+STATE_REPLAYS = 6
+STATE_REPLAY = 7
+STATE_BROWSER = 8
 GAME_STATE = 0
 
 STATE_TITLES = ["Chess Game", "About", "Join Server", "Create Server"]
@@ -907,11 +1472,13 @@ btn_join = GuiButton((menu_btn_x, place_y), FONT_ACCENT.render("Join server", Tr
 place_y += GUI_PAD + btn_join.rect.h
 btn_create = GuiButton((menu_btn_x, place_y), FONT_ACCENT.render("Create server", True, (0, 0, 0)), min_w=menu_btn_w)
 place_y += GUI_PAD + btn_join.rect.h
+btn_replays = GuiButton((menu_btn_x, place_y), FONT_ACCENT.render("Replays", True, (0, 0, 0)), min_w=menu_btn_w)
+place_y += GUI_PAD + btn_join.rect.h
 btn_about = GuiButton((menu_btn_x, place_y), FONT_ACCENT.render("About", True, (0, 0, 0)), min_w=menu_btn_w)
 place_y += GUI_PAD + btn_join.rect.h
 btn_quit = GuiButton((menu_btn_x, place_y), FONT_ACCENT.render("Quit", True, (0, 0, 0)), min_w=menu_btn_w)
 
-menu_btns = [btn_join, btn_create, btn_about, btn_quit]
+menu_btns = [btn_join, btn_create, btn_replays, btn_about, btn_quit]
 
 ## buttons for CREATE
 
@@ -928,6 +1495,7 @@ place_y += GUI_PAD + entry_name.h
 btn_entry_create = GuiButton((entry_x, place_y), FONT_ACCENT.render("Host", True, (0, 0, 0)), min_w=menu_entry_w)
 btn_entry_join = GuiButton((entry_x, place_y), FONT_ACCENT.render("Connect", True, (0, 0, 0)), min_w=menu_entry_w)
 btn_entry_back = GuiButton((GUI_BTN_PAD, GUI_BTN_PAD), FONT_ACCENT.render("Back", True, (0, 0, 0)), min_w=120)
+btn_entry_browse = GuiButton((w - 140 - GUI_BTN_PAD, GUI_BTN_PAD), FONT_ACCENT.render("Servers", True, (0, 0, 0)), min_w=140)
 
 entry_err_txt = None
 entry_preset_buttons = []
@@ -954,15 +1522,41 @@ pygame.display.set_icon(GAME_ICON)
 white = (255, 255, 255)
 screen = pygame.display.set_mode((w, h))
 
+## threats of the positions ClientBoard shows, see threats.py
+THREAT_WORKER = ThreatWorker()
+
 board = ClientBoard(chess.Board(), None, side=0)
 
+profiler = FrameProfiler()
+profiler_overlay = ProfilerOverlay(profiler)
+
 GAME_SERVER = None
 GAME_CLIENT = None
 GAME_RUNNING = True
+
+## Join/Create in progress: PendingConnection, and the ChessClient arguments
+PENDING_CONNECTION = None
+pending_args = None
+pending_text = None
+
+## status of the hosted game for the server list, see discovery.py
+GAME_RESPONDER = None
+browser_list = None
+
+## --record: captures of every game in captures/, see capture.py
+## --replay capture.cap [speed]: plays a client capture instead of connecting
+RECORD_SESSIONS = "--record" in sys.argv
+if "--replay" in sys.argv:
+    i = sys.argv.index("--replay")
+    GAME_CLIENT = CaptureClient(sys.argv[i+1], float(sys.argv[i+2]) if len(sys.argv) > i+2 else 1.0)
+    board = ClientBoard(chess.Board(), GAME_CLIENT)
+    GAME_STATE = STATE_PLAYING
+
 while GAME_RUNNING:
     events = pygame.event.get()
     mouse = pygame.mouse.get_pos()
     screen.fill(white)
+    profiler.mark("events")
 
     if GAME_STATE < STATE_PLAYING:
         title = FONT_TITLE.render(STATE_TITLES[GAME_STATE], True, (0, 0, 0))
@@ -984,6 +1578,9 @@ while GAME_RUNNING:
             if btn_create.pressed:
                 GAME_STATE = STATE_CREATE
                 entry_err_txt = None
+            if btn_replays.pressed:
+                GAME_STATE = STATE_REPLAYS
+                replay_list = ReplayList()
             if btn_about.pressed:
                 GAME_STATE = STATE_ABOUT
                 about_background = pygame.Surface((w, h))
@@ -1029,78 +1626,166 @@ while GAME_RUNNING:
             if GAME_STATE == STATE_CREATE:
                 btn = btn_entry_create
 
+            err_string = None
+
             btn_entry_back.update(events, mouse)
             btn_entry_back.draw(screen)
             if btn_entry_back.pressed:
-                GAME_STATE = STATE_MENU
+                ## Back while connecting only cancels
+                if not PENDING_CONNECTION is None:
+                    cancel_connecting()
+                    entry_err_txt = FONT_ACCENT.render("Connecting cancelled.", True, (0, 0, 0))
+                else:
+                    GAME_STATE = STATE_MENU
+
+            if not PENDING_CONNECTION is None:
+                try:
+                    cl = PENDING_CONNECTION.update()
+                except OSError as e:
+                    log.info("connecting failed: %s", e)
+                    err_string = get_error_string(e)
+                    cancel_connecting()
+                else:
+                    if not cl is None:
+                        ip,port,nick,room,recorder = pending_args
+                        PENDING_CONNECTION = None
+                        entry_err_txt = None
+                        remember_server(ip, port)
+
+                        GAME_CLIENT = ChessClient(ip, port, nick=nick, room=room, recorder=recorder, client=cl)
+                        board = ClientBoard(chess.Board(), GAME_CLIENT)
+
+                        GAME_STATE = STATE_PLAYING
+                    else:
+                        ## the local server has to take its own connection
+                        if not GAME_SERVER is None:
+                            GAME_SERVER.update()
+
+                        what = "Resolving" if PENDING_CONNECTION.is_resolving() else "Connecting to"
+                        dots = "." * (int(time.time() * 3) % 3 + 1)
+                        text = f"{what} {pending_args[0]}:{pending_args[1]}{dots}"
+                        if text != pending_text:
+                            pending_text = text
+                            entry_err_txt = FONT_ACCENT.render(text, True, (0, 0, 0))
+
+            if GAME_STATE == STATE_JOIN and PENDING_CONNECTION is None:
+                btn_entry_browse.update(events, mouse)
+                btn_entry_browse.draw(screen)
+                if btn_entry_browse.pressed:
+                    browser_list = BrowserList(ServerBrowser(get_known_servers()))
+                    GAME_STATE = STATE_BROWSER
 
             if not entry_err_txt is None:
                 screen.blit(entry_err_txt, center_horiz((w, h), entry_err_txt.get_size(), btn_entry_join.pos[1] + btn_entry_join.rect.h + GUI_PAD))
 
             btn.update(events, mouse)
-            if btn.pressed:
+            if btn.pressed and PENDING_CONNECTION is None and GAME_STATE in [STATE_JOIN, STATE_CREATE]:
                 GAME_SERVER = None
                 GAME_CLIENT = None
 
-                ## parse input
-                ip = entry_ip.get()
-                port = 1337
-                if ":" in ip:
-                    ip,port = ip.split(":")[0:2]
-                    port = int(port)
-
                 nick = entry_name.get()
 
-                err_string = None
+                ## resolving and connecting go on over the next frames, see above
                 try:
-                    if GAME_STATE == STATE_CREATE:
-                        GAME_SERVER = ChessServer(ip, port)
-                    GAME_CLIENT = ChessClient(ip, port, nick=nick)
+                    ## address/room for sharded servers
+                    ip,port,room = parse_address(entry_ip.get())
 
-                    board = ClientBoard(chess.Board(), GAME_CLIENT)
-
-                    GAME_STATE = STATE_PLAYING
-                ## connection errors
-                except ConnectionRefusedError:
-                    err_string = "Error: Connection refused!"
+                    if GAME_STATE == STATE_CREATE:
+                        GAME_SERVER = ChessServer(ip, port, clock=get_time_control())
+                        if RECORD_SESSIONS:
+                            GAME_SERVER._server.recorder = new_capture("server", {"side": "server", "clock": GAME_SERVER.clock})
+
+                        ## the game still works without being listed
+                        try:
+                            GAME_RESPONDER = StatusResponder((ip, port), lambda server=GAME_SERVER, name=f"{nick}'s game", port=port: hosting_status(server, name, port))
+                        except OSError as e:
+                            log.warning("not announcing the server: %s", e)
+
+                    recorder = new_capture("client", {"side": "client", "nick": nick}) if RECORD_SESSIONS else None
+                    PENDING_CONNECTION = PendingConnection((ip, port), get_connect_timeout())
+                    pending_args = (ip, port, nick, room, recorder)
+                ## binding the server
                 except OSError as e:
-                    print(e)
-                    ## fuck errno.h
-                    ## !!!!!
-                    known_winerrors = {11001: "Error: Invalid address!",
-                                       10048: "Error: Address already in use.",
-                                       10049: "Error: Cannot bind/connect to this address.",
-                                       10060: "Error: Timed out."}
-
-                    if e.errno in known_winerrors:
-                        err_string = known_winerrors[e.errno]
-                    else:
-                        err_string = "Invalid error :("
-                except socket.timeout:
-                    err_string = "Error: Timed out!"
-                except socket.gaierror:
+                    log.info("hosting failed: %s", e)
+                    err_string = get_error_string(e)
+                    GAME_SERVER = None
+                except ValueError:
                     err_string = "Error: Invalid address!"
 
-                if not err_string is None:
-                    sound_error.play()
-                    entry_err_txt = FONT_ACCENT.render(err_string, True, (0, 0, 0))
+            if not err_string is None:
+                sound_error.play()
+                entry_err_txt = FONT_ACCENT.render(err_string, True, (0, 0, 0))
             btn.draw(screen)
+        profiler.mark("menu")
                 
     if GAME_STATE == STATE_PLAYING:
         if not GAME_SERVER is None:
             GAME_SERVER.update()
+            if not GAME_RESPONDER is None:
+                GAME_RESPONDER.update()
+            profiler.mark("server")
         packets = GAME_CLIENT.update()
+        profiler.mark("network")
+        if packets:
+            profiler.count("packets", len(packets))
         board.server_update(packets)
+        profiler.mark("server_update")
         
         board.draw(screen, mouse)
+        profiler.mark("draw")
 
         ## user left
         if board.update(events, mouse) == False:
             GAME_STATE = STATE_MENU
+            close_captures()
 
             ## destroy server
-            if not GAME_SERVER is None:
-                GAME_SERVER.stop()
+            stop_hosting()
+        profiler.mark("input")
+
+    if GAME_STATE == STATE_REPLAYS:
+        title = FONT_TITLE.render("Replays", True, (0, 0, 0))
+        screen.blit(title, center_horiz((w, h), title.get_size(), GUI_PAD))
+
+        replay_list.draw(screen, mouse)
+        path = replay_list.update(events, mouse)
+        if not path is None:
+            try:
+                replay = ReplayViewer(path, board.board_surface, board.board_surf_white)
+                GAME_STATE = STATE_REPLAY
+            except (OSError, TypeError, ValueError) as e:
+                log.warning("replay: can't open %s %s", path, e)
+                sound_error.play()
+
+        btn_entry_back.update(events, mouse)
+        btn_entry_back.draw(screen)
+        if btn_entry_back.pressed:
+            GAME_STATE = STATE_MENU
+        profiler.mark("menu")
+
+    if GAME_STATE == STATE_BROWSER:
+        title = FONT_TITLE.render("Servers", True, (0, 0, 0))
+        screen.blit(title, center_horiz((w, h), title.get_size(), GUI_PAD))
+
+        address = browser_list.update(events, mouse)
+        browser_list.draw(screen, mouse)
+
+        btn_entry_back.update(events, mouse)
+        btn_entry_back.draw(screen)
+        if btn_entry_back.pressed or not address is None:
+            if not address is None:
+                entry_ip.set_input(address)
+                entry_err_txt = None
+            browser_list.browser.stop()
+            browser_list = None
+            GAME_STATE = STATE_JOIN
+        profiler.mark("menu")
+
+    if GAME_STATE == STATE_REPLAY:
+        if replay.update(events, mouse) == False:
+            GAME_STATE = STATE_REPLAYS
+        replay.draw(screen, mouse)
+        profiler.mark("replay")
 
     if GAME_STATE == STATE_ABOUT:
         screen.blit(about_background, (0, 0))
@@ -1145,20 +1830,33 @@ while GAME_RUNNING:
             about_background.fill(white)
             about_i = 0
         about_i += 1
+        profiler.mark("menu")
+
+    profiler_overlay.update(events)
+    profiler_overlay.draw(screen, None if GAME_CLIENT is None else GAME_CLIENT._client.rtt)
+    profiler.mark("overlay")
             
     pygame.display.flip()
+    profiler.mark("flip")
     for event in events:
         if event.type == pygame.QUIT:
             GAME_RUNNING = False
             pygame.quit()
 
     clock.tick(60)
+    profiler.mark(PROFILE_WAIT_SECTION)
+    profiler.end_frame()
+
+if not PENDING_CONNECTION is None:
+    cancel_connecting()
+close_captures()
 
 if not GAME_CLIENT is None:
     GAME_CLIENT.disconnect()
 
-if not GAME_SERVER is None:
-    GAME_SERVER.stop()
+stop_hosting()
+if not browser_list is None:
+    browser_list.browser.stop()
 
 pygame.display.quit()
 pygame.quit()
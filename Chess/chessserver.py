@@ -0,0 +1,935 @@
+import array
+import chess
+import chess.pgn
+import collections
+import heapq
+import hmac
+import os
+import secrets
+import struct
+import time
+import unidecode
+from datetime import datetime
+from networking import make_packet, Client, Server, PendingConnection, PACKET_PING
+from navigator import encode_move, decode_move
+from log import get_logger
+
+MATCH_DIR = "./matches/"
+
+STATUS_NOT_CONNECTED = -1 ## only for client
+STATUS_WAITING_FOR_PLAYERS = 0
+STATUS_PLAYING = 1
+STATUS_GAME_ENDED = 2
+STATUS_GAME_ENDED_PLAYER_LEFT = 3
+STATUS_SERVER_STOPPED = 4
+
+def write_utf8_string(string):
+    buf = string.encode("utf-8")
+
+    return struct.pack("I", len(buf)) + buf
+
+def read_utf8_string(buf):
+    l = struct.unpack("I", buf[0:4])[0]
+
+    return buf[4:4+l].decode("utf-8")
+    
+PACKET_STATUS = 2               ## int8 status
+PACKET_SET_NICK = 3             ## utf8_string nick
+PACKET_PLAYER_INFO = 4          ## int8 idx, utf8_string nick
+PACKET_SIDE = 5                 ## int8 side (SIDE_SPECTATOR for spectators)
+PACKET_BOARD = 6                ## int8 is_capture utf8_string board_epd
+PACKET_GIVE_UP = 7              ## give up
+PACKET_MOVE = 8                 ## int8 from, int8 to
+PACKET_GAME_OUTCOME = 9         ## int8 termination, int8 winner
+PACKET_CLIENT_MOVE_INFO = 10    ## int8 from, int8 to               info for client to see what was moved
+PACKET_CLIENT_TAKEN_INFO = 11   ## int8 piece                       info for client to see what was taken
+PACKET_JOIN_ROOM = 12           ## utf8_string room                 optional, sent before anything else
+PACKET_SPECTATE = 13            ## int8 is_relay, relay key         never take a seat, sent before the nick
+PACKET_SESSION = 14             ## bytes[16] token, utf8_string room  sent with the seat, for resuming
+PACKET_RESUME = 15              ## bytes[16] token                  instead of the nick, after a drop
+PACKET_PREMOVE = 16             ## (int8 from, int8 to)*            queued moves, the server sends back what is left
+PACKET_CLOCK = 17               ## uint32 white ms, uint32 black ms, int8 running side (-1 none)
+
+OUTCOME_RESIGNED = 11
+OUTCOME_TIMEOUT = 12
+
+SIDE_SPECTATOR = 2
+
+MAX_NICK_LENGTH = 32
+MAX_ROOM_LENGTH = 32
+
+## per client rate limits, packet id -> (per second, burst)
+RATE_LIMITS = {PACKET_PING: (2, 5),
+               PACKET_SET_NICK: (1, 3),
+               PACKET_MOVE: (30, 60),
+               PACKET_GIVE_UP: (1, 3),
+               PACKET_JOIN_ROOM: (1, 2),
+               PACKET_SPECTATE: (1, 2),
+               PACKET_RESUME: (1, 3),
+               PACKET_PREMOVE: (10, 20)}
+
+RELAY_SEND_QUEUE = 1 << 24      ## relays are trusted with a bigger send queue
+
+## shared secret of the relays this server trusts, from the environment so it
+## stays out of process lists and forked shard workers have it too
+## not set: no relay gets the bigger send queue, they still work as spectators
+RELAY_KEY = os.environ.get("CHESS_RELAY_KEY", "").encode("utf-8") or None
+
+MAX_PREMOVES = 8                ## queued moves per seat
+
+SESSION_TOKEN_SIZE = 16
+RESUME_GRACE = 30               ## seconds a dropped player's seat is held
+RESUME_REPLAY_PACKETS = 256     ## missed packets kept, more and the resume gets a fresh snapshot
+RECONNECT_INTERVAL = 1.0        ## seconds between reconnect attempts
+
+CLOCK_FORMAT = "<IIb"
+MAX_LAG_COMPENSATION = 1.0      ## seconds of round trip at most credited back per move
+
+server_log = get_logger("ChessServer")
+client_log = get_logger("ChessClient")
+
+## "minutes+increment seconds", e.g. "5+3" -> (300, 3)
+def parse_time_control(text):
+    base,increment = (text.split("+") + ["0"])[0:2]
+    return float(base) * 60, float(increment)
+
+## flag-fall deadlines of many rooms in one heap, so only rooms whose clock
+## runs out get looked at
+## entries go stale when the room's clock moves on (version), those are skipped
+class DeadlineHeap:
+    def __init__(self):
+        self.heap = []
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, deadline, game):
+        heapq.heappush(self.heap, (deadline, self.seq, game, game.clock_version))
+        self.seq += 1
+
+    ## next deadline, stale or not, None if empty
+    def peek(self):
+        return self.heap[0][0] if self.heap else None
+
+    ## games whose deadline passed
+    def pop_expired(self, now):
+        games = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline,seq,game,version = heapq.heappop(self.heap)
+            if game.clock_version == version:
+                games.append(game)
+
+        return games
+
+## seat of a dropped player
+## what the player had when it dropped plus everything it missed since
+## snapshot None (restored rooms) gets a fresh snapshot on resume instead
+class HeldSeat:
+    def __init__(self, snapshot, deadline):
+        self.snapshot = snapshot
+        self.deadline = deadline
+
+        self.missed = collections.deque(maxlen=RESUME_REPLAY_PACKETS)
+        self.overflowed = False
+
+    def add(self, buf):
+        if len(self.missed) == RESUME_REPLAY_PACKETS:
+            self.overflowed = True
+        self.missed.append(buf)
+
+## this server should accept two clients
+## and then start the game
+##
+## a room is kept small, shards run tens of thousands of them: the game is a
+## start FEN and an array of 2-byte moves, the board is built from them when
+## needed and can be dropped again (release_board), the PGN only gets made
+## when the game is saved, once it ended (or the server stops)
+class ChessServer:
+    ##
+    ## Server
+    ##
+
+    __slots__ = ["_server", "start_fen", "moves", "_board", "legal_moves", "status", "result", "start_time",
+                 "seats", "spectators", "nicks", "room", "tokens", "held", "premoves",
+                 "clock", "deadlines", "remaining", "turn_start", "turn_lag", "clock_version", "on_result", "save_matches",
+                 "new_token"]
+    
+    ## server can be anything with the networking.Server API
+    ## (e.g. a ClientGroup when many rooms share one Server)
+    ## room: name clients rejoin by on a sharded server
+    ## clock: (base, increment) seconds, None for no clocks
+    ## deadlines: DeadlineHeap shared by rooms for flag-fall, optional
+    ## recorder: CaptureWriter for a session capture, see capture.py
+    def __init__(self, ip=None, port=None, server=None, room=None, clock=None, deadlines=None, recorder=None):
+        if server is None:
+            server = Server((ip, port), rate_limits=RATE_LIMITS, recorder=recorder, track_hung_up=True)
+        self._server = server
+
+        if not os.path.exists(MATCH_DIR):
+            os.mkdir(MATCH_DIR)
+
+        ## None for the standard start
+        self.start_fen = None
+        ## navigator.encode_move of every move played
+        self.moves = array.array("H")
+        ## built from the moves on first use, see game_board
+        self._board = None
+
+        ##
+        ##  debug
+        ##
+        debug = -1
+        debug_fen = ["r1bqkb1r/pppp1ppp/2n2n2/3Q4/2B1P3/8/PB3PPP/RN2K1NR w KQkq - 0 1",
+                     "k7/8/8/8/2R1r3/8/8/6K1 w - - 0 1",
+                     "2r5/4kppp/8/N1P5/7P/b7/5KP1/3R2N1 w - - 2 50"]
+        if debug > -1:
+            self.start_fen = debug_fen[debug]
+
+        ##import stockfish
+        ##self.debug_stockfish = stockfish.Stockfish()
+
+        self.status = STATUS_WAITING_FOR_PLAYERS
+        ## "1-0", "0-1" or "1/2-1/2" once the game is over
+        self.result = None
+        self.start_time = None
+
+        ## (from, to) of legal moves in the current position, None until needed
+        self.legal_moves = None
+
+        ## client ids of white and black, seats are taken in nick order
+        self.seats = [None, None]
+        ## clients that asked to only watch
+        self.spectators = set()
+        self.nicks = [None, None]
+
+        ## resuming dropped players
+        self.room = room
+        self.tokens = [None, None]
+        self.held = [None, None]
+
+        ## (from, to) moves each seat wants to play as soon as it is its turn
+        self.premoves = [[], []]
+
+        ## clocks, remaining is as of turn_start for the side to move
+        self.clock = clock
+        self.deadlines = deadlines
+        self.remaining = [clock[0], clock[0]] if not clock is None else None
+        self.turn_start = None
+        ## lag credit of the side to move, fixed when its clock starts so
+        ## the deadline in the heap stays the one check_flag goes by
+        self.turn_lag = 0
+        self.clock_version = 0
+
+        ## called with (white nick, black nick, result, termination) when a game
+        ## ends, termination being what PACKET_GAME_OUTCOME carries
+        self.on_result = None
+        ## finished games go to MATCH_DIR, off for replays
+        self.save_matches = True
+        ## session tokens, called with SESSION_TOKEN_SIZE, replays hand out
+        ## the recorded ones
+        self.new_token = secrets.token_bytes
+
+    ## only the moves since the last capture or pawn move stay on its stack,
+    ## no repetition reaches back further
+    @property
+    def game_board(self):
+        if self._board is None:
+            board = chess.Board() if self.start_fen is None else chess.Board(self.start_fen)
+            for code in self.moves:
+                board.push(decode_move(code))
+            self._board = board.copy(stack=board.halfmove_clock)
+        return self._board
+
+    ## frees the board of a room nothing happens in, it gets rebuilt when needed
+    def release_board(self):
+        self._board = None
+        self.legal_moves = None
+
+    def get_last_move(self):
+        return decode_move(self.moves[-1]) if self.moves else None
+
+    def broadcast(self, buf):
+        self._server.broadcast(buf)
+        self.hold_packet(buf)
+
+    ## dropped players get it when they are back
+    def hold_packet(self, buf):
+        for held in self.held:
+            if not held is None:
+                held.add(buf)
+
+    def change_status(self, status):
+        self.status = status
+        self.broadcast_status()
+
+    def broadcast_status(self):
+        server_log.debug("broadcasting status: %d", self.status)
+        self.broadcast(make_packet(PACKET_STATUS, bytes([self.status])))
+
+    def broadcast_board(self, is_capture=0):
+        data = self.game_board.epd()
+        self.broadcast(make_packet(PACKET_BOARD,bytes([is_capture])+write_utf8_string(data)))
+
+    ## the two players, None if not connected
+    def get_seat(self, idx):
+        if self.seats[idx] is None:
+            return None
+        return self._server.clients.get(self.seats[idx])
+
+    ## 0 white, 1 black, None for spectators
+    def get_side(self, cl_idx):
+        if cl_idx in self.seats:
+            return self.seats.index(cl_idx)
+        return None
+
+    ## first free seat while waiting, otherwise spectator
+    def take_seat(self, cl_idx, now):
+        if self.status == STATUS_WAITING_FOR_PLAYERS and not cl_idx in self.spectators:
+            for idx in [0, 1]:
+                ## held seats of a restored room wait for their players
+                if self.get_seat(idx) is None and self.held[idx] is None:
+                    self.seats[idx] = cl_idx
+                    self.nicks[idx] = None
+
+                    ## lets the player back in after a drop
+                    self.tokens[idx] = self.new_token(SESSION_TOKEN_SIZE)
+                    room = self.room if not self.room is None else ""
+                    self._server.get_client(cl_idx)._send(make_packet(PACKET_SESSION, self.tokens[idx] + write_utf8_string(room)))
+
+                    return idx
+
+        self.spectators.add(cl_idx)
+        self.send_spectator_snapshot(self._server.get_client(cl_idx), now)
+
+        return None
+
+    def player_info_packet(self, idx):
+        return make_packet(PACKET_PLAYER_INFO, bytes([idx]) + write_utf8_string(self.nicks[idx]))
+
+    ## only the players' nicks get shown
+    def send_player_info(self, client):
+        for idx in [0, 1]:
+            ## nick not received yet
+            if not self.nicks[idx] is None and (not self.get_seat(idx) is None or not self.held[idx] is None):
+                client._send(self.player_info_packet(idx))
+
+    ## everything a client joining now needs
+    def send_snapshot(self, cl_idx):
+        client = self._server.get_client(cl_idx)
+
+        client._send(make_packet(PACKET_STATUS, bytes([self.status])))
+        self.send_player_info(client)
+
+    ## the game so far, then the live stream
+    def send_spectator_snapshot(self, client, now):
+        client._send(make_packet(PACKET_SIDE, bytes([SIDE_SPECTATOR])))
+
+        if self.status != STATUS_WAITING_FOR_PLAYERS:
+            client._send(make_packet(PACKET_BOARD, bytes([0]) + write_utf8_string(self.game_board.epd())))
+
+            last = self.get_last_move()
+            if not last is None:
+                client._send(make_packet(PACKET_CLIENT_MOVE_INFO, bytes([last.from_square, last.to_square])))
+
+            if not self.clock is None:
+                client._send(self.clock_packet(now))
+
+    ## what a player on side has, compact: state only, no history
+    def player_snapshot(self, side, now):
+        packets = [make_packet(PACKET_STATUS, bytes([self.status]))]
+        for idx in [0, 1]:
+            if not self.nicks[idx] is None:
+                packets.append(self.player_info_packet(idx))
+        packets.append(make_packet(PACKET_SIDE, bytes([side])))
+
+        if self.status != STATUS_WAITING_FOR_PLAYERS:
+            packets.append(make_packet(PACKET_BOARD, bytes([0]) + write_utf8_string(self.game_board.epd())))
+
+            ## only the opponent's moves get shown
+            last = self.get_last_move()
+            if not last is None and self.get_turn_side() == side:
+                packets.append(make_packet(PACKET_CLIENT_MOVE_INFO, bytes([last.from_square, last.to_square])))
+
+            if not self.clock is None:
+                packets.append(self.clock_packet(now))
+
+        return packets
+
+    ## seats of dropped players are held for RESUME_GRACE seconds
+    ## a player that hung up on purpose left, its game ends right away
+    def check_seats(self, now):
+        hung_up = self._server.get_hung_up_clients()
+        for side in [0, 1]:
+            if self.get_seat(side) is None and self.seats[side] in hung_up and not self.tokens[side] is None:
+                server_log.info("seat %d left", side)
+                self.tokens[side] = None
+                self.held[side] = None
+
+                if self.status == STATUS_PLAYING:
+                    self.abandon_game(now)
+
+            if self.get_seat(side) is None and self.held[side] is None and self.status == STATUS_PLAYING and not self.tokens[side] is None:
+                server_log.info("holding seat %d", side)
+                self.held[side] = HeldSeat(self.player_snapshot(side, now), now + RESUME_GRACE)
+
+            held = self.held[side]
+            if not held is None and now > held.deadline:
+                server_log.info("seat %d not resumed", side)
+                self.held[side] = None
+                self.tokens[side] = None
+
+                if self.status == STATUS_PLAYING:
+                    self.abandon_game(now)
+
+    ## a player is gone for good, the game is saved without a result
+    def abandon_game(self, now):
+        self.freeze_clock(now)
+        self.change_status(STATUS_GAME_ENDED_PLAYER_LEFT)
+        self.save_pgn()
+
+    ## a seat is free, for the server browser (see discovery.py)
+    def is_open(self):
+        return self.status == STATUS_WAITING_FOR_PLAYERS and (self.get_seat(0) is None or self.get_seat(1) is None)
+
+    ## earliest held seat deadline, None if no seat is held
+    def get_deadline(self):
+        deadlines = [held.deadline for held in self.held if not held is None]
+        return min(deadlines, default=None)
+
+    ## a dropped player is back: the snapshot from when it dropped and what it
+    ## missed since, or a fresh snapshot if too much was missed
+    def resume(self, cl_idx, token, now):
+        cl = self._server.get_client(cl_idx)
+
+        for side in [0, 1]:
+            if self.tokens[side] is None or not hmac.compare_digest(self.tokens[side], token):
+                continue
+
+            ## the old connection didn't time out yet
+            if self.held[side] is None:
+                self.held[side] = HeldSeat(self.player_snapshot(side, now), now + RESUME_GRACE)
+
+            held = self.held[side]
+            self.held[side] = None
+            self.seats[side] = cl_idx
+            cl.nick = self.nicks[side]
+
+            server_log.info("client %d resumed seat %d, %d missed packets", cl_idx, side, len(held.missed))
+
+            if held.overflowed or held.snapshot is None:
+                packets = self.player_snapshot(side, now)
+            else:
+                packets = held.snapshot + list(held.missed)
+
+            for packet in packets:
+                cl._send(packet)
+
+            ## the clock kept running meanwhile
+            if not self.clock is None and self.status != STATUS_WAITING_FOR_PLAYERS:
+                cl._send(self.clock_packet(now))
+            return True
+
+        ## too late, watch instead
+        self.spectators.add(cl_idx)
+        self.send_spectator_snapshot(cl, now)
+        return False
+
+    ## round trip of a player, credited back on its moves
+    def get_lag(self, side):
+        seat = self.get_seat(side)
+        if seat is None or seat.rtt is None:
+            return 0
+        return min(seat.rtt, MAX_LAG_COMPENSATION)
+
+    ## when the side to move runs out of time, with its lag allowance
+    def get_flag_deadline(self):
+        side = self.get_turn_side()
+        return self.turn_start + self.remaining[side] + self.turn_lag
+
+    ## remaining time of both sides right now
+    def get_clock_times(self, now):
+        times = list(self.remaining)
+        if self.status == STATUS_PLAYING and not self.turn_start is None:
+            side = self.get_turn_side()
+            times[side] = max(0, times[side] - (now - self.turn_start))
+        return times
+
+    def clock_packet(self, now):
+        white,black = self.get_clock_times(now)
+        running = self.get_turn_side() if self.status == STATUS_PLAYING else -1
+        return make_packet(PACKET_CLOCK, struct.pack(CLOCK_FORMAT, int(white * 1000), int(black * 1000), running))
+
+    ## the side to move's clock starts now
+    def start_clock(self, now):
+        self.turn_start = now
+        self.turn_lag = self.get_lag(self.get_turn_side())
+        self.clock_version += 1
+        if not self.deadlines is None:
+            self.deadlines.push(self.get_flag_deadline(), self)
+
+        self.broadcast(self.clock_packet(now))
+
+    ## game over, clocks stay where they are
+    def freeze_clock(self, now):
+        if self.clock is None or self.turn_start is None:
+            return
+
+        self.remaining = self.get_clock_times(now)
+        self.turn_start = None
+        self.clock_version += 1
+
+    ## time a move took, minus the round trip it spent on the wire
+    def stop_clock(self, side, now):
+        elapsed = max(0, now - self.turn_start - self.turn_lag)
+        self.remaining[side] = max(0, self.remaining[side] - elapsed) + self.clock[1]
+
+    ## returns True if the side to move ran out of time
+    def check_flag(self, now):
+        if self.clock is None or self.status != STATUS_PLAYING or now <= self.get_flag_deadline():
+            return False
+
+        side = self.get_turn_side()
+        server_log.info("%d lost on time", side)
+
+        self.remaining[side] = 0
+        self.clock_version += 1
+        self.change_status(STATUS_GAME_ENDED)
+        self.broadcast(self.clock_packet(now))
+        self.broadcast(make_packet(PACKET_GAME_OUTCOME, bytes([OUTCOME_TIMEOUT, 0 if side == 1 else 1])))
+        self.finish_game("0-1" if side == 0 else "1-0", OUTCOME_TIMEOUT)
+
+        return True
+
+    ## side to move, 0 white, 1 black
+    ## counted from the moves, the board isn't needed for it
+    def get_turn_side(self):
+        start = 1 if not self.start_fen is None and self.start_fen.split()[1] == "b" else 0
+        return (start + len(self.moves)) % 2
+
+    ## returns False if the move is illegal or too late
+    def play_move(self, side, from_square, to_square, now):
+        ## illegal moves never reach the board
+        if not (from_square, to_square) in self.get_legal_moves():
+            server_log.debug("illegal move %d %d", from_square, to_square)
+            return False
+
+        if self.check_flag(now):
+            return False
+
+        server_log.debug("move %d %d", from_square, to_square)
+
+        if not self.clock is None:
+            self.stop_clock(side, now)
+
+        taken_piece = self.board_move(from_square, to_square)
+
+        ## inform other player (and spectators) about the move
+        ## packets are made once and shared by everybody's send queue
+        info = make_packet(PACKET_CLIENT_MOVE_INFO, bytes([from_square, to_square]))
+        if not taken_piece is None:
+            info += make_packet(PACKET_CLIENT_TAKEN_INFO, bytes([taken_piece]))
+
+        mover = self.get_seat(side)
+        for cl_idx,cl in self._server.get_clients():
+            if cl != mover:
+                cl._send(info)
+        self.hold_packet(info)
+
+        if not self.clock is None:
+            if self.status == STATUS_PLAYING:
+                self.start_clock(now)
+            else:
+                self.freeze_clock(now)
+                self.broadcast(self.clock_packet(now))
+
+        return True
+
+    def send_premoves(self, side):
+        seat = self.get_seat(side)
+        if not seat is None:
+            seat._send(make_packet(PACKET_PREMOVE, bytes([square for move in self.premoves[side] for square in move])))
+
+    ## queued moves get played in the same tick the opponent's move lands
+    ## a premove that turned illegal drops the rest of its queue
+    def apply_premoves(self, now):
+        while self.status == STATUS_PLAYING:
+            side = self.get_turn_side()
+            queue = self.premoves[side]
+            if not queue:
+                return
+
+            from_square,to_square = queue.pop(0)
+            if not self.play_move(side, from_square, to_square, now):
+                queue.clear()
+
+            self.send_premoves(side)
+
+    def get_legal_moves(self):
+        if self.legal_moves is None:
+            self.legal_moves = set([(m.from_square, m.to_square) for m in self.game_board.legal_moves])
+        return self.legal_moves
+
+    def board_move(self, from_square, to_square):
+        captured_piece = None ## return what was captured to client
+
+        move = chess.Move(from_square, to_square)
+        board = self.game_board
+
+        ## if pawn, rank 0 or 7, promote to queen
+        if chess.square_rank(move.to_square) in [0, 7] and board.piece_at(move.from_square).piece_type == chess.PAWN:
+            move.promotion = chess.QUEEN
+
+        ## info for client
+        if board.is_en_passant(move):
+            captured_piece = chess.PAWN
+        elif board.is_capture(move):
+            captured_piece = board.piece_at(to_square).piece_type
+
+        ##self.stockfish.set_fen_position(board.fen())
+        
+        board.push(move)
+        self.moves.append(encode_move(move))
+        self.legal_moves = None
+        ## nothing before a capture or pawn move can repeat
+        if board.halfmove_clock == 0:
+            self._board = board.copy(stack=False)
+        self.broadcast_board(1 if not captured_piece is None else 0)
+        ## fix for capture sound on client
+
+        outcome = board.outcome()
+        if not outcome is None:
+            ## the game has ended!
+            self.change_status(STATUS_GAME_ENDED)
+            self.broadcast(make_packet(PACKET_GAME_OUTCOME, bytes([outcome.termination.value, outcome.winner if not outcome.winner is None else 0])))
+            self.finish_game(outcome.result(), outcome.termination.value)
+
+        return captured_piece
+
+    ## the game so far as a chess.pgn.Game
+    def get_pgn(self):
+        game_pgn = chess.pgn.Game()
+        game_pgn.headers["Event"] = "ChessGame.py match"
+        if not self.start_fen is None:
+            game_pgn.setup(chess.Board(self.start_fen))
+
+        for side in [0, 1]:
+            if not self.nicks[side] is None:
+                game_pgn.headers[["White", "Black"][side]] = self.nicks[side]
+
+        if not self.start_time is None:
+            game_pgn.headers["Date"] = self.start_time
+            if not self.clock is None:
+                game_pgn.headers["TimeControl"] = f"{self.clock[0]:g}+{self.clock[1]:g}"
+
+        if not self.result is None:
+            game_pgn.headers["Result"] = self.result
+
+        game_pgn.add_line([decode_move(code) for code in self.moves])
+        return game_pgn
+
+    ## writes the whole game, only when it ended, rebuilding it every move
+    ## would make a game quadratic
+    def save_pgn(self):
+        if not self.save_matches:
+            return
+
+        game_pgn = self.get_pgn()
+        white_nick = game_pgn.headers["White"]
+        black_nick = game_pgn.headers["Black"]
+        
+        match_name = unidecode.unidecode("{0}_{1}_{2}.pgn".format(white_nick, black_nick, self.start_time.strftime("%Y-%m-%d_%H-%M-%S")))
+        
+        f = open(os.path.join(MATCH_DIR, match_name), "w")
+        f.write(str(game_pgn))
+        f.close()
+
+    ## result: "1-0", "0-1" or "1/2-1/2"
+    ## termination: chess.Termination value, OUTCOME_RESIGNED or OUTCOME_TIMEOUT
+    def finish_game(self, result, termination):
+        self.result = result
+        self.save_pgn()
+
+        if not self.on_result is None:
+            self.on_result(self.nicks[0] or "?", self.nicks[1] or "?", result, termination)
+    
+    ## now: time of the tick, replays pass the recorded one
+    def update(self, now=None):
+        if self.status == STATUS_SERVER_STOPPED:
+            return
+
+        ## send status packet to new clients
+        for cl_idx in self._server.get_new_clients():
+            self.send_snapshot(cl_idx)
+
+        if now is None:
+            now = time.time()
+        self.check_seats(now)
+        self.check_flag(now)
+
+        ## the same tick time for the network, captures record it
+        for cl_idx,packets in self._server.update(now=now).items():
+            cl = self._server.get_client(cl_idx)
+            for packet in packets:
+                pID, pDATA = packet
+
+                ## move only if game in progress
+                if pID == PACKET_MOVE and self.status == STATUS_PLAYING and len(pDATA) == 2:
+                    ## each client can only move his own pieces
+                    side = self.get_side(cl_idx)
+                    if side == self.get_turn_side():
+                        self.play_move(side, pDATA[0], pDATA[1], now)
+                        self.apply_premoves(now)
+
+                ## replaces the queue, empty clears it
+                if pID == PACKET_PREMOVE and self.status == STATUS_PLAYING:
+                    side = self.get_side(cl_idx)
+                    if not side is None:
+                        queue = self.premoves[side]
+                        queue.clear()
+                        for i in range(0, min(len(pDATA), MAX_PREMOVES * 2) - 1, 2):
+                            if pDATA[i] < 64 and pDATA[i+1] < 64:
+                                queue.append((pDATA[i], pDATA[i+1]))
+
+                        self.send_premoves(side)
+                        ## the opponent already moved
+                        self.apply_premoves(now)
+
+                if pID == PACKET_SET_NICK:
+                    try:
+                        nick = read_utf8_string(pDATA)[:MAX_NICK_LENGTH]
+                    except (struct.error, UnicodeDecodeError):
+                        continue
+                    server_log.debug("client %d set nick %s", cl_idx, nick)
+
+                    cl.nick = nick
+
+                    side = self.get_side(cl_idx)
+                    if side is None and not cl_idx in self.spectators:
+                        side = self.take_seat(cl_idx, now)
+
+                    if not side is None:
+                    
+                        self.nicks[side] = nick
+
+                        ## send everybody the player's info
+                        self.broadcast(self.player_info_packet(side))
+
+                if pID == PACKET_RESUME and self.get_side(cl_idx) is None and not cl_idx in self.spectators:
+                    self.resume(cl_idx, pDATA[:SESSION_TOKEN_SIZE], now)
+
+                if pID == PACKET_SPECTATE and self.get_side(cl_idx) is None and not cl_idx in self.spectators:
+                    server_log.debug("client %d spectating", cl_idx)
+
+                    if len(pDATA) > 0 and pDATA[0] != 0:
+                        if not RELAY_KEY is None and hmac.compare_digest(bytes(pDATA[1:]), RELAY_KEY):
+                            cl.max_send_queue = RELAY_SEND_QUEUE
+                        else:
+                            server_log.info("client %d claims to be a relay without the key", cl_idx)
+
+                    self.spectators.add(cl_idx)
+                    self.send_spectator_snapshot(cl, now)
+
+                ## gave up
+                if pID == PACKET_GIVE_UP and self.status == STATUS_PLAYING:
+                    side = self.get_side(cl_idx)
+                    if not side is None:
+                        server_log.info("%d gave up", side)
+                        self.freeze_clock(now)
+                        self.change_status(STATUS_GAME_ENDED)
+                        if not self.clock is None:
+                            self.broadcast(self.clock_packet(now))
+                        self.broadcast(make_packet(PACKET_GAME_OUTCOME, bytes([OUTCOME_RESIGNED, 0 if side == 1 else 1])))
+                        self.finish_game("0-1" if side == 0 else "1-0", OUTCOME_RESIGNED)
+
+        ## enough clients (seats are taken with the nicks above)
+        if self.status == STATUS_WAITING_FOR_PLAYERS and not self.get_seat(0) is None and not self.get_seat(1) is None:
+            self.change_status(STATUS_PLAYING)
+            self.broadcast_board()
+
+            self.get_seat(0)._send(make_packet(PACKET_SIDE, bytes([0])))
+            self.get_seat(1)._send(make_packet(PACKET_SIDE, bytes([1])))
+
+            self.start_time = datetime.now()
+
+            if not self.clock is None:
+                self.start_clock(now)
+
+        ## everything queued this tick goes out now
+        self._server.flush()
+
+    ## everything that carries the room over a restart, see snapshot.py
+    ## connections aren't part of it, players come back with their tokens
+    ## moves are navigator.encode_move codes
+    def get_state(self, now):
+        return {"room": self.room,
+                "status": self.status,
+                "nicks": list(self.nicks),
+                "tokens": list(self.tokens),
+                "clock": self.clock,
+                "remaining": None if self.clock is None else self.get_clock_times(now),
+                "start_fen": self.start_fen,
+                "start_time": None if self.start_time is None else self.start_time.timestamp(),
+                "moves": array.array("H", self.moves),
+                "premoves": [list(queue) for queue in self.premoves]}
+
+    ## a fresh room takes over a get_state, seats with a token are held for
+    ## RESUME_GRACE from now, and the clock of the side to move restarts now,
+    ## the restart itself doesn't cost anybody time
+    ## the board only gets built when a player is back
+    def set_state(self, state, now):
+        self.room = state["room"]
+        self.status = state["status"]
+        self.nicks = list(state["nicks"])
+        self.tokens = list(state["tokens"])
+
+        self.start_fen = state["start_fen"]
+        self.moves = array.array("H", state["moves"])
+        self.release_board()
+
+        if not state["start_time"] is None:
+            self.start_time = datetime.fromtimestamp(state["start_time"])
+
+        self.clock = state["clock"]
+        self.remaining = None if self.clock is None else list(state["remaining"])
+        self.turn_start = None
+        if not self.clock is None:
+            if self.status == STATUS_PLAYING:
+                self.turn_start = now
+                self.turn_lag = 0
+                self.clock_version += 1
+                if not self.deadlines is None:
+                    self.deadlines.push(self.get_flag_deadline(), self)
+
+        self.premoves = [list(moves) for moves in state["premoves"]]
+
+        for side in [0, 1]:
+            if not self.tokens[side] is None:
+                self.held[side] = HeldSeat(None, now + RESUME_GRACE)
+
+    ## a very sad day today
+    ## a game still going gets saved as it is, its end overwrites it if a
+    ## restarted server gets the room back
+    def stop(self):
+        if self.status == STATUS_PLAYING:
+            self.save_pgn()
+        self.status = STATUS_SERVER_STOPPED
+        self._server.stop()
+        
+## connects to server
+class ChessClient:
+    ## spectate: only watch, never take a seat
+    ## recorder: CaptureWriter for a session capture, see capture.py
+    ## client: an already connected Client (PendingConnection), connects itself if None
+    def __init__(self, ip, port, nick="newbie", room=None, spectate=False, recorder=None, client=None):
+        self.addr = (ip, port)
+        self._client = Client.new_connection(self.addr) if client is None else client
+
+        self.recorder = recorder
+        self._client.recorder = recorder
+
+        self.nick = nick
+        self.room = room
+
+        ## seated players get a token to resume with after a drop
+        self.token = None
+        self.reconnecting = False
+        self.dropped = None
+        self.last_attempt = 0
+        ## reconnects don't block the game loop either
+        self.pending = None
+
+        ## sharded servers place us by room, see shards.py
+        if not room is None:
+            self._client.send(make_packet(PACKET_JOIN_ROOM, write_utf8_string(self.room)))
+
+        if spectate:
+            self._client.send(make_packet(PACKET_SPECTATE, bytes([0])))
+
+        self._client.send(make_packet(PACKET_SET_NICK, write_utf8_string(self.nick)))
+    
+    ## None when disconnected for good, [] while reconnecting
+    def update(self):
+        if self.reconnecting:
+            return self.reconnect()
+
+        packets = self._client.update()
+
+        ## connection dropped, try to get the seat back
+        if packets is None and not self.token is None:
+            client_log.info("connection lost, reconnecting")
+            self.reconnecting = True
+            if self.dropped is None:
+                self.dropped = time.time()
+            return self.reconnect()
+
+        if packets:
+            self.dropped = None
+            for p_id,payload in packets:
+                if p_id == PACKET_SESSION:
+                    self.token = payload[:SESSION_TOKEN_SIZE]
+                    room = read_utf8_string(payload[SESSION_TOKEN_SIZE:])
+                    if room:
+                        self.room = room
+
+        return packets
+
+    def reconnect(self):
+        now = time.time()
+        if now - self.dropped > RESUME_GRACE:
+            client_log.info("could not reconnect")
+            self.token = None
+            self.dropped = None
+            self.reconnecting = False
+            if not self.pending is None:
+                self.pending.close()
+                self.pending = None
+            return None
+
+        if self.pending is None:
+            if now - self.last_attempt < RECONNECT_INTERVAL:
+                return []
+            self.last_attempt = now
+            self.pending = PendingConnection(self.addr)
+
+        try:
+            client = self.pending.update()
+        except OSError as e:
+            client_log.info("reconnect failed %s", e)
+            self.pending = None
+            return []
+        if client is None:
+            return []
+
+        self.pending = None
+        self._client = client
+        self._client.recorder = self.recorder
+
+        if not self.room is None:
+            self._client.send(make_packet(PACKET_JOIN_ROOM, write_utf8_string(self.room)))
+        self._client.send(make_packet(PACKET_RESUME, self.token))
+
+        self.reconnecting = False
+        return []
+
+    def disconnect(self):
+        self.token = None
+        self.reconnecting = False
+        if not self.pending is None:
+            self.pending.close()
+            self.pending = None
+        if self._client.connected:
+            self._client.disconnect()
+        
+    def send_move(self, from_square, to_square):
+        if self._client.connected:
+            self._client.send(make_packet(PACKET_MOVE, bytes([from_square, to_square])))
+
+    ## moves: [(from, to)], played in order once it's our turn, [] clears
+    def send_premoves(self, moves):
+        if self._client.connected:
+            self._client.send(make_packet(PACKET_PREMOVE, bytes([square for move in moves for square in move])))
+
+    def give_up(self):
+        if self._client.connected:
+            self._client.send(make_packet(PACKET_GIVE_UP, b""))
@@ -0,0 +1,392 @@
+import collections
+import json
+import random
+import socket
+import struct
+import sys
+import time
+from networking import PendingConnection
+from log import get_logger
+
+## LAN discovery and server status
+## a hosting server answers status queries over UDP on its game port and
+## broadcasts the same status to DISCOVERY_PORT every ANNOUNCE_INTERVAL
+## the browser listens there and probes every server it knows at once
+## from one UDP socket, replies are matched by nonce, so a slow server
+## never holds up the others
+## servers that don't answer over UDP (older version, UDP filtered) get a
+## TCP connect instead, its time is the round trip, the rest stays unknown
+##
+## datagrams: DISCOVERY_MAGIC, uint8 kind, uint32 nonce, then
+##   MSG_QUERY:  nothing
+##   MSG_STATUS: utf8 JSON status, nonce of the query or 0 for announcements
+
+DEFAULT_PORT = 1337
+DISCOVERY_PORT = 1338
+
+DISCOVERY_MAGIC = b"CHESSLAN"
+DISCOVERY_HEADER = "<BI"
+DISCOVERY_HEADER_SIZE = len(DISCOVERY_MAGIC) + struct.calcsize(DISCOVERY_HEADER)
+MAX_DATAGRAM = 4096
+
+MSG_QUERY = 0
+MSG_STATUS = 1
+
+ANNOUNCE_INTERVAL = 2.0         ## seconds between LAN announcements
+PROBE_TIMEOUT = 1.0             ## seconds until a UDP probe falls back to TCP
+PROBE_INTERVAL = 5.0            ## seconds between probes of one server
+LAN_EXPIRY = 3 * ANNOUNCE_INTERVAL      ## LAN servers not heard from are dropped after this
+MAX_OPEN_ROOMS = 16             ## rooms waiting for players listed in a status
+
+SERVER_PROBING = 0
+SERVER_ONLINE = 1
+SERVER_OFFLINE = 2
+
+SOURCE_LAN = "lan"
+SOURCE_PRESET = "preset"
+SOURCE_RECENT = "recent"
+
+log = get_logger("discovery")
+
+def make_datagram(kind, nonce, payload=b""):
+    return DISCOVERY_MAGIC + struct.pack(DISCOVERY_HEADER, kind, nonce) + payload
+
+## (kind, nonce, payload), None if it isn't ours
+def read_datagram(data):
+    if len(data) < DISCOVERY_HEADER_SIZE or not data.startswith(DISCOVERY_MAGIC):
+        return None
+    kind,nonce = struct.unpack_from(DISCOVERY_HEADER, data, len(DISCOVERY_MAGIC))
+    return kind, nonce, data[DISCOVERY_HEADER_SIZE:]
+
+## "host[:port][/room]" as typed in the Join screen -> (host, port, room or None)
+## ValueError for a bad port or more than one
+def parse_address(text, default_port=DEFAULT_PORT):
+    room = None
+    if "/" in text:
+        text,room = text.split("/", 1)
+
+    port = default_port
+    if ":" in text:
+        if text.count(":") > 1:
+            raise ValueError(f"more than one port in {text}")
+        text,port = text.split(":")
+        port = int(port)
+        if not 0 <= port <= 65535:
+            raise ValueError(f"port {port} out of range")
+
+    return text, port, room
+
+def is_ip(host):
+    try:
+        socket.inet_aton(host)
+    except OSError:
+        return False
+    return host.count(".") == 3
+
+## status of a hosting server, what the browser shows
+def make_status(name, port, players, rooms=1, open_rooms=(), clock=None):
+    return {"name": name,
+            "port": port,
+            "players": players,
+            "rooms": rooms,
+            "open": list(open_rooms)[:MAX_OPEN_ROOMS],
+            "clock": None if clock is None else f"{clock[0] / 60:g}+{clock[1]:g}"}
+
+## UDP side of a hosting server
+## get_status: returns the make_status dict, called once per answer
+class StatusResponder:
+    def __init__(self, addr, get_status, announce=True):
+        self.addr = addr
+        self.get_status = get_status
+        self.announce = announce
+        self.last_announce = 0
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sock.bind(addr)
+        self.sock.setblocking(False)
+
+        ## loopback servers can't broadcast, their announcements stay on this machine
+        self.announce_addr = ("<broadcast>", DISCOVERY_PORT)
+
+    def status_payload(self):
+        return json.dumps(self.get_status()).encode("utf-8")
+
+    def update(self, now=None):
+        if self.sock is None:
+            return
+        if now is None:
+            now = time.time()
+
+        payload = None
+        while True:
+            try:
+                data,addr = self.sock.recvfrom(MAX_DATAGRAM)
+            except (BlockingIOError, ConnectionResetError):
+                ## windows reports ICMP port unreachable of earlier sends here
+                break
+
+            msg = read_datagram(data)
+            if msg is None or msg[0] != MSG_QUERY:
+                continue
+
+            if payload is None:
+                payload = self.status_payload()
+            try:
+                self.sock.sendto(make_datagram(MSG_STATUS, msg[1], payload), addr)
+            except OSError as e:
+                log.debug("status reply to %s failed %s", addr, e)
+
+        if self.announce and now - self.last_announce > ANNOUNCE_INTERVAL:
+            self.last_announce = now
+            if payload is None:
+                payload = self.status_payload()
+
+            try:
+                self.sock.sendto(make_datagram(MSG_STATUS, 0, payload), self.announce_addr)
+            except OSError as e:
+                if self.announce_addr[0] == "127.0.0.1":
+                    log.debug("announcing failed %s", e)
+                else:
+                    log.info("broadcast failed (%s), announcing on this machine only", e)
+                    self.announce_addr = ("127.0.0.1", DISCOVERY_PORT)
+
+    def stop(self):
+        if not self.sock is None:
+            self.sock.close()
+            self.sock = None
+
+## a server of the browser
+class BrowserEntry:
+    def __init__(self, host, port, source):
+        self.host = host
+        self.port = port
+        self.source = source
+
+        ## hostnames get resolved by the first TCP probe
+        self.ip = host if is_ip(host) else None
+
+        self.state = SERVER_PROBING
+        self.name = None
+        self.rtt = None
+        self.players = None
+        self.rooms = None
+        self.open_rooms = []
+        self.clock = None
+
+        self.nonce = None
+        self.probe_sent = 0
+        self.last_probe = -PROBE_INTERVAL
+        self.last_seen = time.perf_counter()
+
+        ## TCP fallback in progress
+        self.pending = None
+
+    def get_address(self, room=None):
+        address = f"{self.host}:{self.port}"
+        if room:
+            address += f"/{room}"
+        return address
+
+    ## status comes from whoever sent the datagram, ValueError if it isn't
+    ## a make_status dict
+    def set_status(self, status):
+        if type(status) != dict or type(status.get("open", [])) != list:
+            raise ValueError("not a server status")
+
+        self.state = SERVER_ONLINE
+        self.name = str(status.get("name", ""))
+        self.players = status.get("players")
+        self.rooms = status.get("rooms")
+        self.open_rooms = [str(room) for room in status.get("open", [])][:MAX_OPEN_ROOMS]
+        self.clock = status.get("clock")
+
+## every known server, probed concurrently and refreshed as answers come in
+## known: [(host, port, source)] of presets and recently joined servers
+class ServerBrowser:
+    def __init__(self, known=()):
+        self.servers = collections.OrderedDict()
+        for host,port,source in known:
+            self.add(host, port, source)
+
+        ## bumped on every change, the screen only redraws then
+        self.version = 0
+
+        self.probe_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.probe_sock.setblocking(False)
+        ## nonce -> entry
+        self.probes = {}
+
+        ## several browsers on one machine all get the announcements
+        self.listen_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.listen_sock.bind(("", DISCOVERY_PORT))
+            self.listen_sock.setblocking(False)
+        except OSError as e:
+            log.warning("not listening for LAN servers: %s", e)
+            self.listen_sock.close()
+            self.listen_sock = None
+
+    def add(self, host, port, source):
+        key = (host, port)
+        if not key in self.servers:
+            self.servers[key] = BrowserEntry(host, port, source)
+        return self.servers[key]
+
+    def get_servers(self):
+        return list(self.servers.values())
+
+    def changed(self):
+        self.version += 1
+
+    def read_announcements(self, now):
+        if self.listen_sock is None:
+            return
+
+        while True:
+            try:
+                data,addr = self.listen_sock.recvfrom(MAX_DATAGRAM)
+            except (BlockingIOError, ConnectionResetError):
+                return
+
+            msg = read_datagram(data)
+            if msg is None or msg[0] != MSG_STATUS:
+                continue
+
+            try:
+                status = json.loads(msg[2].decode("utf-8"))
+                port = int(status["port"])
+                entry = self.servers.get((addr[0], port)) or BrowserEntry(addr[0], port, SOURCE_LAN)
+                entry.set_status(status)
+            except (ValueError, KeyError, TypeError):
+                continue
+
+            self.servers.setdefault((addr[0], port), entry)
+            entry.last_seen = now
+            self.changed()
+
+    def read_replies(self, now):
+        while True:
+            try:
+                data,addr = self.probe_sock.recvfrom(MAX_DATAGRAM)
+            except (BlockingIOError, ConnectionResetError):
+                return
+
+            msg = read_datagram(data)
+            if msg is None or msg[0] != MSG_STATUS:
+                continue
+
+            entry = self.probes.pop(msg[1], None)
+            if entry is None or entry.nonce != msg[1]:
+                continue
+
+            ## replies wait in the socket until the next update, so the
+            ## round trip is at most one update interval too long
+            now = time.perf_counter()
+
+            try:
+                status = json.loads(msg[2].decode("utf-8"))
+                entry.set_status(status)
+            except ValueError:
+                continue
+
+            entry.nonce = None
+            entry.rtt = now - entry.probe_sent
+            entry.last_seen = now
+            self.changed()
+
+    def probe(self, entry, now):
+        entry.last_probe = now
+
+        ## unresolved hostname, the TCP probe resolves it
+        if entry.ip is None:
+            entry.pending = PendingConnection((entry.host, entry.port), PROBE_TIMEOUT)
+            entry.probe_sent = now
+            return
+
+        entry.nonce = random.getrandbits(32) | 1
+        entry.probe_sent = time.perf_counter()
+        self.probes[entry.nonce] = entry
+        try:
+            self.probe_sock.sendto(make_datagram(MSG_QUERY, entry.nonce), (entry.ip, entry.port))
+        except OSError as e:
+            log.debug("probing %s failed %s", entry.get_address(), e)
+            self.probes.pop(entry.nonce, None)
+            entry.nonce = None
+            self.set_offline(entry)
+
+    def set_offline(self, entry):
+        if entry.state != SERVER_OFFLINE:
+            entry.state = SERVER_OFFLINE
+            entry.rtt = None
+            self.changed()
+
+    def update_tcp_probe(self, entry, now):
+        try:
+            client = entry.pending.update()
+        except OSError:
+            entry.pending = None
+            self.set_offline(entry)
+            return
+
+        if client is None:
+            return
+
+        entry.pending = None
+        entry.rtt = time.perf_counter() - entry.probe_sent
+        entry.ip = client.socket.getpeername()[0]
+        client.socket.close()
+
+        entry.state = SERVER_ONLINE
+        entry.last_seen = now
+        self.changed()
+
+    def update(self, now=None):
+        if now is None:
+            now = time.perf_counter()
+
+        self.read_announcements(now)
+        self.read_replies(now)
+
+        for key,entry in list(self.servers.items()):
+            if not entry.pending is None:
+                self.update_tcp_probe(entry, now)
+
+            ## no UDP answer, try TCP
+            elif not entry.nonce is None and now - entry.probe_sent > PROBE_TIMEOUT:
+                self.probes.pop(entry.nonce, None)
+                entry.nonce = None
+                entry.pending = PendingConnection((entry.ip, entry.port), PROBE_TIMEOUT)
+                entry.probe_sent = now
+
+            elif entry.nonce is None and now - entry.last_probe > PROBE_INTERVAL:
+                self.probe(entry, now)
+
+            if entry.source == SOURCE_LAN and now - entry.last_seen > LAN_EXPIRY and entry.state != SERVER_ONLINE:
+                self.servers.pop(key)
+                self.changed()
+
+    def stop(self):
+        for entry in self.servers.values():
+            if not entry.pending is None:
+                entry.pending.close()
+        self.probe_sock.close()
+        if not self.listen_sock is None:
+            self.listen_sock.close()
+
+## usage: discovery.py [seconds] [host:port ...]
+## lists LAN servers and the given ones
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    browser = ServerBrowser([parse_address(address)[0:2] + (SOURCE_RECENT,) for address in sys.argv[2:]])
+
+    end = time.time() + seconds
+    while time.time() < end:
+        browser.update()
+        time.sleep(0.01)
+    browser.stop()
+
+    for entry in browser.get_servers():
+        rtt = "-" if entry.rtt is None else f"{entry.rtt * 1000:.1f}ms"
+        print(f"{entry.get_address():25} {['probing', 'online', 'offline'][entry.state]:8} {rtt:>9} {entry.name} players {entry.players} rooms {entry.rooms} open {entry.open_rooms}")
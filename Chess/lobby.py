@@ -0,0 +1,238 @@
+import collections
+import heapq
+import math
+import struct
+import time
+from networking import make_packet, PACKET_PING
+from chessserver import *
+
+DEFAULT_RATING = 1500
+
+MATCH_BUCKET_SIZE = 25          ## rating points per queue bucket
+MATCH_WINDOW = 50               ## initial +- rating window
+MATCH_WINDOW_STEP = 50          ## window widening...
+MATCH_WINDOW_STEP_TIME = 5      ## ...every this many seconds
+MATCH_WINDOW_MAX = 800
+
+MATCH_WAIT_SAMPLES = 1000       ## recent wait times kept for stats
+
+class MatchEntry:
+    def __init__(self, key, rating, joined):
+        self.key = key
+        self.rating = rating
+        self.joined = joined
+        self.bucket = math.floor(rating / MATCH_BUCKET_SIZE)
+
+    def get_window(self, now):
+        steps = int((now - self.joined) / MATCH_WINDOW_STEP_TIME)
+        return min(MATCH_WINDOW + steps * MATCH_WINDOW_STEP, MATCH_WINDOW_MAX)
+
+## matchmaking queue
+## players are kept in rating buckets (oldest first in each), finding an
+## opponent only looks at the buckets inside the rating window, so it
+## doesn't depend on how many are waiting
+## players only get looked at again when their window widens
+class MatchQueue:
+    def __init__(self):
+        self.buckets = {}       ## bucket -> {key: MatchEntry}
+        self.entries = {}       ## key -> MatchEntry
+
+        ## (time, seq, key) when to retry with a wider window
+        self.retry_heap = []
+        self.seq = 0
+
+        self.wait_times = collections.deque(maxlen=MATCH_WAIT_SAMPLES)
+        self.num_matched = 0
+        self.max_wait = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def _insert(self, entry):
+        self.entries[entry.key] = entry
+        self.buckets.setdefault(entry.bucket, {})[entry.key] = entry
+
+    def _remove(self, entry):
+        del self.entries[entry.key]
+
+        bucket = self.buckets[entry.bucket]
+        del bucket[entry.key]
+        if not bucket:
+            del self.buckets[entry.bucket]
+
+    def _schedule_retry(self, entry, now):
+        if entry.get_window(now) >= MATCH_WINDOW_MAX:
+            return
+
+        ## next window step
+        steps = int((now - entry.joined) / MATCH_WINDOW_STEP_TIME) + 1
+        heapq.heappush(self.retry_heap, (entry.joined + steps * MATCH_WINDOW_STEP_TIME, self.seq, entry.key))
+        self.seq += 1
+
+    ## closest waiting player both players accept
+    def find_opponent(self, entry, now):
+        window = entry.get_window(now)
+
+        best = None
+        best_diff = None
+        reach = math.ceil(window / MATCH_BUCKET_SIZE)
+        for i in range(entry.bucket - reach, entry.bucket + reach + 1):
+            for other in self.buckets.get(i, {}).values():
+                if other is entry:
+                    continue
+
+                diff = abs(other.rating - entry.rating)
+                if diff > window or diff > other.get_window(now):
+                    continue
+
+                ## bucket is oldest first, first fit is enough
+                if best is None or diff < best_diff:
+                    best = other
+                    best_diff = diff
+                break
+
+        return best
+
+    def _pair(self, entry, other, now):
+        self._remove(entry)
+        self._remove(other)
+
+        for e in [entry, other]:
+            wait = now - e.joined
+            self.wait_times.append(wait)
+            self.max_wait = max(self.max_wait, wait)
+        self.num_matched += 2
+
+        ## whoever waited longer gets white
+        if other.joined < entry.joined:
+            return other.key, entry.key
+        return entry.key, other.key
+
+    ## returns a pair when there is an opponent right away
+    def add(self, key, rating, now=None):
+        if now is None:
+            now = time.time()
+
+        entry = MatchEntry(key, rating, now)
+
+        other = self.find_opponent(entry, now)
+        if not other is None:
+            self._insert(entry)
+            return self._pair(entry, other, now)
+
+        self._insert(entry)
+        self._schedule_retry(entry, now)
+
+        return None
+
+    def remove(self, key):
+        entry = self.entries.get(key)
+        if not entry is None:
+            self._remove(entry)
+
+    ## pairs of players whose windows widened enough
+    def match(self, now=None):
+        if now is None:
+            now = time.time()
+
+        pairs = []
+        while self.retry_heap and self.retry_heap[0][0] <= now:
+            t,seq,key = heapq.heappop(self.retry_heap)
+
+            entry = self.entries.get(key)
+            if entry is None:
+                continue
+
+            other = self.find_opponent(entry, now)
+            if other is None:
+                self._schedule_retry(entry, now)
+            else:
+                pairs.append(self._pair(entry, other, now))
+
+        return pairs
+
+    def get_stats(self, now=None):
+        if now is None:
+            now = time.time()
+
+        waits = sorted(self.wait_times)
+        oldest = min([e.joined for e in self.entries.values()], default=now)
+
+        return {"waiting": len(self.entries),
+                "matched": self.num_matched,
+                "wait_avg": sum(waits) / len(waits) if waits else 0,
+                "wait_p50": waits[len(waits) // 2] if waits else 0,
+                "wait_p95": waits[int(len(waits) * 0.95)] if waits else 0,
+                "wait_max": self.max_wait,
+                "longest_waiting": now - oldest}
+
+## holds clients of a Server until they are matched
+## get_rating: nick -> rating
+class Lobby:
+    def __init__(self, server, get_rating=None):
+        self.server = server
+        self.get_rating = get_rating if not get_rating is None else (lambda nick: DEFAULT_RATING)
+
+        self.queue = MatchQueue()
+
+        ## packets of held clients, given to the room they end up in
+        self.held = {}
+
+    def __contains__(self, cl_id):
+        return cl_id in self.held
+
+    ## new client
+    def add(self, cl_id):
+        self.held[cl_id] = []
+        self.server.get_client(cl_id).send(make_packet(PACKET_STATUS, bytes([STATUS_WAITING_FOR_PLAYERS])))
+
+    def push(self, cl_id, packets, now=None):
+        pair = None
+        for p_id,payload in packets:
+            if p_id == PACKET_PING:
+                continue
+
+            self.held[cl_id].append((p_id, payload))
+
+            ## the nick is known, into the queue
+            if p_id == PACKET_SET_NICK and not cl_id in self.queue and pair is None:
+                try:
+                    nick = read_utf8_string(payload)[:MAX_NICK_LENGTH]
+                except (struct.error, UnicodeDecodeError):
+                    ## one bad packet mustn't take the lobby down, the client goes
+                    self.remove(cl_id)
+                    self.server.remove_client(cl_id)
+                    return None
+                pair = self.queue.add(cl_id, self.get_rating(nick), now)
+
+        return pair
+
+    def remove(self, cl_id):
+        if cl_id in self.held:
+            self.held.pop(cl_id)
+            self.queue.remove(cl_id)
+
+    ## updates of clients going through the lobby (new ones get added)
+    ## returns matched client pairs, [((white, packets), (black, packets))]
+    def update(self, updates, removed, now=None):
+        if now is None:
+            now = time.time()
+
+        for cl_id in removed:
+            self.remove(cl_id)
+
+        pairs = []
+        for cl_id,packets in updates.items():
+            if not cl_id in self.held:
+                self.add(cl_id)
+
+            pair = self.push(cl_id, packets, now)
+            if not pair is None:
+                pairs.append(pair)
+
+        pairs += self.queue.match(now)
+
+        return [tuple([(cl_id, self.held.pop(cl_id)) for cl_id in pair]) for pair in pairs]
@@ -0,0 +1,184 @@
+import atexit
+import collections
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+## logging for the game loops
+## a log call only checks the level and appends (time, level, name, msg,
+## args) to a ring buffer, the message gets formatted and written by a
+## background thread, so a tick never waits for stdout
+## when the buffer is full the oldest entries are dropped and counted
+
+LEVEL_TRACE = 0
+LEVEL_DEBUG = 1
+LEVEL_INFO = 2
+LEVEL_WARNING = 3
+LEVEL_ERROR = 4
+
+LEVEL_NAMES = {LEVEL_TRACE: "TRACE", LEVEL_DEBUG: "DEBUG", LEVEL_INFO: "INFO", LEVEL_WARNING: "WARNING", LEVEL_ERROR: "ERROR"}
+
+LOG_BUFFER_SIZE = 8192          ## entries kept until the flush thread writes them
+LOG_FLUSH_INTERVAL = 0.1        ## seconds between writes
+
+LOG_LEVEL = LEVEL_INFO          ## level of new loggers
+
+class LogBuffer:
+    def __init__(self, size=LOG_BUFFER_SIZE, stream=None, json_lines=False):
+        ## deque appends and pops are atomic, no lock needed
+        self.entries = collections.deque(maxlen=size)
+        self.dropped = 0
+
+        self.stream = stream
+        ## one JSON object per line instead of text
+        self.json_lines = json_lines
+
+        self.thread = None
+        self.wake = threading.Event()
+
+    def append(self, entry):
+        if len(self.entries) == self.entries.maxlen:
+            self.dropped += 1
+        self.entries.append(entry)
+
+    def format(self, entry):
+        t,level,name,msg,args = entry
+        ## a single dict fills %(name)s fields
+        if len(args) == 1 and type(args[0]) == dict:
+            args = args[0]
+        if args:
+            try:
+                msg = msg % args
+            except (TypeError, ValueError):
+                msg = f"{msg} {args}"
+
+        if self.json_lines:
+            return json.dumps({"time": t, "level": LEVEL_NAMES[level], "name": name, "msg": msg})
+
+        clock = time.strftime("%H:%M:%S", time.localtime(t))
+        return f"{clock}.{int(t * 1000) % 1000:03d} {LEVEL_NAMES[level]:7} {name}: {msg}"
+
+    ## writes everything buffered, on the calling thread
+    def flush(self):
+        lines = []
+        while self.entries:
+            try:
+                lines.append(self.format(self.entries.popleft()))
+            except IndexError:
+                break
+
+        if self.dropped:
+            lines.append(f"log: {self.dropped} entries dropped, buffer full")
+            self.dropped = 0
+
+        if lines:
+            stream = sys.stdout if self.stream is None else self.stream
+            stream.write("\n".join(lines) + "\n")
+            stream.flush()
+
+    def run(self):
+        while True:
+            self.wake.wait(LOG_FLUSH_INTERVAL)
+            self.wake.clear()
+            try:
+                self.flush()
+            except (OSError, ValueError):
+                ## stream closed (shutdown)
+                return
+
+    ## the flush thread, started by the first logger
+    ## daemon, so it never keeps a process alive, see flush_logs for exit
+    def start(self):
+        if not self.thread is None and self.thread.is_alive():
+            return
+
+        self.thread = threading.Thread(target=self.run, name="log flush", daemon=True)
+        self.thread.start()
+
+    ## a forked child has the parent's entries but not its thread
+    def reset(self):
+        self.entries.clear()
+        self.dropped = 0
+        self.thread = None
+        self.wake = threading.Event()
+
+BUFFER = LogBuffer()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=BUFFER.reset)
+
+## named logger, level checks happen before anything gets built
+class Logger:
+    def __init__(self, name, level=LEVEL_INFO, buffer=BUFFER):
+        self.name = name
+        self.level = level
+        self.buffer = buffer
+
+        ## for hot paths: `if logger.enabled:` before building the arguments
+        self.enabled = True
+
+    def log(self, level, msg, *args):
+        if level < self.level or not self.enabled:
+            return
+
+        self.buffer.append((time.time(), level, self.name, msg, args))
+        if self.buffer.thread is None:
+            self.buffer.start()
+        if level >= LEVEL_ERROR:
+            self.buffer.wake.set()
+
+    def trace(self, msg, *args):
+        self.log(LEVEL_TRACE, msg, *args)
+
+    def debug(self, msg, *args):
+        self.log(LEVEL_DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(LEVEL_INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(LEVEL_WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        self.log(LEVEL_ERROR, msg, *args)
+
+LOGGERS = {}
+
+def get_logger(name, level=None):
+    logger = LOGGERS.get(name)
+    if logger is None:
+        logger = LOGGERS[name] = Logger(name, LOG_LEVEL if level is None else level)
+    return logger
+
+## every packet read or written, off until switched on
+## callers check packet_trace.enabled first, so a disabled trace is one attribute lookup
+packet_trace = get_logger("packets", LEVEL_TRACE)
+packet_trace.enabled = False
+
+def set_packet_trace(enabled):
+    packet_trace.enabled = enabled
+    get_logger("log").info("packet trace %s", "on" if enabled else "off")
+
+def toggle_packet_trace():
+    set_packet_trace(not packet_trace.enabled)
+
+## SIGUSR1 switches the packet trace of a running server (kill -USR1 pid)
+def trace_on_signal():
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: toggle_packet_trace())
+
+def set_level(level):
+    global LOG_LEVEL
+    LOG_LEVEL = level
+
+    for logger in LOGGERS.values():
+        if not logger is packet_trace:
+            logger.level = level
+
+## what's still buffered, also done at exit
+def flush_logs():
+    BUFFER.flush()
+
+atexit.register(flush_logs)
@@ -0,0 +1,105 @@
+import chess
+import chess.pgn
+
+CHECKPOINT_INTERVAL = 16        ## plies between kept positions
+
+## a move in 2 bytes: from | to << 6 | promotion piece type << 12, 0 being a null move
+def encode_move(move):
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+def decode_move(code):
+    return chess.Move(code & 63, code >> 6 & 63, code >> 12 or None)
+
+## positions of a game by ply
+## a copy of the board is kept every CHECKPOINT_INTERVAL plies, so any ply
+## is at most that many pushes away instead of a replay from the start
+class PlyNavigator:
+    def __init__(self, moves, board=None, interval=CHECKPOINT_INTERVAL):
+        self.moves = list(moves)
+        self.interval = interval
+
+        board = chess.Board() if board is None else board.copy(stack=False)
+        self.start_turn = board.turn
+        self.start_fullmove = board.fullmove_number
+
+        self.checkpoints = [board.copy(stack=False)]
+        ## SAN of every move, for the move list
+        self.san = []
+        for i,move in enumerate(self.moves):
+            self.san.append(board.san(move))
+            board.push(move)
+
+            if (i + 1) % interval == 0:
+                self.checkpoints.append(board.copy(stack=False))
+
+        self.ply = 0
+        self.board = self.checkpoints[0].copy(stack=False)
+
+    def __len__(self):
+        return len(self.moves)
+
+    ## a new board at ply
+    def board_at(self, ply):
+        ply = max(0, min(ply, len(self.moves)))
+
+        base = ply // self.interval
+        board = self.checkpoints[base].copy(stack=False)
+        for move in self.moves[base * self.interval:ply]:
+            board.push(move)
+
+        return board
+
+    ## moves the current board to ply and returns it
+    def seek(self, ply):
+        ply = max(0, min(ply, len(self.moves)))
+        if ply == self.ply:
+            return self.board
+
+        ## stepping forward is cheaper than going from the checkpoint
+        if ply > self.ply and ply - self.ply <= ply % self.interval:
+            for move in self.moves[self.ply:ply]:
+                self.board.push(move)
+        else:
+            self.board = self.board_at(ply)
+
+        self.ply = ply
+        return self.board
+
+    ## move that led to ply, None at the start
+    def get_move(self, ply):
+        if ply <= 0 or ply > len(self.moves):
+            return None
+        return self.moves[ply - 1]
+
+    ## (move number, white ply, black ply) per move list row, plies are None if missing
+    def get_rows(self):
+        rows = []
+        ply = 1
+        number = self.start_fullmove
+
+        ## game starting with black to move
+        if self.start_turn == chess.BLACK and len(self.moves) > 0:
+            rows.append((number, None, ply))
+            ply += 1
+            number += 1
+
+        while ply <= len(self.moves):
+            rows.append((number, ply, ply + 1 if ply + 1 <= len(self.moves) else None))
+            ply += 2
+            number += 1
+
+        return rows
+
+    @staticmethod
+    def from_game(game, interval=CHECKPOINT_INTERVAL):
+        return PlyNavigator(game.mainline_moves(), game.board(), interval)
+
+## (game, PlyNavigator) of the first game in a PGN file, None if there is none
+def load_game(path, interval=CHECKPOINT_INTERVAL):
+    f = open(path, encoding="utf-8")
+    game = chess.pgn.read_game(f)
+    f.close()
+
+    if game is None:
+        return None
+    return game, PlyNavigator.from_game(game, interval)
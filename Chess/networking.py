@@ -1,6 +1,14 @@
+import collections
+import errno
+import itertools
+import os
+import select
 import socket
+import selectors
 import struct
+import threading
 import time
+from log import get_logger, packet_trace
 
 def make_packet(_id, payload):
     b = bytes([_id]) + payload
@@ -8,26 +16,179 @@ def make_packet(_id, payload):
     return struct.pack("I", len(b)) + b
 
 B_EMPTY = b""
-PACKET_PING = 0
+PACKET_PING = 0         ## empty, or int8 kind, double timestamp for measuring the round trip
 PACKET_HANG = 1
 
+PING_REQUEST = 0        ## echo this back
+PING_REPLY = 1
+PING_FORMAT = "<Bd"
+PING_SIZE = struct.calcsize(PING_FORMAT)
+RTT_SMOOTHING = 0.125   ## weight of a new round trip sample
+
+WATCHED_SOCKET = "watched"      ## selector data of sockets only watched for waking up
+
 CLIENT_CLIENT = "client"
 CLIENT_SERVERCLIENT = "server_client"
 
+## record kinds of session captures, see capture.py
+CAPTURE_IN = 0
+CAPTURE_OUT = 1
+CAPTURE_CONNECT = 2
+CAPTURE_DISCONNECT = 3
+CAPTURE_HANG = 4                ## a disconnect after the client sent PACKET_HANG
+CAPTURE_RTT = 5                 ## float64 new round trip time of the client
+
+PING_INTERVAL = 5       ## seconds between sent pings
+PING_TIMEOUT = 10       ## seconds without a ping until disconnect
+
+ACCEPT_BUDGET = 64      ## max accepted connections per server tick
+MAX_CLIENTS = 10000     ## connections over this get hung up right away
+
+CONNECT_TIMEOUT = 10    ## seconds for resolving the host and connecting
+
+MAX_PACKET_SIZE = 1 << 16       ## bigger announced packets disconnect
+MAX_SEND_QUEUE = 1 << 20        ## queued bytes until a slow client gets dropped
+SEND_BATCH = 64                 ## buffers per send call
+
+## scatter/gather sending, not on windows
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+## connect_ex results of a non-blocking connect still going, linux and windows
+CONNECT_IN_PROGRESS = set(getattr(errno, name) for name in ["EINPROGRESS", "EALREADY", "EWOULDBLOCK", "WSAEWOULDBLOCK", "WSAEINPROGRESS"] if hasattr(errno, name))
+FLOOD_MAX_DROPPED = 200         ## rate limited packets in FLOOD_WINDOW until disconnect
+FLOOD_WINDOW = 10.0             ## seconds the dropped packets get counted over
+
+log = get_logger("net")
+
+## rate limit, rate tokens per second up to burst
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+        self.tokens = burst
+        self.last = None
+
+    def take(self, now):
+        if not self.last is None:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+## hashed timer wheel
+## keys get hashed into slots by their deadline, advancing only visits
+## the slots that passed since the last advance, so idle keys cost nothing
+class TimerWheel:
+    def __init__(self, resolution=0.25, num_slots=256):
+        self.resolution = resolution
+        self.num_slots = num_slots
+
+        self.slots = [{} for i in range(num_slots)]
+        self.key_slot = {}
+
+        self.current_tick = None
+
+    def _tick(self, t):
+        return int(t / self.resolution)
+
+    def schedule(self, key, deadline):
+        self.cancel(key)
+
+        tick = self._tick(deadline)
+        ## deadline already passed, fire on next advance
+        if not self.current_tick is None and tick < self.current_tick:
+            tick = self.current_tick
+
+        slot = tick % self.num_slots
+        self.slots[slot][key] = deadline
+        self.key_slot[key] = slot
+
+    def cancel(self, key):
+        slot = self.key_slot.pop(key, None)
+        if not slot is None:
+            del self.slots[slot][key]
+
+    def __len__(self):
+        return len(self.key_slot)
+
+    ## returns keys whose deadline passed
+    def advance(self, now):
+        target = self._tick(now)
+        if self.current_tick is None:
+            self.current_tick = target
+
+        expired = []
+        ## never walk more than one revolution (long stalls)
+        steps = min(target - self.current_tick + 1, self.num_slots)
+        for i in range(steps):
+            slot = self.slots[(self.current_tick + i) % self.num_slots]
+            if not slot:
+                continue
+
+            ## keys for later revolutions stay in the slot
+            for key,deadline in list(slot.items()):
+                if deadline <= now:
+                    del slot[key]
+                    del self.key_slot[key]
+                    expired.append(key)
+
+        self.current_tick = target
+
+        return expired
+
+## packets are small and answered right away, Nagle would hold a board
+## back until the one before is acked (a delayed ack, ~40ms)
+def set_nodelay(sock):
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+
 class Client:
     def __init__(self, socket, _kind=CLIENT_CLIENT):
         self._kind = _kind
         
         self.socket = socket
         self.connected = True
+        ## the other side left on purpose with a hang packet
+        self.hung_up = False
 
         self.socket.settimeout(0.0)
+
+        set_nodelay(self.socket)
         
         self.last_ping_sent = 0
         self.last_ping_received = time.time()
 
+        ## smoothed round trip time in seconds, None until measured
+        self.rtt = None
+
         self.buf = b""
 
+        ## packet id -> TokenBucket, packets over the limit get dropped
+        self.rate_limits = {}
+        ## dropped since window_start, a window starts with its first drop
+        self.dropped = 0
+        self.window_start = 0
+
+        ## outgoing packets, the same buffer can be queued for many clients
+        self.send_queue = collections.deque()
+        self.send_queue_bytes = 0
+        self.send_offset = 0
+        self.max_send_queue = MAX_SEND_QUEUE
+
+        ## server clients only queue, the Server flushes once per tick
+        ## pending: the Server's set of client ids with queued data
+        self.send_immediately = True
+        self.pending = None
+        self.cl_id = None
+
+        ## CaptureWriter getting every packet handled and sent, see capture.py
+        self.recorder = None
+
     ## API use
     @staticmethod
     def new_connection(addr):
@@ -38,25 +199,36 @@ class Client:
 
     ## internal use
     def read_packets(self):
+        packets = []
+        pos = 0
+
         ## is an index present?
-        if len(self.buf) >= 4:
-            packet_length = struct.unpack("I", self.buf[:4])[0]
+        while len(self.buf) - pos >= 4:
+            packet_length = struct.unpack_from("I", self.buf, pos)[0]
+
+            ## don't wait for (and buffer) huge packets
+            if packet_length == 0 or packet_length > MAX_PACKET_SIZE:
+                log.warning("%s bad packet length %d, disconnecting", self._kind, packet_length)
+                self.connected = False
+                self.buf = B_EMPTY
+                return packets
 
-            ## whole packet is present
-            if len(self.buf) >= packet_length+4:
-                packet_buf = self.buf[:4+packet_length]
+            ## whole packet is not present yet
+            if len(self.buf) - pos < 4+packet_length:
+                break
 
-                ## read the packet: id, payload
-                packet = (packet_buf[4], packet_buf[5:])
-                print(packet)
+            ## read the packet: id, payload
+            packet = (self.buf[pos+4], self.buf[pos+5:pos+4+packet_length])
+            if packet_trace.enabled:
+                packet_trace.trace("%s recv %d %r", self._kind, packet[0], packet[1])
+            packets.append(packet)
 
-            ## move the buffer
-            self.buf = self.buf[4+packet_length:]
+            pos += 4+packet_length
 
-            return [packet, *self.read_packets()]
-        
-        else:
-            return []
+        ## move the buffer
+        self.buf = self.buf[pos:]
+
+        return packets
 
     ## API use
     def send(self, buf):
@@ -69,16 +241,86 @@ class Client:
     def _send(self, buf):
         if not self.connected:
             return
+
+        if packet_trace.enabled:
+            packet_trace.trace("%s send %r", self._kind, buf)
+        if not self.recorder is None:
+            self.recorder.record_send(time.time(), self.get_record_id(), buf)
         
-        try:
-            self.socket.sendall(buf)
-        except:
-            print(self._kind, "sending error, disconnecting")
+        self.send_queue.append(buf)
+        self.send_queue_bytes += len(buf)
+
+        if self.send_queue_bytes > self.max_send_queue:
+            log.warning("%s not reading, disconnecting", self._kind)
             self.connected = False
+            return
+
+        if self.send_immediately:
+            self.flush()
+        elif not self.pending is None:
+            self.pending.add(self.cl_id)
+
+    ## sends as much of the queue as possible, True when all got sent
+    def flush(self):
+        while self.send_queue:
+            bufs = list(itertools.islice(self.send_queue, SEND_BATCH))
+            if self.send_offset > 0:
+                bufs[0] = memoryview(bufs[0])[self.send_offset:]
+
+            try:
+                if HAS_SENDMSG:
+                    sent = self.socket.sendmsg(bufs)
+                else:
+                    sent = self.socket.send(b"".join(bufs))
+            except BlockingIOError:
+                return False
+            except OSError:
+                log.info("%s sending error, disconnecting", self._kind)
+                self.connected = False
+                return False
+
+            self.send_queue_bytes -= sent
 
-    def ping(self):
-        self._send(make_packet(PACKET_PING, B_EMPTY))
-        self.last_ping_sent = time.time()
+            ## drop what got sent
+            sent += self.send_offset
+            self.send_offset = 0
+            while sent > 0:
+                length = len(self.send_queue[0])
+                if sent < length:
+                    self.send_offset = sent
+                    return False
+
+                self.send_queue.popleft()
+                sent -= length
+
+        return True
+
+    def ping(self, now=None):
+        self._send(make_packet(PACKET_PING, struct.pack(PING_FORMAT, PING_REQUEST, time.perf_counter())))
+        self.last_ping_sent = time.time() if now is None else now
+
+    ## id in captures, a client on its own is 0
+    def get_record_id(self):
+        return 0 if self.cl_id is None else self.cl_id
+
+    ## pings are echoed back to measure the round trip
+    def handle_ping(self, payload):
+        if len(payload) != PING_SIZE:
+            return
+
+        kind,timestamp = struct.unpack(PING_FORMAT, payload)
+        if kind == PING_REQUEST:
+            self._send(make_packet(PACKET_PING, struct.pack(PING_FORMAT, PING_REPLY, timestamp)))
+
+        elif kind == PING_REPLY:
+            sample = time.perf_counter() - timestamp
+            if sample < 0:
+                return
+
+            if self.rtt is None:
+                self.rtt = sample
+            else:
+                self.rtt += (sample - self.rtt) * RTT_SMOOTHING
 
     ## API use
     def disconnect(self):
@@ -95,30 +337,46 @@ class Client:
         ## hack to make sure hang packet gets through
         self.socket.settimeout(20)
         self._send(make_packet(PACKET_HANG, B_EMPTY))
+        self.flush()
         self.connected = False
 
-    ## update, handles internal stuff and is for API use
-    def update(self):
+    ## reads the socket and handles internal packets
+    ## returns all packets, None when disconnected
+    def receive(self, now):
         if not self.connected:
             return None
-        
+
         try:
             data = self.socket.recv(1024)
             if data:
                 self.buf += data
-                
-        except socket.error:
+            else:
+                ## orderly shutdown by the other side
+                log.info("%s connection closed", self._kind)
+                self.connected = False
+                return None
+
+        except BlockingIOError:
             pass
+        except socket.error:
+            log.info("%s receiving error, disconnecting", self._kind)
+            self.connected = False
+            return None
 
         ## some internal packets get handled internally
         ## all get returned
-        packets = list(self.read_packets())
+        packets = self.read_packets()
+        if not self.connected:
+            self.socket.close()
+            return None
 
-        ## internal handling
-        ## sending ping
-        if (time.time() - self.last_ping_sent) > 5:
-            ##print(self._kind, "pinging")
-            self.ping()
+        if self.rate_limits:
+            packets = self.limit_packets(packets, now)
+            if packets is None:
+                return None
+
+        if not self.recorder is None:
+            self.recorder.record_packets(now, self.get_record_id(), packets)
 
         ## iterate packets (only internal packets are handled)
         for p_id, payload in packets:
@@ -126,38 +384,172 @@ class Client:
             ## received ping
             if p_id == PACKET_PING:
                 ##print(self._kind, "ping received", self.last_ping_received)
-                self.last_ping_received = time.time()
+                self.last_ping_received = now
+                rtt = self.rtt
+                self.handle_ping(payload)
+                ## lag credits depend on it, replays can't measure it
+                if self.rtt != rtt and not self.recorder is None:
+                    self.recorder.record(now, self.get_record_id(), CAPTURE_RTT, struct.pack("<d", self.rtt))
 
             ## received hang
             if p_id == PACKET_HANG:
-                print(self._kind, "hang")
+                log.info("%s hang", self._kind)
                 self.socket.close()
                 self.connected = False
-                return
+                self.hung_up = True
+                return None
+
+        return packets
+
+    ## drops packets over their rate limit, None when flooding
+    def limit_packets(self, packets, now):
+        allowed = []
+        for packet in packets:
+            bucket = self.rate_limits.get(packet[0])
+            if bucket is None or bucket.take(now):
+                allowed.append(packet)
+                continue
+
+            ## only a burst of drops is flooding, not a long session of a few
+            if now - self.window_start > FLOOD_WINDOW:
+                self.window_start = now
+                self.dropped = 0
+            self.dropped += 1
+
+        if self.dropped > FLOOD_MAX_DROPPED:
+            log.warning("%s flooding, disconnecting", self._kind)
+            self.connected = False
+            return None
+
+        return allowed
+
+    ## pings and timeout, returns the time this should be called again
+    def check_timers(self, now):
+        if not self.connected:
+            return None
+
+        ## sending ping
+        if (now - self.last_ping_sent) > PING_INTERVAL:
+            ##print(self._kind, "pinging")
+            self.ping(now)
 
         ## check when last received ping
-        if (time.time() - self.last_ping_received) > 10:
+        if (now - self.last_ping_received) > PING_TIMEOUT:
             ## server not responding, goodbye
-            print(self._kind, "not responding")
+            log.info("%s not responding", self._kind)
             self._disconnect()
-            
+            return None
+
+        return min(self.last_ping_sent + PING_INTERVAL, self.last_ping_received + PING_TIMEOUT)
+
+    ## update, handles internal stuff and is for API use
+    def update(self):
+        now = time.time()
+
+        ## what didn't fit into the socket last time
+        if self.send_queue:
+            self.flush()
+
+        packets = self.receive(now)
+        if packets is None:
+            return None
+
+        self.check_timers(now)
+
+        if not self.connected:
+            return None
 
         return packets
 
-class Server:
-    def __init__(self, addr):
-        self.socket = socket.socket()
-        self.socket.bind(addr)
-        self.socket.listen()
-        
-        self.running = True
+## a connect that never blocks the caller
+## the host gets resolved on a thread (getaddrinfo has no non-blocking form),
+## then every resolved address gets a non-blocking connect, polled by update()
+class PendingConnection:
+    def __init__(self, addr, timeout=CONNECT_TIMEOUT):
+        self.addr = addr
+        self.timeout = timeout
+        self.start = time.time()
+
+        ## getaddrinfo results not tried yet, None until resolved
+        self.addresses = None
+        self.error = None
+        self.sock = None
+
+        self.thread = threading.Thread(target=self.resolve, name="resolve", daemon=True)
+        self.thread.start()
+
+    ## IPv4 only, like the servers listen
+    def resolve(self):
+        try:
+            self.addresses = socket.getaddrinfo(self.addr[0], self.addr[1], socket.AF_INET, socket.SOCK_STREAM)
+        except OSError as e:
+            self.error = e
+
+    def is_resolving(self):
+        return self.sock is None and self.addresses is None and self.error is None
+
+    ## non-blocking connect to the next address, the error when none is left
+    def connect_next(self):
+        while self.addresses:
+            family,_type,proto,name,sockaddr = self.addresses.pop(0)
+            self.sock = socket.socket(family, _type, proto)
+            self.sock.setblocking(False)
+
+            err = self.sock.connect_ex(sockaddr)
+            if err == 0 or err in CONNECT_IN_PROGRESS:
+                return
+            self.close()
+            self.error = OSError(err, os.strerror(err))
 
-        self.socket.settimeout(0.0)
+        if self.error is None:
+            self.error = OSError(errno.EADDRNOTAVAIL, os.strerror(errno.EADDRNOTAVAIL))
+
+    ## Client once connected, None while still going
+    ## raises the OSError (gaierror, timeout, refused...) when it failed
+    def update(self):
+        if time.time() - self.start > self.timeout:
+            self.close()
+            raise OSError(errno.ETIMEDOUT, os.strerror(errno.ETIMEDOUT))
+
+        if self.sock is None:
+            if self.addresses is None and self.error is None:
+                return None
+            self.connect_next()
+            if self.sock is None:
+                raise self.error
+
+        ## writable when connected, failed connects show up as errors on windows
+        r,w,x = select.select([], [self.sock], [self.sock], 0)
+        if not w and not x:
+            return None
 
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.close()
+            self.error = OSError(err, os.strerror(err))
+            ## next address next tick
+            if not self.addresses:
+                raise self.error
+            return None
+
+        sock = self.sock
+        self.sock = None
+        return Client(sock)
+
+    ## gives up, the resolving thread finishes on its own
+    def close(self):
+        if not self.sock is None:
+            self.sock.close()
+            self.sock = None
+
+## shared API of Server and ClientGroup
+class ClientContainer:
+    def __init__(self):
         self.clients = {}
         self.new_clients = []
-
-        self.cl_idx = 0
+        ## removed clients that hung up on purpose, see Client.hung_up
+        ## a ClientGroup always keeps them, its room reads them every update
+        self.hung_up_clients = set()
 
     def broadcast(self, buf):
         for cl_idx,cl in self.clients.items():
@@ -171,53 +563,319 @@ class Server:
         self.new_clients = []
         return tmp
 
+    def get_hung_up_clients(self):
+        tmp = self.hung_up_clients
+        self.hung_up_clients = set()
+        return tmp
+
     def get_num_clients(self):
-        return len(self.clients.items())
+        return len(self.clients)
 
     def get_client(self, i):
         return self.clients[i]
-        
+
+## addr None: no listening socket, clients only come from add_client
+class Server(ClientContainer):
+    ## rate_limits: packet id -> (per second, burst) for every client
+    ## recorder: CaptureWriter for the traffic of all clients, see capture.py
+    ## track_removed: keep the ids of removed clients for get_removed_clients,
+    ## only for owners that call it every tick, otherwise the list just grows
+    ## track_hung_up: the same for get_hung_up_clients
+    def __init__(self, addr, accept_budget=ACCEPT_BUDGET, max_clients=MAX_CLIENTS, rate_limits=None, recorder=None, track_removed=False, track_hung_up=False):
+        ClientContainer.__init__(self)
+
+        self.recorder = recorder
+        self.track_removed = track_removed
+        self.track_hung_up = track_hung_up
+
+        self.rate_limits = rate_limits if not rate_limits is None else {}
+
+        self.running = True
+
+        self.accept_budget = accept_budget
+        self.max_clients = max_clients
+
+        ## only sockets with data get visited each tick
+        self.selector = selectors.DefaultSelector()
+
+        self.socket = None
+        if not addr is None:
+            self.socket = socket.socket()
+            ## a restarted server binds again right away, despite its old
+            ## connections in TIME_WAIT (on windows it would share the port)
+            if os.name == "posix":
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind(addr)
+            self.socket.listen(socket.SOMAXCONN)
+
+            self.socket.settimeout(0.0)
+
+            self.selector.register(self.socket, selectors.EVENT_READ, None)
+
+        ## ping and timeout deadlines of every client
+        self.timers = TimerWheel()
+
+        self.removed_clients = []
+
+        ## clients with queued data
+        self.pending_send = set()
+
+        self.cl_idx = 0
+
+    def get_removed_clients(self):
+        tmp = self.removed_clients
+        self.removed_clients = []
+        return tmp
+
     def stop(self):
-        print("stopping server")
+        log.info("stopping server")
         self.running = False
-        self.socket.close()
 
-    def update(self):
-        if not self.running:
-            return
-    
-        try:
-            conn,addr = self.socket.accept()
+        for cl_id in list(self.clients.keys()):
+            self.remove_client(cl_id)
 
-            print(f"server: client id {self.cl_idx} connected")
+        self.selector.close()
+        if not self.socket is None:
+            self.socket.close()
 
-            self.clients[self.cl_idx] = Client(conn, _kind=CLIENT_SERVERCLIENT)
-            self.new_clients.append(self.cl_idx)
-            self.cl_idx += 1
-        except BlockingIOError:
+    ## wake up update() when sock has data, the owner reads it
+    def watch(self, sock):
+        self.selector.register(sock, selectors.EVENT_READ, WATCHED_SOCKET)
+
+    def unwatch(self, sock):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
             pass
 
-        ## remove clients that are not connected
-        rm = []
-        for cl_id in list(self.clients.keys()):
-            if not self.clients[cl_id].connected:
-                self.clients.pop(cl_id)
+    ## adopt an already connected socket, buf is data already read from it
+    def add_client(self, conn, buf=B_EMPTY, now=None):
+        if now is None:
+            now = time.time()
+
+        log.info("server: client id %d connected", self.cl_idx)
+
+        cl = Client(conn, _kind=CLIENT_SERVERCLIENT)
+        cl.last_ping_received = now
+        cl.buf = buf
+        cl.rate_limits = {p_id: TokenBucket(*limit) for p_id,limit in self.rate_limits.items()}
+
+        cl.send_immediately = False
+        cl.pending = self.pending_send
+        cl.cl_id = self.cl_idx
+
+        cl.recorder = self.recorder
+        if not self.recorder is None:
+            self.recorder.record(now, self.cl_idx, CAPTURE_CONNECT)
+
+        self.clients[self.cl_idx] = cl
+        self.new_clients.append(self.cl_idx)
+
+        self.selector.register(conn, selectors.EVENT_READ, self.cl_idx)
+        self.timers.schedule(self.cl_idx, now)
+
+        self.cl_idx += 1
+
+        return self.cl_idx - 1
+
+    ## stop tracking a client without closing it
+    ## returns the socket and unparsed data
+    def detach_client(self, cl_id):
+        cl = self.clients.pop(cl_id)
+        cl.flush()
+
+        self.pending_send.discard(cl_id)
+        self.timers.cancel(cl_id)
+        self.selector.unregister(cl.socket)
+
+        if cl_id in self.new_clients:
+            self.new_clients.remove(cl_id)
+
+        return cl.socket, cl.buf
 
-                ## make sure it's no longer a new client
-                if cl_id in self.new_clients:
-                    self.new_clients.remove(cl_id)
+    def remove_client(self, cl_id, now=None):
+        cl = self.clients.pop(cl_id)
 
-                print(f"server: client id {cl_id} disconnected")
+        ## captured with the tick time, replays drop its last packets like we do
+        if not self.recorder is None:
+            self.recorder.record(time.time() if now is None else now, cl_id, CAPTURE_HANG if cl.hung_up else CAPTURE_DISCONNECT)
+
+        self.pending_send.discard(cl_id)
+        self.timers.cancel(cl_id)
+        try:
+            self.selector.unregister(cl.socket)
+        except (KeyError, ValueError):
+            pass
+        cl.socket.close()
+
+        ## make sure it's no longer a new client
+        if cl_id in self.new_clients:
+            self.new_clients.remove(cl_id)
+        if cl.hung_up and self.track_hung_up:
+            self.hung_up_clients.add(cl_id)
+
+        if self.track_removed:
+            self.removed_clients.append(cl_id)
+
+        log.info("server: client id %d disconnected", cl_id)
+
+    ## sends queued data, one send call per client no matter how many packets
+    def flush(self):
+        for cl_id in list(self.pending_send):
+            cl = self.clients.get(cl_id)
+            if cl is None or cl.flush() or not cl.connected:
+                self.pending_send.discard(cl_id)
+
+    ## accept waiting connections, at most accept_budget per tick
+    def accept_clients(self, now):
+        for i in range(self.accept_budget):
+            try:
+                conn,addr = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                ## out of file descriptors etc., try again next tick
+                log.warning("server: accept error %s", e)
+                return
+
+            ## server full, hang up right away
+            if len(self.clients) >= self.max_clients:
+                try:
+                    conn.setblocking(False)
+                    conn.send(make_packet(PACKET_HANG, B_EMPTY))
+                except OSError:
+                    pass
+                conn.close()
+                continue
+
+            self.add_client(conn, now=now)
+
+    ## timeout: how long to wait for socket activity
+    ## now: time of the tick, the owner's when it has one
+    def update(self, timeout=0, now=None):
+        if not self.running:
+            return
+        
+        if now is None:
+            now = time.time()
+
+        ## what didn't fit into the sockets last tick
+        self.flush()
 
         ## return client updates as a dict
+        ## only clients that sent something are in it
         d_updates = {}
-        for i in self.clients:
-            update = self.clients[i].update()
-            if not update is None:
-                d_updates[i] = update
+        dead = []
+        accept = False
+
+        for key,mask in self.selector.select(timeout):
+            ## listening socket
+            if key.data is None:
+                accept = True
+                continue
+
+            if key.data is WATCHED_SOCKET:
+                continue
+
+            cl_id = key.data
+            if not cl_id in self.clients:
+                continue
+            
+            update = self.clients[cl_id].receive(now)
+            if update is None:
+                dead.append(cl_id)
+            elif len(update) > 0:
+                d_updates[cl_id] = update
+
+        ## pings and timeouts
+        for cl_id in self.timers.advance(now):
+            if not cl_id in self.clients:
+                continue
+            
+            deadline = self.clients[cl_id].check_timers(now)
+            if deadline is None:
+                dead.append(cl_id)
+            else:
+                self.timers.schedule(cl_id, deadline)
+
+        ## remove clients that are not connected
+        for cl_id in dead:
+            if cl_id in self.clients:
+                self.remove_client(cl_id, now)
+                d_updates.pop(cl_id, None)
+
+        ## after the removals, a client that hung up this tick already closed
+        ## its socket and a new connection can get the same descriptor
+        if accept:
+            self.accept_clients(now)
 
         return d_updates
 
+## a part of a Server's clients with the same API as Server
+## lets many game rooms share one Server (one selector, one timer wheel)
+## the owner of the Server feeds it packets and removals
+class ClientGroup(ClientContainer):
+    def __init__(self, server):
+        ClientContainer.__init__(self)
+
+        self.server = server
+        self.running = True
+
+        ## Server client id -> id in this group
+        self.local_ids = {}
+        self.updates = {}
+
+        self.cl_idx = 0
+
+    def add(self, server_cl_id):
+        self.clients[self.cl_idx] = self.server.get_client(server_cl_id)
+        self.local_ids[server_cl_id] = self.cl_idx
+        self.new_clients.append(self.cl_idx)
+
+        self.cl_idx += 1
+
+        return self.cl_idx - 1
+
+    ## the client was removed from the Server
+    def discard(self, server_cl_id):
+        cl_id = self.local_ids.pop(server_cl_id, None)
+        if cl_id is None:
+            return
+
+        cl = self.clients.pop(cl_id)
+        self.updates.pop(cl_id, None)
+
+        if cl_id in self.new_clients:
+            self.new_clients.remove(cl_id)
+        if cl.hung_up:
+            self.hung_up_clients.add(cl_id)
+
+        log.info("group: client id %d disconnected", cl_id)
+
+    def push(self, server_cl_id, packets):
+        cl_id = self.local_ids.get(server_cl_id)
+        if not cl_id is None:
+            self.updates.setdefault(cl_id, []).extend(packets)
+
+    def flush(self):
+        self.server.flush()
+
+    def stop(self):
+        self.running = False
+
+        for server_cl_id in list(self.local_ids.keys()):
+            self.server.get_client(server_cl_id)._disconnect()
+            self.server.remove_client(server_cl_id)
+
+    ## now: unused, the Server's owner already ran it
+    def update(self, now=None):
+        if not self.running:
+            return
+        
+        tmp = self.updates
+        self.updates = {}
+        return tmp
+
 ##s = Server(("127.0.0.1", 1337))
 ##c = Client.new_connection(("127.0.0.1", 1337))
 
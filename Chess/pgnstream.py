@@ -0,0 +1,217 @@
+import chess
+import chess.pgn
+import io
+import itertools
+import multiprocessing
+import re
+import sys
+import time
+from archive import ArchiveWriter
+from log import get_logger
+from ratings import get_archive_files
+
+## streaming PGN import and export
+## a multi-game file is cut into the text of one game at a time without
+## parsing, headers are matched on that text and only the games that pass
+## get parsed, in this process or over a pool in batches of STREAM_BATCH
+## games, so memory stays at about a batch whatever the size of the file
+##
+## a parsed game is (headers, start FEN or None, moves), which is all the
+## archive keeps, and is cheap to send back from a pool worker
+
+STREAM_BATCH = 1000             ## games handed to the pool at once
+STREAM_CHUNKSIZE = 50           ## games per pool task
+
+HEADER_RE = re.compile(r'^\[(\w+)\s+"(.*)"\]\s*$')
+
+log = get_logger("pgnstream")
+
+## whether a {} comment is still open after a movetext line
+## comments don't nest, and outside of one ";" comments out the rest of the line
+def scan_comment(line, comment):
+    pos = 0
+    while True:
+        if comment:
+            end = line.find("}", pos)
+            if end < 0:
+                return True
+            comment = False
+            pos = end + 1
+        else:
+            start = line.find("{", pos)
+            if start < 0:
+                return False
+            semicolon = line.find(";", pos)
+            if 0 <= semicolon < start:
+                return False
+            comment = True
+            pos = start + 1
+
+## text of every game in a PGN stream
+## a comment left open is closed by a blank line followed by a tag line, so a
+## stray brace costs at most its own game, not the rest of the file
+def iter_game_texts(f):
+    lines = []
+    in_moves = False
+    ## inside a {} comment, a comment line can start with "["
+    comment = False
+    blank = False
+
+    for line in f:
+        if line.startswith("[") and in_moves:
+            if comment and blank:
+                log.warning("comment not closed before line %r, game ends there", line.strip())
+                comment = False
+            if not comment:
+                yield "".join(lines)
+                lines = []
+                in_moves = False
+
+        if not line.startswith("[") and line.strip():
+            in_moves = True
+        ## "%" lines are escaped, not movetext
+        if in_moves and (comment or "{" in line and not line.startswith("%")):
+            comment = scan_comment(line, comment)
+        blank = not line.strip()
+
+        lines.append(line)
+
+    if any(line.strip() for line in lines):
+        yield "".join(lines)
+
+## headers of a game text, read off its tag lines
+def read_text_headers(text):
+    headers = {}
+    for line in text.splitlines():
+        if not line.startswith("["):
+            if line.strip():
+                break
+            continue
+
+        match = HEADER_RE.match(line)
+        if match:
+            headers[match.group(1)] = match.group(2).replace('\\"', '"')
+
+    return headers
+
+## filters: header -> value, or -> list of values, every header has to match
+def match_headers(headers, filters):
+    for key,value in filters.items():
+        if type(value) == list:
+            if not headers.get(key) in value:
+                return False
+        elif headers.get(key) != value:
+            return False
+
+    return True
+
+## (headers, start FEN or None, moves) of a game text, None if it has no game
+def parse_game_text(text):
+    game = chess.pgn.read_game(io.StringIO(text))
+    if game is None:
+        return None
+
+    board = game.board()
+    fen = board.fen()
+    return dict(game.headers), None if fen == chess.STARTING_FEN else fen, list(game.mainline_moves())
+
+## game texts of every file in paths, "-" being stdin, that match filters
+def iter_filtered_texts(paths, filters=None):
+    for path in paths:
+        f = sys.stdin if path == "-" else open(path, encoding="utf-8-sig", errors="replace")
+        for text in iter_game_texts(f):
+            if not filters or match_headers(read_text_headers(text), filters):
+                yield text
+        if not f is sys.stdin:
+            f.close()
+
+## parsed games of every file in paths that match filters, in file order
+## processes: None parses here, otherwise the size of the pool
+def stream_games(paths, filters=None, processes=None):
+    texts = iter_filtered_texts(paths, filters)
+
+    if processes is None:
+        for text in texts:
+            game = parse_game_text(text)
+            if not game is None:
+                yield game
+        return
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        ## a batch at a time, imap would read the whole stream ahead
+        while True:
+            batch = list(itertools.islice(texts, STREAM_BATCH))
+            if not batch:
+                break
+
+            for game in pool.imap(parse_game_text, batch, STREAM_CHUNKSIZE):
+                if not game is None:
+                    yield game
+    finally:
+        pool.terminate()
+        pool.join()
+
+## games of the PGN files into a packed archive, returns the number of games
+def import_pgn(paths, out_path, filters=None, processes=None):
+    writer = ArchiveWriter(out_path)
+    games = 0
+    for headers,fen,moves in stream_games(paths, filters, processes):
+        writer.add(headers, moves, fen)
+        games += 1
+    writer.close()
+
+    return games
+
+## the match archive as one PGN stream, games are copied, not parsed
+## out_path "-" writes to stdout, returns the number of games
+def export_matches(match_dir, out_path, filters=None):
+    out = sys.stdout if out_path == "-" else open(out_path, "w", encoding="utf-8")
+    games = 0
+    for text in iter_filtered_texts(get_archive_files(match_dir), filters):
+        out.write(text.strip() + "\n\n")
+        games += 1
+    if not out is sys.stdout:
+        out.close()
+
+    return games
+
+## Header=value arguments as filters, a header given twice takes either value
+def parse_filters(args):
+    filters = {}
+    for arg in args:
+        key,value = arg.split("=", 1)
+        if key in filters:
+            if type(filters[key]) != list:
+                filters[key] = [filters[key]]
+            filters[key].append(value)
+        else:
+            filters[key] = value
+
+    return filters
+
+## usage: pgnstream.py import in.pgn [out.arc] [processes] [Header=value ...]
+##        pgnstream.py export [match dir] [out.pgn] [Header=value ...]
+## in.pgn and out.pgn can be - for stdin and stdout
+if __name__ == "__main__":
+    ## stdout can be the PGN
+    log.buffer.stream = sys.stderr
+
+    filters = parse_filters([arg for arg in sys.argv[2:] if "=" in arg])
+    args = [arg for arg in sys.argv[2:] if not "=" in arg]
+
+    if len(sys.argv) > 1 and sys.argv[1] == "import":
+        out_path = args[1] if len(args) > 1 else "./import.arc"
+        processes = int(args[2]) if len(args) > 2 else None
+
+        t = time.perf_counter()
+        n = import_pgn([args[0]], out_path, filters, processes)
+        elapsed = time.perf_counter() - t
+        print(f"pgnstream: imported {n} games into {out_path} in {elapsed:.2f}s ({n / max(elapsed, 0.000001):.0f} games/s)", file=sys.stderr)
+
+    elif len(sys.argv) > 1 and sys.argv[1] == "export":
+        match_dir = args[0] if len(args) > 0 else "./matches/"
+        out_path = args[1] if len(args) > 1 else "./matches.pgn"
+
+        n = export_matches(match_dir, out_path, filters)
+        print(f"pgnstream: exported {n} games to {out_path}", file=sys.stderr)
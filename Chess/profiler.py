@@ -0,0 +1,176 @@
+import collections
+import cProfile
+import os
+import pstats
+import sys
+import time
+from log import get_logger
+
+## main loop instrumentation
+## the loop calls mark(section) after each part of a tick, the time since
+## the previous mark goes to that section, and end_frame() closes the tick
+## the last PROFILE_WINDOW ticks are kept for averages and the histogram
+
+PROFILE_WINDOW = 240            ## ticks kept, 4s at 60fps
+PROFILE_LOG_INTERVAL = 10       ## seconds between stats lines in headless mode
+PROFILE_DIR = "./profiles/"
+
+## histogram bucket upper bounds in ms, the last bucket takes the rest
+HISTOGRAM_BUCKETS = [2, 4, 8, 17, 33, 50, 100]
+
+FRAME_SECTION = "frame"
+
+class FrameProfiler:
+    def __init__(self, window=PROFILE_WINDOW):
+        self.window = window
+
+        ## section -> seconds of the last ticks, in order of first use
+        self.sections = collections.OrderedDict()
+        self.frames = collections.deque(maxlen=window)
+
+        ## counter -> values of the last ticks (packets per frame, ...)
+        self.counters = collections.OrderedDict()
+
+        ## sections passed and counts of the tick in progress
+        self.frame_sections = set()
+        self.frame_counts = {}
+
+        self.frame_start = time.perf_counter()
+        self.last_mark = self.frame_start
+
+    def begin_frame(self):
+        self.frame_start = time.perf_counter()
+        self.last_mark = self.frame_start
+
+    def mark(self, section):
+        now = time.perf_counter()
+        times = self.sections.get(section)
+        if times is None:
+            times = self.sections[section] = collections.deque(maxlen=self.window)
+
+        ## a section can be passed more than once a tick
+        if section in self.frame_sections:
+            times[-1] += now - self.last_mark
+        else:
+            times.append(now - self.last_mark)
+            self.frame_sections.add(section)
+
+        self.last_mark = now
+
+    def count(self, counter, n=1):
+        self.frame_counts[counter] = self.frame_counts.get(counter, 0) + n
+
+    def end_frame(self):
+        self.frames.append(time.perf_counter() - self.frame_start)
+
+        ## sections not passed this tick took no time, so the averages are per tick
+        for section,times in self.sections.items():
+            if not section in self.frame_sections:
+                times.append(0)
+
+        for counter in self.frame_counts:
+            if not counter in self.counters:
+                self.counters[counter] = collections.deque(maxlen=self.window)
+
+        ## counters not touched this tick count as 0
+        for counter,values in self.counters.items():
+            values.append(self.frame_counts.get(counter, 0))
+
+        self.frame_sections = set()
+        self.frame_counts = {}
+        self.begin_frame()
+
+    ## section -> (avg, p95, max) in ms over the window, the whole tick as FRAME_SECTION
+    ## sections that didn't run within the window are left out
+    def get_stats(self):
+        stats = collections.OrderedDict()
+        for section,times in [(FRAME_SECTION, self.frames)] + list(self.sections.items()):
+            ordered = sorted(times)
+            if ordered and ordered[-1] > 0:
+                stats[section] = (sum(times) / len(times) * 1000, ordered[int(len(ordered) * 0.95)] * 1000, ordered[-1] * 1000)
+
+        return stats
+
+    ## counter -> average per tick
+    def get_counters(self):
+        return collections.OrderedDict((counter, sum(values) / len(values)) for counter,values in self.counters.items() if values)
+
+    ## tick counts per HISTOGRAM_BUCKETS bucket
+    def get_histogram(self):
+        histogram = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        for t in self.frames:
+            ms = t * 1000
+            i = 0
+            while i < len(HISTOGRAM_BUCKETS) and ms > HISTOGRAM_BUCKETS[i]:
+                i += 1
+            histogram[i] += 1
+
+        return histogram
+
+    def format_stats(self):
+        lines = [f"{section:10} avg {avg:6.2f}ms p95 {p95:6.2f}ms max {top:6.2f}ms" for section,(avg, p95, top) in self.get_stats().items()]
+        counters = self.get_counters()
+        if counters:
+            lines.append("  ".join(f"{counter} {value:.1f}/tick" for counter,value in counters.items()))
+
+        return lines
+
+## cProfile of the next seconds, written to PROFILE_DIR as .prof (pstats/snakeviz)
+class ProfileCapture:
+    def __init__(self, out_dir=PROFILE_DIR):
+        self.out_dir = out_dir
+        self.profile = None
+        self.end = 0
+
+        ## path of the last finished capture
+        self.last_path = None
+
+    def is_running(self):
+        return not self.profile is None
+
+    def start(self, seconds):
+        if self.is_running():
+            return
+
+        self.end = time.time() + seconds
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    ## stops and writes the capture once the time is up, returns its path then
+    def update(self):
+        if not self.is_running() or time.time() < self.end:
+            return None
+
+        self.profile.disable()
+
+        os.makedirs(self.out_dir, exist_ok=True)
+        self.last_path = os.path.join(self.out_dir, time.strftime("profile_%Y-%m-%d_%H-%M-%S.prof"))
+        self.profile.dump_stats(self.last_path)
+        self.profile = None
+
+        return self.last_path
+
+## the top functions of a capture by cumulative time
+def print_capture(path, lines=20):
+    pstats.Stats(path).sort_stats("cumulative").print_stats(lines)
+
+## stats lines every PROFILE_LOG_INTERVAL for loops without a screen
+class ProfileLogger:
+    def __init__(self, profiler, name, interval=PROFILE_LOG_INTERVAL):
+        self.profiler = profiler
+        self.log = get_logger(name)
+        self.interval = interval
+        self.last_log = time.time()
+
+    def update(self):
+        now = time.time()
+        if now - self.last_log < self.interval:
+            return
+        self.last_log = now
+
+        for line in self.profiler.format_stats():
+            self.log.info(line)
+
+## usage: profiler.py capture.prof [lines]
+if __name__ == "__main__":
+    print_capture(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 20)
@@ -0,0 +1,275 @@
+import chess.pgn
+import itertools
+import math
+import os
+import sys
+import time
+import numpy as np
+
+## Elo and Glicko-2 ratings
+## games are added one by one as they finish, or the whole archive gets
+## recomputed in rating periods, each period is one set of array operations
+
+DEFAULT_RATING = 1500
+ELO_K = 20
+
+GLICKO_SCALE = 173.7178
+GLICKO_RD = 350
+GLICKO_VOLATILITY = 0.06
+GLICKO_TAU = 0.5
+GLICKO_EPSILON = 0.000001
+GLICKO_MAX_ITERATIONS = 100
+
+RATING_PERIOD_GAMES = 10000     ## games per rating period when recomputing
+
+RESULT_SCORES = {"1-0": 1.0, "0-1": 0.0, "1/2-1/2": 0.5}
+
+def elo_expected(rating, opponent_rating):
+    return 1 / (1 + 10 ** ((opponent_rating - rating) / 400))
+
+def glicko_g(phi):
+    return 1 / np.sqrt(1 + 3 * phi**2 / math.pi**2)
+
+## volatility update (Illinois algorithm), for all players at once
+def glicko_volatility(phi, sigma, v, delta):
+    a = np.log(sigma**2)
+
+    def f(x):
+        ex = np.exp(x)
+        return ex * (delta**2 - phi**2 - v - ex) / (2 * (phi**2 + v + ex)**2) - (x - a) / GLICKO_TAU**2
+
+    A = a.copy()
+    big = delta**2 > phi**2 + v
+    B = np.where(big, np.log(np.maximum(delta**2 - phi**2 - v, GLICKO_EPSILON)), a - GLICKO_TAU)
+
+    ## bracket the root
+    k = np.ones(len(a))
+    small = ~big & (f(B) < 0)
+    while small.any():
+        k[small] += 1
+        B[small] = a[small] - k[small] * GLICKO_TAU
+        small &= f(B) < 0
+
+    fA = f(A)
+    fB = f(B)
+    for i in range(GLICKO_MAX_ITERATIONS):
+        todo = np.abs(B - A) > GLICKO_EPSILON
+        if not todo.any():
+            break
+
+        C = A + (A - B) * fA / (fB - fA)
+        fC = f(C)
+
+        swap = todo & (fC * fB <= 0)
+        halve = todo & ~swap
+        A = np.where(swap, B, A)
+        fA = np.where(swap, fB, np.where(halve, fA / 2, fA))
+        B = np.where(todo, C, B)
+        fB = np.where(todo, fC, fB)
+
+    return np.exp(A / 2)
+
+class RatingBook:
+    def __init__(self, capacity=64):
+        self.nicks = []
+        self.index = {}
+
+        self.elo = np.full(capacity, DEFAULT_RATING, dtype=np.float64)
+        ## glicko-2 internal scale
+        self.mu = np.zeros(capacity)
+        self.phi = np.full(capacity, GLICKO_RD / GLICKO_SCALE)
+        self.sigma = np.full(capacity, GLICKO_VOLATILITY)
+        self.games = np.zeros(capacity, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.nicks)
+
+    def _grow(self, capacity):
+        old = len(self.elo)
+
+        self.elo = np.resize(self.elo, capacity)
+        self.mu = np.resize(self.mu, capacity)
+        self.phi = np.resize(self.phi, capacity)
+        self.sigma = np.resize(self.sigma, capacity)
+        self.games = np.resize(self.games, capacity)
+
+        self.elo[old:] = DEFAULT_RATING
+        self.mu[old:] = 0
+        self.phi[old:] = GLICKO_RD / GLICKO_SCALE
+        self.sigma[old:] = GLICKO_VOLATILITY
+        self.games[old:] = 0
+
+    def get_index(self, nick):
+        idx = self.index.get(nick)
+        if idx is None:
+            idx = len(self.nicks)
+            if idx >= len(self.elo):
+                self._grow(len(self.elo) * 2)
+
+            self.nicks.append(nick)
+            self.index[nick] = idx
+
+        return idx
+
+    ## glicko-2 rating, used for matchmaking
+    def get_rating(self, nick):
+        idx = self.index.get(nick)
+        if idx is None:
+            return DEFAULT_RATING
+        return float(self.mu[idx] * GLICKO_SCALE + DEFAULT_RATING)
+
+    def get_elo(self, nick):
+        idx = self.index.get(nick)
+        if idx is None:
+            return DEFAULT_RATING
+        return float(self.elo[idx])
+
+    ## (nick, rating, rd, elo, games), best first
+    def get_table(self):
+        n = len(self.nicks)
+        order = np.argsort(-self.mu[:n])
+
+        return [(self.nicks[i], float(self.mu[i] * GLICKO_SCALE + DEFAULT_RATING), float(self.phi[i] * GLICKO_SCALE), float(self.elo[i]), int(self.games[i])) for i in order]
+
+    ## one rating period, white/black are index arrays, score is white's score
+    ## inactive: also apply the rating deviation increase to players without games
+    def rate_period(self, white, black, score, inactive=True):
+        n = len(self.nicks)
+
+        ## every game twice, once from each side
+        player = np.concatenate([white, black])
+        opponent = np.concatenate([black, white])
+        s = np.concatenate([score, 1 - score])
+
+        ## elo, everybody against their pre-period rating
+        expected = elo_expected(self.elo[player], self.elo[opponent])
+        self.elo[:n] += ELO_K * np.bincount(player, s - expected, minlength=n)
+
+        ## glicko-2
+        g = glicko_g(self.phi[opponent])
+        E = 1 / (1 + np.exp(-g * (self.mu[player] - self.mu[opponent])))
+
+        played = np.unique(player)
+        v = 1 / np.bincount(player, g * g * E * (1 - E), minlength=n)[played]
+        delta_sum = np.bincount(player, g * (s - E), minlength=n)[played]
+        delta = v * delta_sum
+
+        phi = self.phi[played]
+        sigma = glicko_volatility(phi, self.sigma[played], v, delta)
+
+        if inactive:
+            idle = np.ones(n, dtype=bool)
+            idle[played] = False
+            self.phi[:n][idle] = np.sqrt(self.phi[:n][idle]**2 + self.sigma[:n][idle]**2)
+
+        phi_star = np.sqrt(phi**2 + sigma**2)
+        new_phi = 1 / np.sqrt(1 / phi_star**2 + 1 / v)
+
+        self.mu[played] += new_phi**2 * delta_sum
+        self.phi[played] = new_phi
+        self.sigma[played] = sigma
+
+        self.games[:n] += np.bincount(player, minlength=n)
+
+    ## a finished game, rated right away
+    def add_game(self, white_nick, black_nick, result):
+        if not result in RESULT_SCORES:
+            return
+
+        white = self.get_index(white_nick)
+        black = self.get_index(black_nick)
+
+        self.rate_period(np.array([white]), np.array([black]), np.array([RESULT_SCORES[result]]), inactive=False)
+
+    ## results: iterable of (white, black, result) in the order they were played
+    def recompute(self, results, period_games=RATING_PERIOD_GAMES):
+        results = iter(results)
+        num_games = 0
+
+        while True:
+            period = list(itertools.islice(results, period_games))
+            if len(period) == 0:
+                break
+
+            white = np.empty(len(period), dtype=np.int64)
+            black = np.empty(len(period), dtype=np.int64)
+            score = np.empty(len(period))
+            i = 0
+            for white_nick,black_nick,result in period:
+                if not result in RESULT_SCORES:
+                    continue
+
+                white[i] = self.get_index(white_nick)
+                black[i] = self.get_index(black_nick)
+                score[i] = RESULT_SCORES[result]
+                i += 1
+
+            if i > 0:
+                self.rate_period(white[:i], black[:i], score[:i])
+            num_games += i
+
+        return num_games
+
+    @staticmethod
+    def from_archive(match_dir):
+        book = RatingBook()
+        book.recompute(read_archive_results(match_dir))
+
+        return book
+
+## match files sorted by the date in their name (nick_nick_date_time.pgn)
+def get_archive_files(match_dir):
+    if not os.path.exists(match_dir):
+        return []
+
+    files = [f for f in os.listdir(match_dir) if f.endswith(".pgn")]
+    files.sort(key=lambda f: f[:-4].rsplit("_", 2)[-2:])
+
+    return [os.path.join(match_dir, f) for f in files]
+
+## (white, black, result) of every game in the archive, headers only
+def read_archive_results(match_dir):
+    for path in get_archive_files(match_dir):
+        f = open(path, encoding="utf-8")
+        while True:
+            headers = chess.pgn.read_headers(f)
+            if headers is None:
+                break
+
+            yield headers.get("White", "?"), headers.get("Black", "?"), headers.get("Result", "*")
+        f.close()
+
+def random_results(num_games, num_players):
+    rng = np.random.default_rng(0)
+    players = rng.integers(0, num_players, size=(num_games, 2))
+    results = rng.choice(list(RESULT_SCORES.keys()), size=num_games)
+
+    for (white,black),result in zip(players, results):
+        if white != black:
+            yield f"player{white}", f"player{black}", str(result)
+
+## usage: ratings.py [match dir]
+##        ratings.py bench [games] [players]
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        num_games = int(sys.argv[2]) if len(sys.argv) > 2 else 500000
+        num_players = int(sys.argv[3]) if len(sys.argv) > 3 else 5000
+
+        results = list(random_results(num_games, num_players))
+
+        t = time.perf_counter()
+        book = RatingBook()
+        n = book.recompute(results)
+        elapsed = time.perf_counter() - t
+        print(f"ratings: recomputed {n} games of {len(book)} players in {elapsed:.2f}s ({n / elapsed:.0f} games/s)")
+
+    else:
+        match_dir = sys.argv[1] if len(sys.argv) > 1 else "./matches/"
+
+        t = time.perf_counter()
+        book = RatingBook()
+        n = book.recompute(read_archive_results(match_dir))
+        print(f"ratings: {n} games in {time.perf_counter() - t:.2f}s")
+
+        for nick,rating,rd,elo,games in book.get_table():
+            print(f"{nick:25} {rating:7.1f} +-{rd:5.1f}   elo {elo:7.1f}   {games} games")
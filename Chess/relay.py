@@ -0,0 +1,325 @@
+import multiprocessing
+import selectors
+import socket
+import struct
+import sys
+import time
+from networking import make_packet, Client, Server, PACKET_PING, PACKET_HANG, PING_INTERVAL
+from chessserver import *
+from bots import Bot
+from log import get_logger, trace_on_signal, flush_logs
+
+## relay node
+## connects to a game server (or another relay) as a privileged spectator
+## and serves the same protocol to its own spectators, so relays can be
+## chained into a tree and the game server only sends every packet once
+## per relay instead of once per spectator
+## every upstream packet is encoded once and queued for all downstream clients
+## the upstream only gives a relay its bigger send queue with the relay key
+## (CHESS_RELAY_KEY in the environment of both, see chessserver.RELAY_KEY)
+
+RELAY_TICK_WAIT = 0.005         ## max wait for socket activity per tick
+
+BENCH_MOVE_INTERVAL = 0.05      ## seconds between bot moves in the latency bench
+TEST_PLIES = 40                 ## moves played in the fan-out test
+TEST_TIMEOUT = 20.0             ## seconds until the fan-out test gives up
+
+log = get_logger("relay")
+
+class Relay:
+    ## upstream: (ip, port) of the server or relay to watch
+    ## addr: (ip, port) to serve spectators on
+    ## room: room to watch on a sharded upstream
+    ## key: relay key the upstream trusts, None for none
+    def __init__(self, upstream, addr, room=None, key=RELAY_KEY):
+        self.upstream = Client.new_connection(upstream)
+
+        ## sharded servers place us by room, see shards.py
+        if not room is None:
+            self.upstream.send(make_packet(PACKET_JOIN_ROOM, write_utf8_string(room)))
+        self.upstream.send(make_packet(PACKET_SPECTATE, bytes([1]) + (key or b"")))
+
+        self.server = Server(addr, rate_limits=RATE_LIMITS)
+        ## upstream data wakes up the tick
+        self.server.watch(self.upstream.socket)
+
+        self.running = True
+
+        ## latest state, what a new spectator needs
+        self.status = STATUS_WAITING_FOR_PLAYERS
+        self.player_info = {}       ## idx -> packet
+        self.board = None
+        self.move_info = None
+        self.taken_info = None
+        self.outcome = None
+        ## last clock payload and when it came
+        self.clock = None
+        self.clock_received = 0
+
+    ## the clock as it is now, the running side counted down since it came
+    def clock_packet(self, now):
+        white,black,running = struct.unpack(CLOCK_FORMAT, self.clock)
+        times = [white, black]
+        if running >= 0:
+            times[running] = max(0, times[running] - int((now - self.clock_received) * 1000))
+
+        return make_packet(PACKET_CLOCK, struct.pack(CLOCK_FORMAT, times[0], times[1], running))
+
+    def send_snapshot(self, cl_idx):
+        client = self.server.get_client(cl_idx)
+
+        client._send(make_packet(PACKET_STATUS, bytes([self.status])))
+        for idx in sorted(self.player_info.keys()):
+            client._send(self.player_info[idx])
+
+        client._send(make_packet(PACKET_SIDE, bytes([SIDE_SPECTATOR])))
+
+        for packet in [self.board, self.move_info, self.taken_info, self.outcome]:
+            if not packet is None:
+                client._send(packet)
+
+        if not self.clock is None:
+            client._send(self.clock_packet(time.time()))
+
+    ## remember the state and pass the packet on
+    def forward(self, p_id, payload):
+        ## our own side, downstream everybody is a spectator
+        ## pings are between us and upstream, downstream gets its own
+        if p_id in [PACKET_SIDE, PACKET_PING, PACKET_HANG]:
+            return
+
+        packet = make_packet(p_id, payload)
+
+        if p_id == PACKET_STATUS:
+            self.status = payload[0]
+
+        if p_id == PACKET_PLAYER_INFO:
+            self.player_info[payload[0]] = packet
+
+        if p_id == PACKET_BOARD:
+            self.board = packet
+            ## the move and capture info comes after the board
+            self.move_info = None
+            self.taken_info = None
+
+        if p_id == PACKET_CLIENT_MOVE_INFO:
+            self.move_info = packet
+
+        if p_id == PACKET_CLIENT_TAKEN_INFO:
+            self.taken_info = packet
+
+        if p_id == PACKET_GAME_OUTCOME:
+            self.outcome = packet
+
+        if p_id == PACKET_CLOCK:
+            self.clock = payload
+            self.clock_received = time.time()
+
+        self.server.broadcast(packet)
+
+    def update(self, timeout=RELAY_TICK_WAIT):
+        if not self.running:
+            return
+
+        ## spectators have nothing to say, their packets are dropped
+        self.server.update(timeout=timeout)
+
+        for cl_idx in self.server.get_new_clients():
+            self.send_snapshot(cl_idx)
+
+        packets = self.upstream.update()
+        if packets is None:
+            log.info("upstream gone")
+            self.forward(PACKET_STATUS, bytes([STATUS_SERVER_STOPPED]))
+            self.server.flush()
+            self.stop()
+            return
+
+        for p_id,payload in packets:
+            self.forward(p_id, payload)
+
+        self.server.flush()
+
+    def stop(self):
+        self.running = False
+
+        self.server.unwatch(self.upstream.socket)
+        if self.upstream.connected:
+            self.upstream.disconnect()
+        self.server.stop()
+
+def relay_main(upstream, addr, room=None):
+    trace_on_signal()
+
+    relay = Relay(upstream, addr, room)
+    try:
+        while relay.running:
+            relay.update()
+    except KeyboardInterrupt:
+        relay.stop()
+    flush_logs()
+
+## game server with two bots moving every BENCH_MOVE_INTERVAL, for the bench
+def bench_server(port, delay):
+    game = ChessServer("127.0.0.1", port)
+
+    bots = None
+    start = time.time() + delay
+    last_move = 0
+    while game.status != STATUS_GAME_ENDED:
+        game.update()
+
+        now = time.time()
+        if bots is None and now > start:
+            bots = [Bot("127.0.0.1", port, nick=f"bot{i}") for i in range(2)]
+
+        if not bots is None and now - last_move > BENCH_MOVE_INTERVAL:
+            last_move = now
+            for bot in bots:
+                bot.update()
+
+        time.sleep(0.001)
+
+    ## let the outcome get through
+    end = time.time() + 1
+    while time.time() < end:
+        game.update()
+        time.sleep(0.001)
+    game.stop()
+
+## added latency per hop, server -> relay -> relay, all on localhost
+## a spectator on every tier notes when each board arrives
+def bench(port, tiers):
+    processes = [multiprocessing.Process(target=bench_server, args=(port, 1.0 + tiers * 0.5), daemon=True)]
+    for i in range(tiers):
+        processes.append(multiprocessing.Process(target=relay_main, args=(("127.0.0.1", port + i), ("127.0.0.1", port + i + 1)), daemon=True))
+
+    for process in processes:
+        process.start()
+        time.sleep(0.3)
+
+    selector = selectors.DefaultSelector()
+    probes = []
+    for i in range(tiers + 1):
+        probe = ChessClient("127.0.0.1", port + i, nick=f"probe{i}", spectate=True)
+        selector.register(probe._client.socket, selectors.EVENT_READ, i)
+        probes.append(probe)
+
+    ## board -> arrival time on each tier
+    arrivals = {}
+    finished = set()
+    while len(finished) < len(probes):
+        for key,mask in selector.select(0.1):
+            packets = probes[key.data].update()
+            if packets is None:
+                finished.add(key.data)
+                selector.unregister(key.fileobj)
+                continue
+
+            now = time.perf_counter()
+            for p_id,payload in packets:
+                if p_id == PACKET_BOARD:
+                    arrivals.setdefault(payload, [None] * len(probes))[key.data] = now
+
+                if p_id == PACKET_STATUS and payload[0] in [STATUS_GAME_ENDED, STATUS_SERVER_STOPPED]:
+                    finished.add(key.data)
+
+    for process in processes:
+        process.join(2)
+        if process.is_alive():
+            process.terminate()
+
+    complete = [times for times in arrivals.values() if not None in times]
+    print(f"relay: {len(complete)} boards seen on all {tiers + 1} tiers")
+    for i in range(1, tiers + 1):
+        hop = sorted([(times[i] - times[i - 1]) * 1000 for times in complete])
+        if hop:
+            print(f"relay: hop {i} adds {sum(hop) / len(hop):.3f}ms avg, p50 {hop[len(hop) // 2]:.3f}ms, max {hop[-1]:.3f}ms")
+
+## fan-out over loopback in one process: a game server, a relay and
+## spectators of the relay, two bots play TEST_PLIES moves
+## every spectator has to see the same boards, ending with the server's, and
+## no pings but the relay's own, returns True if so
+def fanout_test(port, num_spectators):
+    game = ChessServer("127.0.0.1", port)
+    game.save_matches = False
+    relay = Relay(("127.0.0.1", port), ("127.0.0.1", port + 1))
+
+    spectators = [ChessClient("127.0.0.1", port + 1, nick=f"spectator{i}", spectate=True) for i in range(num_spectators)]
+    boards = [[] for spectator in spectators]
+    pings = [0] * num_spectators
+    bots = None
+
+    start = time.time()
+    done = None
+    while time.time() - start < TEST_TIMEOUT:
+        game.update()
+        relay.update(timeout=0)
+
+        ## the bots come once every spectator is there
+        if bots is None and relay.server.get_num_clients() == num_spectators:
+            bots = [Bot("127.0.0.1", port, nick=f"bot{i}") for i in range(2)]
+        if not bots is None and done is None:
+            for bot in bots:
+                bot.update()
+            if len(game.moves) >= TEST_PLIES or game.status != STATUS_PLAYING and len(game.moves) > 0:
+                done = time.time()
+
+        for i,spectator in enumerate(spectators):
+            for p_id,payload in spectator.update() or []:
+                if p_id == PACKET_BOARD:
+                    boards[i].append(read_utf8_string(payload[1:]))
+                if p_id == PACKET_PING:
+                    pings[i] += 1
+
+        ## what is on the wire gets through
+        if not done is None and time.time() - done > 0.5:
+            break
+        time.sleep(0.001)
+
+    elapsed = time.time() - start
+    final = game.game_board.epd()
+
+    relay.stop()
+    game.stop()
+
+    ## a request of the relay and the answer to our own, per interval
+    max_pings = 2 * (1 + int(elapsed // PING_INTERVAL))
+
+    ok = done is not None
+    for i in range(num_spectators):
+        if boards[i] != boards[0] or not boards[i] or boards[i][-1] != final:
+            log.error("spectator %d saw %d boards, ending %s, the server is at %s", i, len(boards[i]), boards[i][-1:] , final)
+            ok = False
+        if pings[i] > max_pings:
+            log.error("spectator %d got %d pings, at most %d are the relay's", i, pings[i], max_pings)
+            ok = False
+
+    print(f"relay: fan-out to {num_spectators} spectators, {len(boards[0])} boards, {'ok' if ok else 'FAILED'}")
+    return ok
+
+## usage: relay.py upstream_ip:port [port] [room]
+##        relay.py bench [tiers] [base port]
+##        relay.py test [spectators] [base port]
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        tiers = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+        port = int(sys.argv[3]) if len(sys.argv) > 3 else 14000
+        bench(port, tiers)
+
+    elif len(sys.argv) > 1 and sys.argv[1] == "test":
+        num_spectators = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+        port = int(sys.argv[3]) if len(sys.argv) > 3 else 14000
+        ok = fanout_test(port, num_spectators)
+        flush_logs()
+        sys.exit(0 if ok else 1)
+
+    else:
+        addr = sys.argv[1] if len(sys.argv) > 1 else "127.0.0.1:1337"
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else 1338
+        room = sys.argv[3] if len(sys.argv) > 3 else None
+
+        ip,upstream_port = addr.split(":")
+
+        log.info("watching %s, serving on %d", addr, port)
+        relay_main((ip, int(upstream_port)), ("0.0.0.0", port), room)
@@ -0,0 +1,192 @@
+import chess
+import multiprocessing
+import os
+import sys
+import time
+import pygame
+from navigator import load_game
+from ratings import get_archive_files
+
+## board images without a window
+## draws positions with the piece art and board colors of the game client,
+## for the match archive (thumbnails and one diagram per ply)
+## importing this doesn't open a display, run it as a script or call
+## init_headless first when there is none
+
+ASSETS_DIR = "./assets/"
+IMG_DIR = os.path.join(ASSETS_DIR, "pieces")
+
+BOARD_LIGHT = (255, 207, 159)
+BOARD_DARK = (210, 140, 69)
+LAST_MOVE_COLOR = (255, 160, 120)
+
+PIECES_FILENAME = {"R": "Vb",
+                   "N": "Jb",
+                   "B": "Sb",
+                   "Q": "Db",
+                   "K": "Kb",
+                   "P": "Pb",
+                   "r": "Vc",
+                   "n": "Jc",
+                   "b": "Sc",
+                   "q": "Dc",
+                   "k": "Kc",
+                   "p": "Pc"}
+
+LABEL_FONT = os.path.join(ASSETS_DIR, "OpenSans-ExtraBold.ttf")
+MIN_LABEL_TILE = 32             ## smaller boards get no coordinates
+
+DEFAULT_TILE_SIZE = 60
+DEFAULT_THUMBNAIL_SIZE = 160
+
+## piece art as loaded, and scaled per tile size
+## filled once per process, every board of that size only blits
+SPRITES = {}
+SCALED_SPRITES = {}             ## (symbol, tile size) -> Surface
+
+## a 1x1 window on the dummy video driver, surfaces can be converted
+## to the display format then, which makes blitting a lot faster
+def init_headless():
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    pygame.display.init()
+    pygame.font.init()
+    if pygame.display.get_surface() is None:
+        pygame.display.set_mode((1, 1))
+
+## surf in the display format, if there is a display
+def convert(surf, alpha=False):
+    if pygame.display.get_surface() is None:
+        return surf
+    return surf.convert_alpha() if alpha else surf.convert()
+
+def get_sprite(symbol, tile_size):
+    key = (symbol, tile_size)
+    surf = SCALED_SPRITES.get(key)
+    if not surf is None:
+        return surf
+
+    if not symbol in SPRITES:
+        SPRITES[symbol] = pygame.image.load(os.path.join(IMG_DIR, PIECES_FILENAME[symbol] + ".png"))
+
+    surf = SPRITES[symbol]
+    if surf.get_width() != tile_size:
+        surf = pygame.transform.smoothscale(surf, (tile_size, tile_size))
+
+    surf = convert(surf, alpha=True)
+    SCALED_SPRITES[key] = surf
+    return surf
+
+class BoardRenderer:
+    def __init__(self, tile_size=DEFAULT_TILE_SIZE, labels=True):
+        self.tile_size = tile_size
+        self.size = tile_size*8
+
+        ## empty boards, from white's and black's side
+        ## opaque, which also makes the PNGs smaller and faster to write
+        self.backgrounds = {}
+        for flipped in [False, True]:
+            surf = pygame.Surface((self.size, self.size))
+            for y in range(0, 8):
+                for x in range(0, 8):
+                    clr = BOARD_DARK if ((x+y)%2) else BOARD_LIGHT
+                    surf.fill(clr, self.get_rect(x, y))
+
+            if labels and tile_size >= MIN_LABEL_TILE:
+                self.draw_labels(surf, flipped)
+
+            self.backgrounds[flipped] = convert(surf)
+
+    def get_rect(self, x, y):
+        return pygame.Rect(x*self.tile_size, y*self.tile_size, self.tile_size, self.tile_size)
+
+    ## screen column and row of a square
+    def transform(self, square, flipped):
+        x,y = chess.square_file(square), 7 - chess.square_rank(square)
+        if flipped:
+            return 7 - x, 7 - y
+        return x, y
+
+    ## files along the bottom, ranks along the left, like the game client
+    def draw_labels(self, surf, flipped):
+        font = pygame.font.Font(LABEL_FONT, max(8, self.tile_size*14 // 60))
+        files = "ABCDEFGH"
+        for i in range(0, 8):
+            ## label color is the other square color
+            clr = BOARD_LIGHT if (i+7)%2 else BOARD_DARK
+            lb = files[7-i] if flipped else files[i]
+            lb_pos = ((i+1)*self.tile_size-font.get_height()+7, self.size-font.get_height()+3)
+            surf.blit(font.render(lb, True, clr), lb_pos)
+
+            clr = BOARD_LIGHT if i%2 else BOARD_DARK
+            lb = i+1 if flipped else 8-i
+            surf.blit(font.render(f"{lb}", True, clr), (2, i*self.tile_size))
+
+    def render(self, board, last_move=None, flipped=False):
+        surf = self.backgrounds[flipped].copy()
+
+        if not last_move is None:
+            for square in [last_move.from_square, last_move.to_square]:
+                surf.fill(LAST_MOVE_COLOR, self.get_rect(*self.transform(square, flipped)).inflate(-self.tile_size//4, -self.tile_size//4))
+
+        for square,piece in board.piece_map().items():
+            x,y = self.transform(square, flipped)
+            surf.blit(get_sprite(piece.symbol(), self.tile_size), (x*self.tile_size, y*self.tile_size))
+
+        return surf
+
+## thumbnail of the final position, and a diagram per ply when plies is set
+## out_dir/<game>.png and out_dir/<game>/<ply>.png, returns the number of images
+def render_game(path, out_dir, tile_size=DEFAULT_TILE_SIZE, thumbnail_size=DEFAULT_THUMBNAIL_SIZE, plies=True):
+    loaded = load_game(path)
+    if loaded is None:
+        return 0
+    game,navigator = loaded
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    renderer = BoardRenderer(tile_size)
+    images = 0
+
+    if plies:
+        ply_dir = os.path.join(out_dir, name)
+        os.makedirs(ply_dir, exist_ok=True)
+
+        ## the navigator steps forward one push per ply
+        for ply in range(0, len(navigator) + 1):
+            surf = renderer.render(navigator.seek(ply), navigator.get_move(ply))
+            pygame.image.save(surf, os.path.join(ply_dir, f"{ply:03d}.png"))
+            images += 1
+
+    ## thumbnails are small, their own sprite size looks better than scaling a full board down
+    thumbnail = BoardRenderer(thumbnail_size // 8, labels=False)
+    last = len(navigator)
+    surf = thumbnail.render(navigator.seek(last), navigator.get_move(last))
+    pygame.image.save(surf, os.path.join(out_dir, f"{name}.png"))
+
+    return images + 1
+
+def render_job(args):
+    return render_game(*args)
+
+## every game of the archive over a process pool, returns (games, images, seconds)
+def render_archive(match_dir, out_dir, processes=None, tile_size=DEFAULT_TILE_SIZE, thumbnail_size=DEFAULT_THUMBNAIL_SIZE, plies=True):
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = [(path, out_dir, tile_size, thumbnail_size, plies) for path in get_archive_files(match_dir)]
+
+    t = time.perf_counter()
+    pool = multiprocessing.Pool(processes, initializer=init_headless)
+    images = sum(pool.imap_unordered(render_job, jobs))
+    pool.close()
+    pool.join()
+
+    return len(jobs), images, time.perf_counter() - t
+
+## usage: renderer.py [match dir] [out dir] [processes] [tile size]
+if __name__ == "__main__":
+    match_dir = sys.argv[1] if len(sys.argv) > 1 else "./matches/"
+    out_dir = sys.argv[2] if len(sys.argv) > 2 else "./archive/"
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    tile_size = int(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_TILE_SIZE
+
+    games,images,elapsed = render_archive(match_dir, out_dir, processes, tile_size)
+    print(f"renderer: {games} games, {images} images in {elapsed:.2f}s ({images / max(elapsed, 0.000001):.1f} images/s)")
@@ -0,0 +1,510 @@
+import collections
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import sys
+import time
+from networking import make_packet, Server, ClientGroup
+from chessserver import *
+from lobby import Lobby
+from ratings import RatingBook
+from profiler import FrameProfiler, ProfileLogger
+from discovery import StatusResponder, make_status, MAX_OPEN_ROOMS
+from snapshot import write_snapshot, read_snapshot_dir, snapshot_rooms, unpack_room, get_room_name, SNAPSHOT_DIR
+from log import get_logger, trace_on_signal, flush_logs
+
+## sharded server
+## the coordinator owns the listening socket, reads the first packet of
+## every connection to find its room (or matches it with an opponent in
+## the lobby) and passes the socket itself (not the traffic) to the worker
+## process hosting that room
+## workers run many ChessServer rooms each, on one shared Server
+##
+## linux only (socket passing over AF_UNIX/SOCK_SEQPACKET)
+##
+## SIGUSR2 restarts the server without ending its games: every worker writes
+## its live rooms to SNAPSHOT_DIR and the process runs itself again, which
+## hands the rooms out to the new workers, players get back in with their
+## session tokens like after any drop (see snapshot.py)
+## players still in the lobby are not kept
+
+SHARD_MSG_REPORT = 0            ## uint32 rooms, uint32 players, utf8_string* rooms with a free seat
+SHARD_MSG_ROOM_CLOSED = 1       ## utf8_string room
+SHARD_MSG_RESULT = 2            ## utf8_string white, utf8_string black, utf8_string result
+
+## coordinator -> worker, sent without a socket
+SHARD_CMD_SNAPSHOT = 0          ## utf8_string path         write the live rooms there and exit
+
+SHARD_REPORT_INTERVAL = 1.0
+SHARD_TICK_WAIT = 0.005         ## max wait for socket activity per worker tick
+SHARD_SNAPSHOT_TIMEOUT = 60     ## seconds the coordinator waits for the snapshots
+RESTORE_BATCH = 50              ## restored rooms per worker tick
+BOARD_RELEASE_INTERVAL = 30.0   ## seconds a room can sit untouched before its board is dropped
+
+## clients that don't send PACKET_JOIN_ROOM go through matchmaking
+MATCH_ROOM_PREFIX = "#match"
+
+log = get_logger("shards")
+
+class ShardWorker:
+    ## clock: (base, increment) seconds for every room, None for no clocks
+    ## profile: log tick stats every PROFILE_LOG_INTERVAL
+    ## restore: packed rooms of a snapshot (see snapshot.py) this worker takes over
+    def __init__(self, idx, control, clock=None, profile=False, restore=()):
+        self.idx = idx
+        self.control = control
+        self.running = True
+
+        ## recv_fds ignores MSG_DONTWAIT
+        self.control.setblocking(False)
+
+        self.server = Server(None, rate_limits=RATE_LIMITS, track_removed=True)
+
+        self.rooms = {}         ## room name -> ChessServer
+        self.client_room = {}   ## Server client id -> room name
+
+        ## rooms holding seats of dropped players, updated until the seats expire
+        self.held_rooms = set()
+
+        ## flag-fall of all rooms, only rooms whose time ran out get updated
+        self.clock = clock
+        self.deadlines = DeadlineHeap()
+
+        ## room name -> packed room, restored a batch per tick, or right
+        ## away when one of its players is back before that
+        self.restoring = collections.OrderedDict((get_room_name(record), record) for record in restore)
+
+        self.last_report = 0
+
+        ## rooms updated since the last board release, the others lose their board
+        self.touched = set()
+        self.last_release = time.time()
+
+        self.profiler = FrameProfiler()
+        self.profile_log = ProfileLogger(self.profiler, f"shards worker {idx}") if profile else None
+
+    def get_num_players(self):
+        return self.server.get_num_clients()
+
+    def get_num_rooms(self):
+        return len(self.rooms) + len(self.restoring)
+
+    def new_room(self, room):
+        game = ChessServer(server=ClientGroup(self.server), room=room, clock=self.clock, deadlines=self.deadlines)
+        game.on_result = self.send_result
+        self.rooms[room] = game
+        return game
+
+    def restore_room(self, room, now):
+        game = self.new_room(room)
+        game.set_state(unpack_room(self.restoring.pop(room)), now)
+        if not game.get_deadline() is None:
+            self.held_rooms.add(room)
+
+    ## live rooms, and those not restored yet, to path
+    def save_snapshot(self, path):
+        records = snapshot_rooms(self.rooms, time.time()) + list(self.restoring.values())
+        write_snapshot(path, records)
+        log.info("worker %d saved %d rooms to %s", self.idx, len(records), path)
+
+    ## sockets handed over by the coordinator
+    def receive_handoffs(self, dirty):
+        while True:
+            try:
+                msg,fds,flags,addr = socket.recv_fds(self.control, 1 << 16, 1)
+            except BlockingIOError:
+                return
+
+            if not fds:
+                if msg and msg[0] == SHARD_CMD_SNAPSHOT:
+                    try:
+                        self.save_snapshot(read_utf8_string(msg[1:]))
+                    except OSError as e:
+                        log.error("worker %d snapshot failed %s", self.idx, e)
+
+                ## coordinator gone, or done with us
+                self.running = False
+                return
+
+            room = read_utf8_string(msg)
+            leftover = msg[4+len(room.encode("utf-8")):]
+
+            cl_id = self.server.add_client(socket.socket(fileno=fds[0]), leftover)
+
+            if room in self.restoring:
+                self.restore_room(room, time.time())
+            elif not room in self.rooms:
+                self.new_room(room)
+
+            group = self.rooms[room]._server
+            group.add(cl_id)
+            self.client_room[cl_id] = room
+
+            ## packets read by the coordinator after the first one
+            group.push(cl_id, self.server.get_client(cl_id).read_packets())
+
+            dirty.add(room)
+
+    def send_control(self, msg_id, payload):
+        try:
+            self.control.send(bytes([msg_id]) + payload)
+        except BlockingIOError:
+            ## coordinator busy, the next report will do
+            pass
+        except OSError:
+            self.running = False
+
+    ## finished games get rated by the coordinator
+    def send_result(self, white, black, result, termination):
+        self.send_control(SHARD_MSG_RESULT, write_utf8_string(white) + write_utf8_string(black) + write_utf8_string(result))
+
+    def update(self):
+        dirty = set()
+
+        self.receive_handoffs(dirty)
+        if not self.running:
+            return
+        self.profiler.mark("handoffs")
+
+        updates = self.server.update(timeout=SHARD_TICK_WAIT)
+        self.profiler.mark("network")
+
+        for cl_id in self.server.get_removed_clients():
+            room = self.client_room.pop(cl_id)
+            self.rooms[room]._server.discard(cl_id)
+            dirty.add(room)
+
+        for cl_id,packets in updates.items():
+            room = self.client_room[cl_id]
+            self.rooms[room]._server.push(cl_id, packets)
+            self.profiler.count("packets", len(packets))
+            dirty.add(room)
+
+        now = time.time()
+        for i in range(min(RESTORE_BATCH, len(self.restoring))):
+            room = next(iter(self.restoring))
+            self.restore_room(room, now)
+            dirty.add(room)
+
+        for room in list(self.held_rooms):
+            deadline = self.rooms[room].get_deadline()
+            if deadline is None or deadline <= now:
+                self.held_rooms.discard(room)
+                dirty.add(room)
+
+        for game in self.deadlines.pop_expired(now):
+            if self.rooms.get(game.room) is game:
+                dirty.add(game.room)
+
+        self.profiler.mark("timers")
+
+        if now - self.last_release > BOARD_RELEASE_INTERVAL:
+            self.last_release = now
+            for room,game in self.rooms.items():
+                if not room in self.touched:
+                    game.release_board()
+            self.touched = set()
+        self.touched |= dirty
+
+        ## only rooms with something going on get updated
+        self.profiler.count("rooms", len(dirty))
+        for room in dirty:
+            game = self.rooms[room]
+            game.update()
+
+            if not game.get_deadline() is None:
+                self.held_rooms.add(room)
+
+            ## everybody left and nobody can come back, room is done
+            elif game._server.get_num_clients() == 0:
+                game.stop()
+                self.rooms.pop(room)
+                self.send_control(SHARD_MSG_ROOM_CLOSED, write_utf8_string(room))
+        self.profiler.mark("rooms")
+
+        if now - self.last_report > SHARD_REPORT_INTERVAL:
+            self.last_report = now
+            open_rooms = [room for room,game in self.rooms.items() if game.is_open()][:MAX_OPEN_ROOMS]
+            self.send_control(SHARD_MSG_REPORT, struct.pack("II", self.get_num_rooms(), self.get_num_players()) + b"".join(write_utf8_string(room) for room in open_rooms))
+
+        self.profiler.end_frame()
+        if not self.profile_log is None:
+            self.profile_log.update()
+
+    def stop(self):
+        for game in self.rooms.values():
+            game.stop()
+        self.server.stop()
+
+def worker_main(idx, control, clock=None, profile=False, restore=()):
+    trace_on_signal()
+
+    worker = ShardWorker(idx, control, clock, profile, restore)
+    try:
+        while worker.running:
+            worker.update()
+    except KeyboardInterrupt:
+        pass
+    worker.stop()
+
+    ## worker processes exit without atexit handlers
+    flush_logs()
+
+class ShardCoordinator:
+    ## ratings: RatingBook for matchmaking, finished games get added to it
+    ## clock: (base, increment) seconds for every room, None for no clocks
+    ## profile: workers log their tick stats
+    ## restore: packed rooms of a snapshot, spread over the workers
+    def __init__(self, ip, port, num_workers=None, ratings=None, clock=None, profile=False, restore=()):
+        if not hasattr(socket, "send_fds"):
+            raise Exception("Sharding needs socket passing (Linux, Python 3.9+)")
+
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+
+        self.server = Server((ip, port), rate_limits=RATE_LIMITS, track_removed=True)
+
+        self.workers = []
+        self.controls = []
+        for i in range(num_workers):
+            control,worker_control = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+            process = multiprocessing.Process(target=worker_main, args=(i, worker_control, clock, profile, restore[i::num_workers]), daemon=True)
+            process.start()
+            worker_control.close()
+
+            self.workers.append(process)
+            self.controls.append(control)
+
+        ## what the workers last reported
+        self.worker_rooms = [0] * num_workers
+        self.worker_players = [0] * num_workers
+        self.worker_open_rooms = [[] for i in range(num_workers)]
+
+        self.room_worker = {}
+
+        self.ratings = ratings if not ratings is None else RatingBook()
+
+        self.lobby = Lobby(self.server, self.ratings.get_rating)
+        self.match_idx = 0
+
+        ## restored rooms are where the workers got them, matches go on counting
+        for i,record in enumerate(restore):
+            room = get_room_name(record)
+            self.room_worker[room] = i % num_workers
+            self.worker_rooms[i % num_workers] += 1
+
+            if room.startswith(MATCH_ROOM_PREFIX) and room[len(MATCH_ROOM_PREFIX):].isdigit():
+                self.match_idx = max(self.match_idx, int(room[len(MATCH_ROOM_PREFIX):]) + 1)
+
+    def get_num_rooms(self):
+        return sum(self.worker_rooms)
+
+    def get_num_players(self):
+        return sum(self.worker_players)
+
+    ## rooms waiting for an opponent, as last reported
+    def get_open_rooms(self):
+        return [room for rooms in self.worker_open_rooms for room in rooms][:MAX_OPEN_ROOMS]
+
+    ## rooms stay on their worker, new rooms go to the least busy one
+    def assign(self, room):
+        if not room in self.room_worker:
+            ## dead workers get no new rooms
+            alive = [i for i in range(len(self.workers)) if not self.controls[i] is None]
+            idx = min(alive, key=lambda i: (self.worker_rooms[i], self.worker_players[i]))
+
+            self.room_worker[room] = idx
+            ## count it now, the report only comes later
+            self.worker_rooms[idx] += 1
+
+        return self.room_worker[room]
+
+    def hand_off(self, cl_id, room, packets):
+        conn,buf = self.server.detach_client(cl_id)
+
+        ## packets already parsed go along with the socket
+        leftover = b"".join([make_packet(p_id, payload) for p_id,payload in packets]) + buf
+
+        idx = self.assign(room)
+        try:
+            socket.send_fds(self.controls[idx], [write_utf8_string(room) + leftover], [conn.fileno()])
+        except OSError as e:
+            log.warning("handing off to worker %d failed %s", idx, e)
+        conn.close()
+
+    def read_reports(self):
+        for idx,control in enumerate(self.controls):
+            if control is None:
+                continue
+
+            while True:
+                try:
+                    msg = control.recv(1 << 16, socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    break
+                except OSError:
+                    msg = b""
+
+                if not msg:
+                    log.error("worker %d died", idx)
+                    self.controls[idx] = None
+                    control.close()
+
+                    ## its rooms are gone with it
+                    for room in [r for r,i in self.room_worker.items() if i == idx]:
+                        self.room_worker.pop(room)
+                    self.worker_rooms[idx] = 0
+                    self.worker_players[idx] = 0
+                    self.worker_open_rooms[idx] = []
+                    break
+
+                if msg[0] == SHARD_MSG_REPORT:
+                    self.worker_rooms[idx],self.worker_players[idx] = struct.unpack("II", msg[1:9])
+
+                    open_rooms = []
+                    buf = msg[9:]
+                    while buf:
+                        room = read_utf8_string(buf)
+                        open_rooms.append(room)
+                        buf = buf[4+len(room.encode("utf-8")):]
+                    self.worker_open_rooms[idx] = open_rooms
+
+                if msg[0] == SHARD_MSG_ROOM_CLOSED:
+                    room = read_utf8_string(msg[1:])
+                    if self.room_worker.get(room) == idx:
+                        self.room_worker.pop(room)
+
+                if msg[0] == SHARD_MSG_RESULT:
+                    white = read_utf8_string(msg[1:])
+                    msg = msg[5+len(white.encode("utf-8")):]
+                    black = read_utf8_string(msg)
+                    msg = msg[4+len(black.encode("utf-8")):]
+                    self.ratings.add_game(white, black, read_utf8_string(msg))
+
+    def update(self, timeout=SHARD_TICK_WAIT):
+        updates = self.server.update(timeout=timeout)
+
+        ## the first packet decides the room, no room means matchmaking
+        lobby_updates = {}
+        for cl_id,packets in updates.items():
+            p_id,payload = packets[0]
+            if p_id == PACKET_JOIN_ROOM and not cl_id in self.lobby:
+                try:
+                    room = read_utf8_string(payload)[:MAX_ROOM_LENGTH]
+                except (struct.error, UnicodeDecodeError):
+                    log.info("client %d sent a bad room name, dropping it", cl_id)
+                    self.server.remove_client(cl_id)
+                    continue
+                self.hand_off(cl_id, room, packets[1:])
+            else:
+                lobby_updates[cl_id] = packets
+
+        ## matched players get a fresh room, white first
+        for (white, white_packets),(black, black_packets) in self.lobby.update(lobby_updates, self.server.get_removed_clients()):
+            room = f"{MATCH_ROOM_PREFIX}{self.match_idx}"
+            self.match_idx += 1
+
+            self.hand_off(white, room, white_packets)
+            self.hand_off(black, room, black_packets)
+
+        self.read_reports()
+
+    ## every worker saves its rooms to snapshot_dir and exits, returns the
+    ## number of workers that made it
+    def snapshot(self, snapshot_dir=SNAPSHOT_DIR):
+        os.makedirs(snapshot_dir, exist_ok=True)
+
+        for idx,control in enumerate(self.controls):
+            if control is None:
+                continue
+            try:
+                control.send(bytes([SHARD_CMD_SNAPSHOT]) + write_utf8_string(os.path.join(snapshot_dir, f"shard_{idx}.snap")))
+            except OSError as e:
+                log.warning("snapshot of worker %d failed %s", idx, e)
+
+        saved = 0
+        deadline = time.time() + SHARD_SNAPSHOT_TIMEOUT
+        for idx,process in enumerate(self.workers):
+            process.join(max(0, deadline - time.time()))
+            if not self.controls[idx] is None and process.exitcode == 0:
+                saved += 1
+
+        return saved
+
+    def stop(self):
+        self.server.stop()
+        for control in self.controls:
+            if not control is None:
+                control.close()
+        for process in self.workers:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+
+## usage: shards.py [port] [workers|auto] [minutes+increment] [--profile]
+if __name__ == "__main__":
+    profile = "--profile" in sys.argv
+    args = [arg for arg in sys.argv if arg != "--profile"]
+
+    port = int(args[1]) if len(args) > 1 else 1337
+    num_workers = int(args[2]) if len(args) > 2 and args[2] != "auto" else None
+    clock = parse_time_control(args[3]) if len(args) > 3 else None
+
+    trace_on_signal()
+
+    ratings = RatingBook.from_archive(MATCH_DIR)
+    log.info("%d rated players", len(ratings))
+
+    ## rooms of the process this one replaces
+    restore = read_snapshot_dir()
+    if restore:
+        log.info("restoring %d rooms", len(restore))
+
+    coordinator = ShardCoordinator("0.0.0.0", port, num_workers, ratings, clock, profile, restore)
+    log.info("listening on %d with %d workers", port, len(coordinator.workers))
+
+    ## kill -USR2 pid restarts with the games kept, after a deploy
+    restart = []
+    if hasattr(signal, "SIGUSR2"):
+        signal.signal(signal.SIGUSR2, lambda signum, frame: restart.append(True))
+
+    ## status queries and LAN announcements, on the game port over UDP
+    status = lambda: make_status(socket.gethostname(), port, coordinator.get_num_players() + coordinator.server.get_num_clients(), coordinator.get_num_rooms(), coordinator.get_open_rooms(), clock)
+    responder = StatusResponder(("0.0.0.0", port), status)
+    coordinator.server.watch(responder.sock)
+
+    profiler = FrameProfiler()
+    profile_log = ProfileLogger(profiler, "shards coordinator") if profile else None
+
+    last_print = 0
+    try:
+        while not restart:
+            coordinator.update()
+            responder.update()
+            profiler.end_frame()
+            if not profile_log is None:
+                profile_log.update()
+
+            if time.time() - last_print > 10:
+                last_print = time.time()
+                log.info("%d rooms, %d players", coordinator.get_num_rooms(), coordinator.get_num_players())
+
+                stats = coordinator.lobby.queue.get_stats()
+                log.info("lobby: %(waiting)d waiting, %(matched)d matched, wait avg %(wait_avg).1fs p95 %(wait_p95).1fs max %(wait_max).1fs", stats)
+    except KeyboardInterrupt:
+        pass
+    coordinator.server.unwatch(responder.sock)
+    responder.stop()
+
+    if restart:
+        t = time.perf_counter()
+        saved = coordinator.snapshot()
+        log.info("%d of %d workers saved their rooms in %.2fs, restarting", saved, len(coordinator.workers), time.perf_counter() - t)
+    coordinator.stop()
+
+    if restart:
+        flush_logs()
+        os.execv(sys.executable, [sys.executable] + sys.argv)
@@ -0,0 +1,310 @@
+import array
+import chess
+import gc
+import os
+import random
+import secrets
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+from navigator import encode_move
+from networking import Server, ClientGroup
+from chessserver import *
+
+## live room snapshots, for restarting a server without ending its games
+## every room is packed from ChessServer.get_state, a file holds the rooms of
+## one process:
+##
+##   SNAPSHOT_MAGIC, uint32 version, uint32 rooms
+##   rooms: uint32 length, then ROOM_HEADER, a token per flagged seat,
+##          strings room, white nick, black nick, start FEN,
+##          moves * uint16 (see navigator.encode_move), premoves of both seats
+##
+## strings are uint16 length + utf8, NO_STRING standing for None
+## premoves are a uint8 count of (uint8 from, uint8 to) per seat
+##
+## a restored room holds the seats for RESUME_GRACE, players get back in
+## through the usual reconnect, the restart doesn't run their clocks
+
+SNAPSHOT_MAGIC = b"CHESSNAP"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_DIR = "./snapshot/"
+
+## status, flags, clock base, increment, remaining white, black, start time, plies
+ROOM_HEADER = "<BBdddddI"
+ROOM_HEADER_SIZE = struct.calcsize(ROOM_HEADER)
+
+FLAG_CLOCK = 1
+FLAG_STARTED = 2
+FLAG_TOKEN_WHITE = 4
+FLAG_TOKEN_BLACK = 8
+
+NO_STRING = 0xFFFF
+
+def pack_string(s):
+    if s is None:
+        return struct.pack("<H", NO_STRING)
+    s = s.encode("utf-8")
+    return struct.pack("<H", len(s)) + s
+
+## (string, offset after it)
+def unpack_string(buf, offset):
+    length = struct.unpack_from("<H", buf, offset)[0]
+    offset += 2
+    if length == NO_STRING:
+        return None, offset
+    return bytes(buf[offset:offset+length]).decode("utf-8"), offset+length
+
+## a room worth keeping: a game on or a player waiting for one
+def is_live(game):
+    return game.status == STATUS_PLAYING or (game.status == STATUS_WAITING_FOR_PLAYERS and any(not token is None for token in game.tokens))
+
+def pack_room(state):
+    flags = 0
+    clock = (0, 0)
+    remaining = (0, 0)
+    if not state["clock"] is None:
+        flags |= FLAG_CLOCK
+        clock = state["clock"]
+        remaining = state["remaining"]
+    if not state["start_time"] is None:
+        flags |= FLAG_STARTED
+    if not state["tokens"][0] is None:
+        flags |= FLAG_TOKEN_WHITE
+    if not state["tokens"][1] is None:
+        flags |= FLAG_TOKEN_BLACK
+
+    moves = array.array("H", state["moves"])
+    if sys.byteorder != "little":
+        moves.byteswap()
+
+    buf = [struct.pack(ROOM_HEADER, state["status"], flags, clock[0], clock[1], remaining[0], remaining[1], state["start_time"] or 0, len(moves))]
+    buf += [token for token in state["tokens"] if not token is None]
+    buf += [pack_string(state["room"]), pack_string(state["nicks"][0]), pack_string(state["nicks"][1]), pack_string(state["start_fen"])]
+    buf.append(moves.tobytes())
+    for queue in state["premoves"]:
+        buf.append(bytes([len(queue)]) + b"".join(bytes(premove) for premove in queue))
+
+    return b"".join(buf)
+
+def unpack_room(buf):
+    status,flags,base,increment,white,black,start_time,plies = struct.unpack_from(ROOM_HEADER, buf, 0)
+    offset = ROOM_HEADER_SIZE
+
+    tokens = [None, None]
+    for side,flag in [(0, FLAG_TOKEN_WHITE), (1, FLAG_TOKEN_BLACK)]:
+        if flags & flag:
+            tokens[side] = bytes(buf[offset:offset+SESSION_TOKEN_SIZE])
+            offset += SESSION_TOKEN_SIZE
+
+    room,offset = unpack_string(buf, offset)
+    white_nick,offset = unpack_string(buf, offset)
+    black_nick,offset = unpack_string(buf, offset)
+    start_fen,offset = unpack_string(buf, offset)
+
+    codes = array.array("H", buf[offset:offset+plies*2])
+    if sys.byteorder != "little":
+        codes.byteswap()
+    offset += plies*2
+
+    premoves = []
+    for side in [0, 1]:
+        count = buf[offset]
+        premoves.append([(buf[offset+1+i*2], buf[offset+2+i*2]) for i in range(count)])
+        offset += 1+count*2
+
+    return {"room": room,
+            "status": status,
+            "nicks": [white_nick, black_nick],
+            "tokens": tokens,
+            "clock": (base, increment) if flags & FLAG_CLOCK else None,
+            "remaining": [white, black] if flags & FLAG_CLOCK else None,
+            "start_fen": start_fen,
+            "start_time": start_time if flags & FLAG_STARTED else None,
+            "moves": codes,
+            "premoves": premoves}
+
+## room name of a packed room, without unpacking the rest
+def get_room_name(buf):
+    flags = buf[1]
+    offset = ROOM_HEADER_SIZE
+    offset += SESSION_TOKEN_SIZE * (bool(flags & FLAG_TOKEN_WHITE) + bool(flags & FLAG_TOKEN_BLACK))
+    return unpack_string(buf, offset)[0]
+
+## records: packed rooms, the file is only there once it is complete
+def write_snapshot(path, records):
+    tmp_path = path + ".tmp"
+    f = open(tmp_path, "wb")
+    f.write(SNAPSHOT_MAGIC + struct.pack("<II", SNAPSHOT_VERSION, len(records)))
+    for record in records:
+        f.write(struct.pack("<I", len(record)))
+        f.write(record)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.replace(tmp_path, path)
+
+## packed rooms of a snapshot file
+def read_snapshot(path):
+    f = open(path, "rb")
+    buf = f.read()
+    f.close()
+
+    if buf[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError(f"{path} is not a snapshot")
+    pos = len(SNAPSHOT_MAGIC)
+    version,num_rooms = struct.unpack_from("<II", buf, pos)
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"{path} is a version {version} snapshot, not {SNAPSHOT_VERSION}")
+    pos += 8
+
+    records = []
+    for i in range(num_rooms):
+        length = struct.unpack_from("<I", buf, pos)[0]
+        records.append(buf[pos+4:pos+4+length])
+        pos += 4+length
+
+    return records
+
+## packed rooms of every snapshot in snapshot_dir, the files are used up
+## a snapshot that can't be read is left there and skipped
+def read_snapshot_dir(snapshot_dir=SNAPSHOT_DIR):
+    if not os.path.isdir(snapshot_dir):
+        return []
+
+    records = []
+    for name in sorted(os.listdir(snapshot_dir)):
+        if not name.endswith(".snap"):
+            continue
+
+        path = os.path.join(snapshot_dir, name)
+        try:
+            records += read_snapshot(path)
+        except (OSError, ValueError, struct.error) as e:
+            server_log.error("snapshot %s not restored: %s", path, e)
+            continue
+        os.remove(path)
+
+    return records
+
+## packed rooms of every live room of a game per room dict
+def snapshot_rooms(rooms, now):
+    return [pack_room(game.get_state(now)) for game in rooms.values() if is_live(game)]
+
+## rooms live in the middle of a game of random moves, for the benchmarks
+## plies: moves played in every room, None for 20 to 80
+def random_states(num_rooms, clock=(300, 2), plies=None):
+    rng = random.Random(1)
+    states = []
+    for i in range(num_rooms):
+        board = chess.Board()
+        for ply in range(rng.randrange(20, 80) if plies is None else plies):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            board.push(rng.choice(moves))
+
+        moves = board.move_stack
+        states.append({"room": f"room{i}",
+                       "status": STATUS_PLAYING,
+                       "nicks": [f"player{rng.randrange(100)}", f"player{rng.randrange(100)}"],
+                       "tokens": [secrets.token_bytes(SESSION_TOKEN_SIZE), secrets.token_bytes(SESSION_TOKEN_SIZE)],
+                       "clock": clock,
+                       "remaining": [clock[0] - len(moves), clock[0] - len(moves) / 2],
+                       "start_fen": None,
+                       "start_time": time.time(),
+                       "moves": array.array("H", [encode_move(move) for move in moves]),
+                       "premoves": [[], []]})
+    return states
+
+## seconds to snapshot and restore num_rooms rooms, as a restart does it
+def benchmark(num_rooms):
+    server = Server(None, rate_limits=RATE_LIMITS)
+    deadlines = DeadlineHeap()
+    now = time.time()
+
+    rooms = {}
+    for state in random_states(num_rooms):
+        game = ChessServer(server=ClientGroup(server), room=state["room"], clock=state["clock"], deadlines=deadlines)
+        game.set_state(state, now)
+        rooms[state["room"]] = game
+
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, "bench.snap")
+
+    t = time.perf_counter()
+    write_snapshot(path, snapshot_rooms(rooms, now))
+    snapshot_time = time.perf_counter() - t
+
+    t = time.perf_counter()
+    restored = {}
+    for record in read_snapshot_dir(tmp_dir):
+        state = unpack_room(record)
+        game = ChessServer(server=ClientGroup(server), room=state["room"], clock=state["clock"], deadlines=deadlines)
+        game.set_state(state, now)
+        restored[state["room"]] = game
+    restore_time = time.perf_counter() - t
+
+    plies = sum(len(game.moves) for game in rooms.values())
+    size = sum(len(pack_room(game.get_state(now))) + 4 for game in rooms.values())
+    print(f"snapshot: {num_rooms} rooms, {plies} plies, {size} bytes ({size / num_rooms:.0f} per room)")
+    print(f"snapshot: snapshot {snapshot_time:.2f}s ({num_rooms / snapshot_time:.0f} rooms/s), restore {restore_time:.2f}s ({num_rooms / restore_time:.0f} rooms/s)")
+
+    mismatched = [room for room,game in rooms.items() if restored.get(room) is None or restored[room].game_board.fen() != game.game_board.fen() or restored[room].tokens != game.tokens]
+    if mismatched:
+        print(f"snapshot: {len(mismatched)} rooms restored differently, {mismatched[:5]}")
+
+    os.rmdir(tmp_dir)
+    server.stop()
+
+## bytes allocated per room by make_room(i)
+def measure_rooms(make_room, num_rooms):
+    gc.collect()
+    tracemalloc.start()
+    rooms = [make_room(i) for i in range(num_rooms)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return size / len(rooms)
+
+## bytes per room of rooms waiting for players and of rooms 80 plies into
+## a game, with the board built and released
+def memory_benchmark(num_rooms):
+    server = Server(None, rate_limits=RATE_LIMITS)
+    states = random_states(num_rooms, plies=80)
+    now = time.time()
+
+    def played_room(i, board):
+        game = ChessServer(server=ClientGroup(server), room=f"room{i}", clock=states[i]["clock"])
+        game.set_state(states[i], now)
+        ## both players are back
+        game.held = [None, None]
+        if board:
+            game.game_board
+        return game
+
+    idle = measure_rooms(lambda i: ChessServer(server=ClientGroup(server), room=f"room{i}", clock=(300, 2)), num_rooms)
+    released = measure_rooms(lambda i: played_room(i, False), num_rooms)
+    built = measure_rooms(lambda i: played_room(i, True), num_rooms)
+
+    plies = sum(len(state["moves"]) for state in states) / num_rooms
+    print(f"snapshot: bytes per room, {num_rooms} rooms: waiting {idle:.0f}, {plies:.0f} plies {released:.0f} (board released), {built:.0f} (board built)")
+
+    server.stop()
+
+## usage: snapshot.py bench [rooms]
+##        snapshot.py memory [rooms]
+##        snapshot.py snapshot.snap
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
+
+    elif len(sys.argv) > 1 and sys.argv[1] == "memory":
+        memory_benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 2000)
+
+    elif len(sys.argv) > 1:
+        for record in read_snapshot(sys.argv[1]):
+            state = unpack_room(record)
+            print(f"{state['room']}: {state['nicks'][0]} - {state['nicks'][1]}, status {state['status']}, {len(state['moves'])} plies, clock {state['remaining']}")
@@ -0,0 +1,144 @@
+import chess
+import chess.polyglot
+import collections
+import queue
+import random
+import sys
+import threading
+import time
+
+## threats of a position for the side to move, for the board overlay
+## worked out from the attack bitboards on a worker thread when a position
+## arrives and kept by zobrist hash, the drawing side only ever looks up
+## results, so showing, hiding or redrawing the overlay never recomputes
+
+THREAT_CACHE_SIZE = 256         ## positions kept
+
+## a piece attacked by a cheaper one is hanging even when defended
+THREAT_VALUES = {chess.PAWN: 1, chess.KNIGHT: 3, chess.BISHOP: 3, chess.ROOK: 5, chess.QUEEN: 9, chess.KING: 100}
+
+## squares as bitmasks, see chess.SquareSet
+## attacked: squares the opponent attacks
+## hanging: pieces of the side to move that are attacked and undefended, or
+##          attacked by a cheaper piece
+## checkers: opponent pieces giving check
+## checks: squares the side to move can give check by moving to
+class Threats:
+    __slots__ = ["attacked", "hanging", "checkers", "checks"]
+
+    def __init__(self, attacked, hanging, checkers, checks):
+        self.attacked = attacked
+        self.hanging = hanging
+        self.checkers = checkers
+        self.checks = checks
+
+def get_threats(board):
+    us = board.turn
+    them = not us
+
+    attacked = 0
+    for square in chess.scan_forward(board.occupied_co[them]):
+        attacked |= board.attacks_mask(square)
+
+    hanging = 0
+    for square in chess.scan_forward(board.occupied_co[us] & attacked & ~board.kings):
+        value = THREAT_VALUES[board.piece_type_at(square)]
+        attackers = board.attackers_mask(them, square)
+        if not board.attackers_mask(us, square) or min(THREAT_VALUES[board.piece_type_at(a)] for a in chess.scan_forward(attackers)) < value:
+            hanging |= chess.BB_SQUARES[square]
+
+    checks = 0
+    for move in board.legal_moves:
+        if board.gives_check(move):
+            checks |= chess.BB_SQUARES[move.to_square]
+
+    return Threats(attacked, hanging, board.checkers_mask(), checks)
+
+## one thread working out the threats of requested positions
+## a request that is behind newer ones by the time the worker gets to it is
+## dropped, the board it was for is gone
+class ThreatWorker:
+    def __init__(self, cache_size=THREAT_CACHE_SIZE):
+        self.cache_size = cache_size
+
+        ## hash -> Threats, least recently used first
+        self.cache = collections.OrderedDict()
+        self.pending = set()
+        self.lock = threading.Lock()
+
+        self.requests = queue.Queue()
+        self.computed = 0
+
+        self.thread = threading.Thread(target=self.run, name="threats", daemon=True)
+        self.thread.start()
+
+    ## hash of the position, its threats get worked out unless known
+    def request(self, board):
+        key = chess.polyglot.zobrist_hash(board)
+
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return key
+            if key in self.pending:
+                return key
+            self.pending.add(key)
+
+        self.requests.put((key, board.copy(stack=False)))
+        return key
+
+    ## Threats of a requested position, None while the worker is on it
+    def get(self, key):
+        return self.cache.get(key)
+
+    def run(self):
+        while True:
+            key,board = self.requests.get()
+
+            ## only the newest position matters
+            while True:
+                try:
+                    newer = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                with self.lock:
+                    self.pending.discard(key)
+                key,board = newer
+
+            threats = get_threats(board)
+
+            with self.lock:
+                self.pending.discard(key)
+                self.cache[key] = threats
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+                self.computed += 1
+
+## milliseconds per position of get_threats over random games
+def benchmark(num_positions):
+    rng = random.Random(1)
+    boards = []
+    board = chess.Board()
+    while len(boards) < num_positions:
+        moves = list(board.legal_moves)
+        if not moves or board.ply() > 120:
+            board = chess.Board()
+            continue
+        board.push(rng.choice(moves))
+        boards.append(board.copy(stack=False))
+
+    t = time.perf_counter()
+    for board in boards:
+        get_threats(board)
+    elapsed = time.perf_counter() - t
+
+    t = time.perf_counter()
+    for board in boards:
+        chess.polyglot.zobrist_hash(board)
+    hash_elapsed = time.perf_counter() - t
+
+    print(f"threats: {num_positions} positions, {elapsed * 1000 / num_positions:.3f}ms per position, hash {hash_elapsed * 1000 / num_positions:.3f}ms")
+
+## usage: threats.py [positions]
+if __name__ == "__main__":
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
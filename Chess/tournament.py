@@ -0,0 +1,617 @@
+import chess
+import math
+import socket
+import struct
+import sys
+import time
+from networking import make_packet, Server, ClientGroup, PACKET_PING
+from chessserver import *
+from bots import Bot
+from log import get_logger, flush_logs
+
+## tournaments
+## players are registered by nick, every round pairs them (round robin or
+## swiss) and each pair gets a room of its own, all rooms of a round are
+## played at the same time on one Server
+## players connect with their nick like to any server and wait until their
+## pair is there, white gets seated first, then black (see Lobby)
+## after a game they connect again for the next round, a dropped player
+## resumes its seat through the room name like on a sharded server
+##
+## results come from the rooms' on_result, with the termination the room
+## sends in PACKET_GAME_OUTCOME, games nobody finishes (a player missing
+## for FORFEIT_TIME or gone for good) are forfeits, games still on when the
+## round has taken ROUND_TIME_LIMIT are lost by the side to move
+## standings are updated with every result, Buchholz included
+##
+## bot seats are played by Bots the server runs itself over loopback, a
+## tournament of only bots (tournament.py sim) times the whole event
+
+TOURNAMENT_ROUND_ROBIN = "rr"
+TOURNAMENT_SWISS = "swiss"
+
+TOURNAMENT_ROOM_PREFIX = "#t"
+TOURNAMENT_TICK_WAIT = 0.005    ## max wait for socket activity per tick
+ROUND_BREAK = 30.0              ## seconds between rounds, players need to connect again
+FORFEIT_TIME = 120.0            ## seconds a paired player has to show up
+ROUND_TIME_LIMIT = 4 * 3600.0   ## seconds until games still on are adjudicated
+
+OUTCOME_FORFEIT = 13            ## never sent, no-shows and abandoned games
+OUTCOME_ROUND_LIMIT = 14        ## never sent, the side to move lost at ROUND_TIME_LIMIT
+
+RESULT_POINTS = {"1-0": (1, 0), "0-1": (0, 1), "1/2-1/2": (0.5, 0.5), "0-0": (0, 0)}
+BYE_POINTS = 1
+
+SWISS_PAIRING_BUDGET = 100000   ## pairing attempts before rematches are allowed
+
+## bots of a simulation give up this many points of material behind
+SIM_RESIGN_MATERIAL = 6
+PIECE_VALUES = {chess.PAWN: 1, chess.KNIGHT: 3, chess.BISHOP: 3, chess.ROOK: 5, chess.QUEEN: 9}
+
+log = get_logger("tournament")
+
+def get_termination_name(termination):
+    if termination == OUTCOME_RESIGNED:
+        return "resigned"
+    if termination == OUTCOME_TIMEOUT:
+        return "timeout"
+    if termination == OUTCOME_FORFEIT:
+        return "forfeit"
+    if termination == OUTCOME_ROUND_LIMIT:
+        return "round limit"
+    return chess.Termination(termination).name.lower()
+
+class PlayerRecord:
+    def __init__(self, nick, seed):
+        self.nick = nick
+        self.seed = seed
+
+        self.score = 0
+        ## sum of the opponents' scores
+        self.buchholz = 0
+        self.wins = 0
+        self.draws = 0
+        self.losses = 0
+
+        self.opponents = []
+        self.colors = []        ## 0 white, 1 black, per game
+        self.had_bye = False
+
+    def get_color_balance(self):
+        return self.colors.count(0) - self.colors.count(1)
+
+## scores, tie-breaks and who played whom, updated with every result
+class Standings:
+    ## nicks: in seed order
+    def __init__(self, nicks):
+        self.players = {nick: PlayerRecord(nick, seed) for seed,nick in enumerate(nicks)}
+
+    def __contains__(self, nick):
+        return nick in self.players
+
+    ## the player's opponents' Buchholz goes up with it
+    def add_points(self, record, points):
+        record.score += points
+        for opponent in record.opponents:
+            self.players[opponent].buchholz += points
+
+    ## result: "1-0", "0-1", "1/2-1/2" or "0-0" (both forfeited)
+    def add_game(self, white, black, result):
+        white = self.players[white]
+        black = self.players[black]
+
+        white.opponents.append(black.nick)
+        black.opponents.append(white.nick)
+        white.buchholz += black.score
+        black.buchholz += white.score
+        white.colors.append(0)
+        black.colors.append(1)
+
+        points = RESULT_POINTS.get(result, (0, 0))
+        for record,own,other in [(white, points[0], points[1]), (black, points[1], points[0])]:
+            if own > other:
+                record.wins += 1
+            elif own == other and own > 0:
+                record.draws += 1
+            else:
+                record.losses += 1
+            self.add_points(record, own)
+
+    def add_bye(self, nick):
+        record = self.players[nick]
+        record.had_bye = True
+        self.add_points(record, BYE_POINTS)
+
+    ## best first
+    def get_table(self):
+        return sorted(self.players.values(), key=lambda r: (-r.score, -r.buchholz, -r.wins, r.seed))
+
+## (white, black) pairs of every round, None as the opponent is a bye
+## circle method: the first player stays, the others rotate by one each round
+def round_robin_rounds(nicks):
+    players = list(nicks)
+    if len(players) % 2:
+        players.append(None)
+    n = len(players)
+
+    rounds = []
+    for r in range(n - 1):
+        pairs = []
+        for i in range(n // 2):
+            white,black = players[i], players[n - 1 - i]
+            ## colors alternate by board, the fixed player's by round
+            if (i == 0 and r % 2) or (i > 0 and i % 2):
+                white,black = black,white
+            if white is None:
+                white,black = black,white
+            pairs.append((white, black))
+        rounds.append(pairs)
+
+        players = [players[0], players[-1]] + players[1:-1]
+
+    return rounds
+
+## order paired top down, each with the first one below it not played yet
+## returns None if there is no way without rematches
+def pair_players(order, standings, budget):
+    if not order:
+        return []
+
+    first = standings.players[order[0]]
+    for i in range(1, len(order)):
+        budget[0] -= 1
+        if budget[0] < 0:
+            return None
+        if order[i] in first.opponents:
+            continue
+
+        rest = pair_players(order[1:i] + order[i+1:], standings, budget)
+        if not rest is None:
+            return [(order[0], order[i])] + rest
+
+    return None
+
+## white for whoever had it less, or had black last, else the higher ranked
+def allocate_colors(a, b, standings):
+    ra = standings.players[a]
+    rb = standings.players[b]
+
+    if ra.get_color_balance() != rb.get_color_balance():
+        return (a, b) if ra.get_color_balance() < rb.get_color_balance() else (b, a)
+    if ra.colors and rb.colors and ra.colors[-1] != rb.colors[-1]:
+        return (a, b) if ra.colors[-1] == 1 else (b, a)
+    return a, b
+
+## pairs of the next swiss round, by score then seed, no rematches if it
+## can be helped, the lowest ranked player without one gets the bye
+def swiss_pairings(standings):
+    order = [record.nick for record in sorted(standings.players.values(), key=lambda r: (-r.score, r.seed))]
+
+    bye = None
+    if len(order) % 2:
+        bye = next((nick for nick in reversed(order) if not standings.players[nick].had_bye), order[-1])
+        order.remove(bye)
+
+    pairs = pair_players(order, standings, [SWISS_PAIRING_BUDGET])
+    if pairs is None:
+        log.warning("no pairing without rematches")
+        pairs = [(order[i], order[i+1]) for i in range(0, len(order), 2)]
+
+    pairs = [allocate_colors(a, b, standings) for a,b in pairs]
+    if not bye is None:
+        pairs.append((bye, None))
+
+    return pairs
+
+## the event without the network: rounds, boards and results
+class Tournament:
+    ## nicks: players in seed order
+    ## kind: TOURNAMENT_ROUND_ROBIN or TOURNAMENT_SWISS
+    ## rounds: None for every round of a round robin, log2 players for swiss
+    def __init__(self, nicks, kind=TOURNAMENT_SWISS, rounds=None):
+        self.kind = kind
+        self.standings = Standings(nicks)
+
+        self.schedule = None
+        if kind == TOURNAMENT_ROUND_ROBIN:
+            self.schedule = round_robin_rounds(nicks)
+            self.num_rounds = len(self.schedule) if rounds is None else min(rounds, len(self.schedule))
+        else:
+            self.num_rounds = max(1, math.ceil(math.log2(len(nicks)))) if rounds is None else rounds
+
+        self.round = 0
+        ## (white, black) of this round's boards
+        self.boards = []
+        ## board -> (result, termination) of this round
+        self.results = {}
+        ## (round, white, black, result, termination) of every game
+        self.games = []
+
+    ## pairs of the next round, byes are scored right away
+    def start_round(self):
+        self.round += 1
+        if self.schedule is None:
+            pairs = swiss_pairings(self.standings)
+        else:
+            pairs = self.schedule[self.round - 1]
+
+        self.boards = []
+        self.results = {}
+        for white,black in pairs:
+            if black is None:
+                self.standings.add_bye(white)
+            else:
+                self.boards.append((white, black))
+
+        return self.boards
+
+    ## returns False if the board already has a result
+    def add_result(self, board, result, termination):
+        if board in self.results:
+            return False
+        self.results[board] = (result, termination)
+
+        white,black = self.boards[board]
+        self.standings.add_game(white, black, result)
+        self.games.append((self.round, white, black, result, termination))
+
+        return True
+
+    def is_round_over(self):
+        return len(self.results) == len(self.boards)
+
+    def is_over(self):
+        return self.round >= self.num_rounds and self.is_round_over()
+
+    ## termination name -> games
+    def get_terminations(self):
+        counts = {}
+        for game in self.games:
+            name = get_termination_name(game[4])
+            counts[name] = counts.get(name, 0) + 1
+        return counts
+
+## a Bot that gives up a lost cause
+class TournamentBot(Bot):
+    def __init__(self, ip, port, nick="bot", room=None):
+        Bot.__init__(self, ip, port, nick, room)
+        self.resigned = False
+
+    def get_material(self, color):
+        return sum([len(self.board.pieces(piece_type, color)) * value for piece_type,value in PIECE_VALUES.items()])
+
+    def choose_move(self):
+        ours = self.side == 0
+        if self.get_material(ours) - self.get_material(not ours) <= -SIM_RESIGN_MATERIAL:
+            ## no more moves, the outcome is on its way
+            if not self.resigned:
+                self.client.give_up()
+                self.resigned = True
+            return None
+
+        return Bot.choose_move(self)
+
+class TournamentServer:
+    ## tournament: Tournament to run
+    ## clock: (base, increment) seconds for every game, None for no clocks
+    ## bots: nicks whose seats the server plays itself
+    ## round_break: seconds before each round
+    ## rate_limits: see networking.Server, None for none
+    ## round_limit: seconds a round may take, then the side to move loses
+    ## every game still on (somebody stopped moving in a game without clocks)
+    def __init__(self, ip, port, tournament, clock=None, bots=(), round_break=ROUND_BREAK, forfeit_time=FORFEIT_TIME, save_matches=True, rate_limits=RATE_LIMITS, round_limit=ROUND_TIME_LIMIT):
+        self.server = Server((ip, port), rate_limits=rate_limits, track_removed=True)
+        self.port = self.server.socket.getsockname()[1]
+
+        self.tournament = tournament
+        self.clock = clock
+        self.round_break = round_break
+        self.forfeit_time = forfeit_time
+        self.round_limit = round_limit
+        self.save_matches = save_matches
+
+        self.rooms = {}             ## room name -> ChessServer
+        self.client_room = {}       ## Server client id -> room name
+        self.room_board = {}        ## room name -> (round, board) it was made for
+        self.held_rooms = set()
+        self.deadlines = DeadlineHeap()
+
+        ## connected players not in a room, with their packets so far
+        self.waiting = {}           ## client id -> packets
+        self.client_nick = {}       ## client id -> nick of waiting players
+        self.nick_client = {}       ## nick -> client id
+
+        ## room name -> (white, black) of this round's boards not started yet
+        self.unseated = {}
+        self.round_start = 0
+        self.next_round = None
+        self.finished = False
+
+        self.bot_nicks = list(bots)
+        self.bots = {}
+        self.bot_moves = 0
+
+    def remove_waiting(self, cl_id):
+        self.waiting.pop(cl_id, None)
+        nick = self.client_nick.pop(cl_id, None)
+        if not nick is None and self.nick_client.get(nick) == cl_id:
+            self.nick_client.pop(nick)
+
+    def join_room(self, cl_id, room, packets):
+        group = self.rooms[room]._server
+        group.add(cl_id)
+        self.client_room[cl_id] = room
+        group.push(cl_id, packets)
+
+    ## packets of a player not in a room, the nick says which board it plays
+    def push_waiting(self, cl_id, packets, dirty):
+        if not cl_id in self.waiting:
+            ## dropped player back to its room
+            p_id,payload = packets[0]
+            if p_id == PACKET_JOIN_ROOM:
+                try:
+                    room = read_utf8_string(payload)[:MAX_ROOM_LENGTH]
+                except (struct.error, UnicodeDecodeError):
+                    log.info("client %d sent a bad room name, dropping it", cl_id)
+                    self.server.remove_client(cl_id)
+                    return
+                if room in self.rooms:
+                    self.join_room(cl_id, room, packets[1:])
+                    dirty.add(room)
+                    return
+                packets = packets[1:]
+
+            self.waiting[cl_id] = []
+            self.server.get_client(cl_id).send(make_packet(PACKET_STATUS, bytes([STATUS_WAITING_FOR_PLAYERS])))
+
+        for p_id,payload in packets:
+            if p_id == PACKET_PING:
+                continue
+            self.waiting[cl_id].append((p_id, payload))
+
+            if p_id == PACKET_SET_NICK and not cl_id in self.client_nick:
+                try:
+                    nick = read_utf8_string(payload)[:MAX_NICK_LENGTH]
+                except (struct.error, UnicodeDecodeError):
+                    nick = None
+                if not nick in self.tournament.standings:
+                    log.info("client %d: %s is not registered", cl_id, nick)
+                    self.remove_waiting(cl_id)
+                    self.server.remove_client(cl_id)
+                    return
+
+                ## the newest connection of a nick counts
+                old = self.nick_client.get(nick)
+                if not old is None:
+                    self.remove_waiting(old)
+                    self.server.remove_client(old)
+
+                self.client_nick[cl_id] = nick
+                self.nick_client[nick] = cl_id
+
+    def start_round(self, now):
+        boards = self.tournament.start_round()
+        log.info("round %d of %d, %d boards", self.tournament.round, self.tournament.num_rounds, len(boards))
+
+        self.unseated = {}
+        for board,pair in enumerate(boards):
+            room = f"{TOURNAMENT_ROOM_PREFIX}{self.tournament.round}.{board}"
+            self.unseated[room] = pair
+            self.room_board[room] = (self.tournament.round, board)
+            log.debug("%s: %s - %s", room, pair[0], pair[1])
+
+        self.round_start = now
+        self.next_round = None
+
+    ## rooms of past rounds have their result already
+    def add_result(self, room, result, termination):
+        round,board = self.room_board[room]
+        if round == self.tournament.round and self.tournament.add_result(board, result, termination):
+            log.info("%s: %s (%s)", room, result, get_termination_name(termination))
+
+    ## pairs that are both here get their room, missing players forfeit
+    def seat_players(self, now, dirty):
+        for room,(white,black) in list(self.unseated.items()):
+            white_id = self.nick_client.get(white)
+            black_id = self.nick_client.get(black)
+
+            if not white_id is None and not black_id is None:
+                self.unseated.pop(room)
+
+                game = ChessServer(server=ClientGroup(self.server), room=room, clock=self.clock, deadlines=self.deadlines)
+                game.on_result = lambda white, black, result, termination, room=room: self.add_result(room, result, termination)
+                game.save_matches = self.save_matches
+                self.rooms[room] = game
+
+                for cl_id in [white_id, black_id]:
+                    packets = self.waiting[cl_id]
+                    self.remove_waiting(cl_id)
+                    self.join_room(cl_id, room, packets)
+                dirty.add(room)
+
+            elif now - self.round_start > self.forfeit_time:
+                self.unseated.pop(room)
+                result = "0-0"
+                if not white_id is None:
+                    result = "1-0"
+                elif not black_id is None:
+                    result = "0-1"
+                self.add_result(room, result, OUTCOME_FORFEIT)
+
+    ## games of the round still on when its time is up, the side to move loses
+    def adjudicate_round(self, now, dirty):
+        if self.round_limit is None or now - self.round_start <= self.round_limit:
+            return
+
+        for room,game in self.rooms.items():
+            if self.room_board[room][0] != self.tournament.round or game.status != STATUS_PLAYING:
+                continue
+
+            side = game.get_turn_side()
+            game.freeze_clock(now)
+            game.change_status(STATUS_GAME_ENDED)
+            game.broadcast(make_packet(PACKET_GAME_OUTCOME, bytes([OUTCOME_TIMEOUT, 0 if side == 1 else 1])))
+            game.finish_game("0-1" if side == 0 else "1-0", OUTCOME_ROUND_LIMIT)
+            dirty.add(room)
+
+    ## a player that didn't come back loses, if neither did both do
+    def score_abandoned(self, room, game):
+        seated = [not game.get_seat(side) is None for side in [0, 1]]
+        result = "0-0"
+        if seated[0] and not seated[1]:
+            result = "1-0"
+        elif seated[1] and not seated[0]:
+            result = "0-1"
+        self.add_result(room, result, OUTCOME_FORFEIT)
+
+    ## bot seats, a new connection for every game
+    def update_bots(self):
+        for nick in self.bot_nicks:
+            bot = self.bots.get(nick)
+            if not bot is None and bot.finished:
+                self.bot_moves += bot.moves
+                bot.disconnect()
+                bot = None
+            if bot is None:
+                bot = self.bots[nick] = TournamentBot("127.0.0.1", self.port, nick=nick)
+            bot.update()
+
+    def update(self):
+        dirty = set()
+
+        updates = self.server.update(timeout=TOURNAMENT_TICK_WAIT)
+
+        for cl_id in self.server.get_removed_clients():
+            room = self.client_room.pop(cl_id, None)
+            if room is None:
+                self.remove_waiting(cl_id)
+            else:
+                self.rooms[room]._server.discard(cl_id)
+                dirty.add(room)
+
+        for cl_id,packets in updates.items():
+            room = self.client_room.get(cl_id)
+            if room is None:
+                self.push_waiting(cl_id, packets, dirty)
+            else:
+                self.rooms[room]._server.push(cl_id, packets)
+                dirty.add(room)
+
+        now = time.time()
+        if self.tournament.is_round_over() and not self.finished:
+            if self.tournament.is_over():
+                self.finished = True
+                log.info("tournament over")
+            elif self.next_round is None:
+                self.next_round = now + self.round_break
+            elif now >= self.next_round:
+                self.start_round(now)
+
+        self.seat_players(now, dirty)
+        self.adjudicate_round(now, dirty)
+
+        for room in list(self.held_rooms):
+            deadline = self.rooms[room].get_deadline()
+            if deadline is None or deadline <= now:
+                self.held_rooms.discard(room)
+                dirty.add(room)
+
+        for game in self.deadlines.pop_expired(now):
+            if self.rooms.get(game.room) is game:
+                dirty.add(game.room)
+
+        for room in dirty:
+            game = self.rooms[room]
+            game.update()
+
+            ## gone for good, or before the game could start
+            if game.status == STATUS_GAME_ENDED_PLAYER_LEFT or (game.status == STATUS_WAITING_FOR_PLAYERS and game._server.get_num_clients() < 2):
+                self.score_abandoned(room, game)
+
+            if not game.get_deadline() is None:
+                self.held_rooms.add(room)
+
+            ## everybody left and nobody can come back
+            elif game._server.get_num_clients() == 0 and game.status != STATUS_PLAYING:
+                game.stop()
+                self.rooms.pop(room)
+                self.room_board.pop(room)
+
+        self.update_bots()
+
+    def stop(self):
+        for bot in self.bots.values():
+            self.bot_moves += bot.moves
+            bot.disconnect()
+        for game in self.rooms.values():
+            game.stop()
+        self.server.stop()
+
+def print_standings(tournament, top=None):
+    table = tournament.standings.get_table()
+    for rank,record in enumerate(table[:top]):
+        print(f"{rank+1:3}. {record.nick:20} {record.score:4g}  buchholz {record.buchholz:5g}  +{record.wins} ={record.draws} -{record.losses}")
+
+## the whole event played by bots, with nobody waiting between rounds
+## the bots move as fast as they can, past the move rate limit of players
+def simulate(num_players, kind, rounds=None):
+    nicks = [f"bot{i}" for i in range(num_players)]
+    tournament = Tournament(nicks, kind, rounds)
+    host = TournamentServer("127.0.0.1", 0, tournament, bots=nicks, round_break=0, save_matches=False, rate_limits=None)
+
+    t = time.perf_counter()
+    round_times = []
+    last_round = 0
+    try:
+        while not host.finished:
+            host.update()
+            if tournament.round != last_round:
+                last_round = tournament.round
+                round_times.append(time.perf_counter())
+    except KeyboardInterrupt:
+        pass
+    elapsed = time.perf_counter() - t
+    host.stop()
+
+    round_times.append(time.perf_counter())
+    longest = max([b - a for a,b in zip(round_times, round_times[1:])], default=0)
+    games = len(tournament.games)
+
+    print_standings(tournament, 10)
+    print(f"tournament: {num_players} players, {kind} {tournament.round} rounds, {games} games, {host.bot_moves} moves in {elapsed:.1f}s")
+    print(f"tournament: {games / elapsed:.1f} games/s, {host.bot_moves / elapsed:.0f} moves/s, longest round {longest:.1f}s")
+    print(f"tournament: {tournament.get_terminations()}")
+
+## usage: tournament.py [port] [rr|swiss] [rounds|auto] [minutes+increment|none] nick ... [--bots=N]
+##        tournament.py sim [players] [rr|swiss] [rounds|auto]
+## nicks in seed order, --bots adds N bot seats played by the server
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "sim":
+        num_players = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+        kind = sys.argv[3] if len(sys.argv) > 3 else TOURNAMENT_SWISS
+        rounds = int(sys.argv[4]) if len(sys.argv) > 4 and sys.argv[4] != "auto" else None
+        simulate(num_players, kind, rounds)
+        flush_logs()
+        sys.exit()
+
+    bots = [f"bot{i}" for arg in sys.argv if arg.startswith("--bots=") for i in range(int(arg[7:]))]
+    args = [arg for arg in sys.argv if not arg.startswith("--bots=")]
+
+    port = int(args[1]) if len(args) > 1 else 1337
+    kind = args[2] if len(args) > 2 else TOURNAMENT_SWISS
+    rounds = int(args[3]) if len(args) > 3 and args[3] != "auto" else None
+    clock = parse_time_control(args[4]) if len(args) > 4 and args[4] != "none" else None
+    nicks = args[5:] + bots
+
+    tournament = Tournament(nicks, kind, rounds)
+    host = TournamentServer("0.0.0.0", port, tournament, clock, bots)
+    log.info("%s tournament of %d players, %d rounds, on %d", kind, len(nicks), tournament.num_rounds, port)
+
+    try:
+        while not host.finished:
+            host.update()
+    except KeyboardInterrupt:
+        pass
+    host.stop()
+
+    print_standings(tournament)